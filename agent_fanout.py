@@ -0,0 +1,128 @@
+"""
+多智能体咨询模块 - 把问题同时发给多个专业智能体，带单个智能体超时和整体截止时间
+"""
+
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import chat_chain
+
+# 单个智能体的回答超时（秒）
+CONSULT_TIMEOUT = float(os.getenv("CONSULT_TIMEOUT", "20"))
+# 整次咨询的截止时间（秒）
+CONSULT_DEADLINE = float(os.getenv("CONSULT_DEADLINE", "30"))
+# 最多同时咨询的智能体数量
+CONSULT_MAX_AGENTS = int(os.getenv("CONSULT_MAX_AGENTS", "3"))
+# 咨询模式：merge合并所有按时返回的回答，first返回最先得到的有效回答
+CONSULT_MODE = os.getenv("CONSULT_MODE", "merge")
+# 有知识库时检索的文档片段数
+CONSULT_RETRIEVAL_K = 4
+
+# 执行LLM调用的线程池。不使用事件循环的默认线程池，否则asyncio.run()退出时
+# 会等待超时的调用执行完，截止时间就失去了作用
+_executor = ThreadPoolExecutor(max_workers=CONSULT_MAX_AGENTS * 4, thread_name_prefix="consult")
+
+
+class ConsultChain:
+    """
+    用于被其他智能体咨询的无状态问答链
+
+    不带对话记忆，同一个实例可以被多个请求并发使用，因此可以按智能体缓存复用，
+    不必每次咨询都重新创建。
+    """
+
+    def __init__(self, role_prompt, vector_store=None, k=CONSULT_RETRIEVAL_K):
+        """
+        Args:
+            role_prompt: 智能体的角色设定
+            vector_store: 智能体的向量存储，没有知识库时为None
+            k: 检索的文档片段数
+        """
+        self.role_prompt = role_prompt
+        self.vector_store = vector_store
+        self.k = k
+
+    def answer(self, question):
+        """
+        回答问题
+
+        Returns:
+            回答文本
+        """
+        system_prompt = self.role_prompt
+        if self.vector_store is not None:
+            documents = self.vector_store.similarity_search(question, k=self.k)
+            if documents:
+                context = "\n\n".join(document.page_content for document in documents)
+                system_prompt += f"\n\n请参考以下资料回答问题：\n{context}"
+        response = chat_chain.get_llm().invoke([("system", system_prompt), ("human", question)])
+        return getattr(response, 'content', response).strip()
+
+
+async def _consult_one(agent_info, chain, question, timeout):
+    started_at = time.monotonic()
+    result = {'agent': agent_info, 'answer': None, 'error': None, 'seconds': 0.0}
+    try:
+        # LLM调用是阻塞的，放到线程中执行，多个智能体才能同时进行
+        loop = asyncio.get_running_loop()
+        result['answer'] = await asyncio.wait_for(loop.run_in_executor(_executor, chain.answer, question), timeout)
+    except asyncio.TimeoutError:
+        result['error'] = f"超过 {timeout:.0f} 秒未回答"
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = time.monotonic() - started_at
+    return result
+
+async def consult_agents(question, targets, mode=CONSULT_MODE, timeout=CONSULT_TIMEOUT, deadline=CONSULT_DEADLINE):
+    """
+    同时向多个智能体咨询问题
+
+    Args:
+        question: 问题
+        targets: [(智能体信息, ConsultChain)]
+        mode: merge返回截止时间内所有的回答，first返回最先得到的有效回答
+        timeout: 单个智能体的超时（秒）
+        deadline: 整次咨询的截止时间（秒）
+
+    Returns:
+        结果列表，每项为{'agent', 'answer', 'error', 'seconds'}；
+        first模式下只包含第一个有效回答（没有有效回答时包含所有失败的结果）
+    """
+    tasks = [asyncio.create_task(_consult_one(agent_info, chain, question, timeout))
+             for agent_info, chain in targets]
+    results = []
+    try:
+        if mode == 'first':
+            for next_done in asyncio.as_completed(tasks, timeout=deadline):
+                result = await next_done
+                if result['answer']:
+                    results = [result]
+                    break
+                results.append(result)
+        else:
+            done, _ = await asyncio.wait(tasks, timeout=deadline)
+            # 按智能体的排序返回
+            results = [task.result() for task in tasks if task in done]
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    for result in results:
+        status = "完成" if result['answer'] else f"失败: {result['error']}"
+        print(f"咨询 {result['agent']['name']} {status}，耗时 {result['seconds']:.2f} 秒")
+    return results
+
+def merge_answers(results):
+    """
+    把多个智能体的回答合并成一条消息
+
+    Returns:
+        合并后的文本，没有任何有效回答时返回None
+    """
+    answered = [result for result in results if result['answer']]
+    if not answered:
+        return None
+    return "\n\n".join(f"[{result['agent']['name']}回答] {result['answer']}" for result in answered)
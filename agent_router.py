@@ -0,0 +1,232 @@
+"""
+智能体路由模块 - 用嵌入向量为每个智能体建立画像，按相似度把问题路由给最合适的智能体
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# 画像中角色设定向量所占的权重，其余为知识库向量平均值
+ROUTER_ROLE_WEIGHT = float(os.getenv("ROUTER_ROLE_WEIGHT", "0.5"))
+# 目标智能体的最低相似度
+ROUTER_MIN_SCORE = float(os.getenv("ROUTER_MIN_SCORE", "0.3"))
+# 目标智能体需要比当前智能体高出多少相似度才转发
+ROUTER_MARGIN = float(os.getenv("ROUTER_MARGIN", "0.05"))
+# 缓存的查询向量数量
+ROUTER_QUERY_CACHE_SIZE = int(os.getenv("ROUTER_QUERY_CACHE_SIZE", "1024"))
+# 计算画像失败后的重试间隔（秒），连续失败时翻倍直到上限
+ROUTER_RETRY_DELAY = float(os.getenv("ROUTER_RETRY_DELAY", "5"))
+ROUTER_MAX_RETRY_DELAY = float(os.getenv("ROUTER_MAX_RETRY_DELAY", "300"))
+# 不参与路由的智能体类型
+ROUTER_EXCLUDED_TYPES = ("DEFAULT",)
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class AgentRouter:
+    """
+    智能体路由器
+
+    每个智能体的画像向量由角色设定的嵌入和知识库向量平均值加权得到，
+    所有画像组成一个归一化矩阵，一次矩阵乘法即可得到问题与全部智能体的相似度。
+    智能体变化时只标记需要重新计算的画像，由后台线程补算并替换矩阵，
+    路由时只使用已经算好的矩阵，还没有矩阵时不路由。
+    """
+
+    def __init__(self, embed_query, load_centroid, query_cache_size=ROUTER_QUERY_CACHE_SIZE):
+        """
+        Args:
+            embed_query: 嵌入单条文本的函数，返回向量
+            load_centroid: 获取智能体知识库向量平均值的函数，参数为智能体ID，没有知识库时返回None
+            query_cache_size: 缓存的查询向量数量
+        """
+        self.embed_query = embed_query
+        self.load_centroid = load_centroid
+        self.query_cache_size = query_cache_size
+        self._agents = {}  # {agent_id: agent_info}
+        self._profiles = {}  # {agent_id: 归一化的画像向量}
+        self._stale = set()  # 需要重新计算画像的智能体ID
+        self._needs_rebuild = False  # 有智能体被删除或重置，需要重建矩阵
+        self._matrix = None
+        self._matrix_ids = []
+        self._query_cache = OrderedDict()  # {问题文本: 归一化的查询向量}
+        self._lock = threading.Lock()
+        self._refresh_event = threading.Event()
+        self._refresher = None  # 第一次有智能体变化时才启动
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.decisions = 0
+        self.total_decision_ms = 0.0
+        self.last_decision_ms = 0.0
+
+    def set_agents(self, agent_infos):
+        """设置全部智能体（启动时调用），画像在后台计算"""
+        with self._lock:
+            self._agents = {agent_info['id']: agent_info for agent_info in agent_infos}
+            self._profiles = {}
+            self._stale = set(self._agents)
+            self._needs_rebuild = True
+            self._wake_refresher()
+
+    def update_agent(self, agent_info):
+        """智能体被创建、修改或知识库变化后调用，新画像在后台计算，算好之前继续使用旧画像"""
+        with self._lock:
+            self._agents[agent_info['id']] = agent_info
+            self._stale.add(agent_info['id'])
+            self._wake_refresher()
+
+    def remove_agent(self, agent_id):
+        """智能体被删除后调用"""
+        with self._lock:
+            self._agents.pop(agent_id, None)
+            self._profiles.pop(agent_id, None)
+            self._stale.discard(agent_id)
+            self._needs_rebuild = True
+            self._wake_refresher()
+
+    def rank(self, message, from_agent_id, limit):
+        """
+        按相似度列出比当前智能体更适合回答问题的其他智能体
+
+        Args:
+            message: 用户的问题
+            from_agent_id: 当前对话的智能体ID
+            limit: 最多返回的智能体数量
+
+        Returns:
+            ([(智能体信息, 相似度)]按相似度从高到低, 当前智能体相似度（不参与路由时为None）)
+        """
+        with self._lock:
+            matrix, matrix_ids = self._matrix, self._matrix_ids
+            agents = self._agents
+        # 画像还没有在后台算好时不路由，也不为问题调用嵌入
+        if matrix is None or not matrix_ids:
+            return [], None
+
+        # 决策耗时包括问题的嵌入（缓存未命中时是一次远程调用）
+        started_at = time.perf_counter()
+        query = self._get_query_vector(message)
+        scores = matrix @ query
+        current_score = None
+        if from_agent_id in matrix_ids:
+            current_index = matrix_ids.index(from_agent_id)
+            current_score = float(scores[current_index])
+            scores[current_index] = -np.inf
+        threshold = max(ROUTER_MIN_SCORE, (current_score if current_score is not None else -1.0) + ROUTER_MARGIN)
+
+        ranked = []
+        for index in np.argsort(-scores):
+            if len(ranked) >= limit or scores[index] < threshold:
+                break
+            # 矩阵在后台重建之前，已删除的智能体可能还在其中
+            agent_info = agents.get(matrix_ids[index])
+            if agent_info is not None:
+                ranked.append((agent_info, float(scores[index])))
+
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        with self._lock:
+            self.decisions += 1
+            self.total_decision_ms += elapsed_ms
+            self.last_decision_ms = elapsed_ms
+        return ranked, current_score
+
+    def stats(self):
+        """获取路由器统计信息"""
+        with self._lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                'agents': len(self._profiles),
+                'stale_profiles': len(self._stale),
+                'query_cache_size': len(self._query_cache),
+                'query_cache_hit_rate': self.cache_hits / lookups if lookups else 0.0,
+                'decisions': self.decisions,
+                'avg_decision_ms': self.total_decision_ms / self.decisions if self.decisions else 0.0,
+                'last_decision_ms': self.last_decision_ms
+            }
+
+    def _get_query_vector(self, message):
+        with self._lock:
+            vector = self._query_cache.get(message)
+            if vector is not None:
+                self._query_cache.move_to_end(message)
+                self.cache_hits += 1
+                return vector
+            self.cache_misses += 1
+
+        vector = _normalize(self.embed_query(message))
+        with self._lock:
+            self._query_cache[message] = vector
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+        return vector
+
+    def _build_profile(self, agent_info):
+        role_text = f"{agent_info.get('name', '')}。{agent_info.get('role', '')}"
+        profile = _normalize(self.embed_query(role_text))
+        centroid = None
+        if agent_info.get('has_knowledge_base'):
+            try:
+                centroid = self.load_centroid(agent_info['id'])
+            except Exception as e:
+                print(f"读取智能体 {agent_info['id']} 的知识库向量时出错: {e}")
+        if centroid is not None:
+            profile = _normalize(ROUTER_ROLE_WEIGHT * profile + (1 - ROUTER_ROLE_WEIGHT) * _normalize(centroid))
+        return profile
+
+    def _wake_refresher(self):
+        """通知后台线程重新计算画像（调用方需持有self._lock）"""
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._run_refresher, daemon=True)
+            self._refresher.start()
+        self._refresh_event.set()
+
+    def _run_refresher(self):
+        retry_delay = ROUTER_RETRY_DELAY
+        while True:
+            self._refresh_event.wait()
+            self._refresh_event.clear()
+            try:
+                self._refresh_profiles()
+                retry_delay = ROUTER_RETRY_DELAY
+            except Exception as e:
+                print(f"计算智能体画像时出错，{retry_delay:.0f}秒后重试: {e}")
+                # 稍后重试仍待计算的画像，嵌入服务持续不可用（如未配置API密钥）时逐渐拉长间隔
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, ROUTER_MAX_RETRY_DELAY)
+                self._refresh_event.set()
+
+    def _refresh_profiles(self):
+        with self._lock:
+            stale = [self._agents[agent_id] for agent_id in self._stale if agent_id in self._agents]
+            needs_rebuild = self._needs_rebuild
+
+        profiles = {}
+        for agent_info in stale:
+            if agent_info.get('agent_type') in ROUTER_EXCLUDED_TYPES:
+                continue
+            profiles[agent_info['id']] = self._build_profile(agent_info)
+
+        if not stale and not needs_rebuild:
+            return
+        with self._lock:
+            # 矩阵按此刻的画像重建，计算期间被删除的智能体也已经不在其中
+            self._needs_rebuild = False
+            for agent_info in stale:
+                agent_id = agent_info['id']
+                # 计算期间智能体可能已被修改（保持待计算）或删除
+                if self._agents.get(agent_id) is not agent_info:
+                    continue
+                self._stale.discard(agent_id)
+                self._profiles.pop(agent_id, None)
+                if agent_id in profiles:
+                    self._profiles[agent_id] = profiles[agent_id]
+            self._matrix_ids = list(self._profiles)
+            self._matrix = np.stack([self._profiles[agent_id] for agent_id in self._matrix_ids]) \
+                if self._matrix_ids else None
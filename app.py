@@ -7,12 +7,29 @@ import time
 import shutil
 import rag_core
 import io
-import speech_to_text
+import stt_pool
+import streaming_stt
 import text_to_speech
+import vector_store_cache
+import chat_chain
+import knowledge_base
+import embedding_cache
+import ingestion_jobs
+import storage
+import chain_pool
+import conversation_summary
+import context_budget
+import agent_router
+import agent_fanout
+import streaming
+import tts_pipeline
+import tts_cache
+import audio_frames
 from werkzeug.utils import secure_filename
 import threading
 import asyncio
 import base64
+import itertools
 import edge_tts
 
 app = Flask(__name__)
@@ -33,16 +50,30 @@ AGENT_TYPES = {
 }
 
 # 确保所有必要的文件夹都存在
-for folder in [UPLOAD_FOLDER, VECTOR_STORE_FOLDER, AGENTS_FOLDER, CONVERSATIONS_FOLDER]:
+for folder in [UPLOAD_FOLDER, VECTOR_STORE_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
 # 允许上传的文件类型
 ALLOWED_EXTENSIONS = {'pdf', 'docx', 'txt'}
 
-# --- 内存中的状态 (临时方案) ---
-# 在生产环境中，应该使用数据库来存储
-agents = {}  # {agent_id: agent_info}
-conversations = {}  # {conv_id: {qa_chain, agent_id, messages}}
+# 获取对话时每页返回的消息数
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
+# 创建QA链时加载的最近消息数，与对话记忆窗口一致
+CONTEXT_HISTORY_MESSAGES = chat_chain.MEMORY_WINDOW_TURNS * 2
+
+# --- 状态 ---
+# 数据库、后台线程和路由器在init_services()中创建。语音识别和文档解析的工作进程以spawn方式启动，
+# 会重新导入主模块，导入本模块时不能有打开数据库、启动线程或调用远程服务等副作用
+# 智能体、对话和消息保存在SQLite中，内存中只保留运行时对象
+db = None
+ingestion_queue = None
+summary_worker = None
+router = None
+# 对话的QA链延迟创建，池中数量有上限，被淘汰的链下次使用时从对话历史重建
+qa_chains = chain_pool.get_pool()
+# 被其他智能体咨询时使用的无状态问答链，按智能体ID缓存
+consult_chains = chain_pool.ChainPool()
 
 # --- 辅助函数 ---
 
@@ -50,155 +81,175 @@ def allowed_file(filename):
     """检查文件类型是否允许上传"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def load_agents():
-    """从文件系统加载所有已保存的智能体"""
-    global agents
-    if not os.path.exists(AGENTS_FOLDER):
-        return
-    
-    for agent_id in os.listdir(AGENTS_FOLDER):
-        agent_path = os.path.join(AGENTS_FOLDER, agent_id)
-        if os.path.isdir(agent_path):
-            info_path = os.path.join(agent_path, 'info.json')
-            if os.path.exists(info_path):
-                with open(info_path, 'r', encoding='utf-8') as f:
-                    agents[agent_id] = json.load(f)
-
-def load_conversations():
-    """从文件系统加载所有已保存的对话"""
-    global conversations
-    if not os.path.exists(CONVERSATIONS_FOLDER):
-        return
-    
-    for conv_id in os.listdir(CONVERSATIONS_FOLDER):
-        conv_path = os.path.join(CONVERSATIONS_FOLDER, conv_id)
-        if os.path.isdir(conv_path):
-            messages_path = os.path.join(conv_path, 'messages.json')
-            info_path = os.path.join(conv_path, 'info.json')
-            if os.path.exists(messages_path) and os.path.exists(info_path):
-                with open(messages_path, 'r', encoding='utf-8') as f:
-                    messages = json.load(f)
-                with open(info_path, 'r', encoding='utf-8') as f:
-                    info = json.load(f)
-                
-                # 创建对话对象但不立即加载QA链（延迟加载）
-                conversations[conv_id] = {
-                    'qa_chain': None,  # 延迟加载
-                    'agent_id': info['agent_id'],
-                    'messages': messages,
-                    'title': info.get('title', '新对话')
-                }
+def get_agent_vector_store(agent_id):
+    """获取智能体的向量存储，同一智能体的所有对话共享进程内缓存的索引"""
+    vector_store_path = knowledge_base.current_path(os.path.join(VECTOR_STORE_FOLDER, agent_id))
+    cache = vector_store_cache.get_cache()
+    return cache.get(agent_id, vector_store_path, knowledge_base.load_vector_store)
 
-def save_agent(agent_id, agent_info):
-    """保存智能体信息到文件系统"""
-    agent_path = os.path.join(AGENTS_FOLDER, agent_id)
-    os.makedirs(agent_path, exist_ok=True)
-    
-    # 保存智能体信息
-    with open(os.path.join(agent_path, 'info.json'), 'w', encoding='utf-8') as f:
-        json.dump(agent_info, f, ensure_ascii=False, indent=2)
+def swap_agent_vector_store(agent_id, vector_store):
+    """
+    切换智能体的向量存储：正在执行的问答继续使用旧的索引快照，
+    之后的检索使用新索引。vector_store为None表示知识库已被清空。
+    调用方需持有该知识库的更新锁（在knowledge_base的on_commit回调中调用），保证多次更新按顺序生效。
+    """
+    cache = vector_store_cache.get_cache()
+    if vector_store is None:
+        cache.invalidate(agent_id)
+    else:
+        vector_store_path = knowledge_base.current_path(os.path.join(VECTOR_STORE_FOLDER, agent_id))
+        cache.put(agent_id, vector_store, vector_store_cache.estimate_store_size(vector_store_path))
+
+    # 咨询链没有正在进行的对话，直接丢弃，下次咨询时重建
+    consult_chains.remove(agent_id)
 
-def save_conversation(conv_id):
-    """保存对话到文件系统"""
-    if conv_id not in conversations:
+    for conv_id, qa_chain in qa_chains.chains_for_agent(agent_id):
+        retriever = getattr(qa_chain, 'retriever', None)
+        if vector_store is not None and retriever is not None and hasattr(retriever, 'vectorstore'):
+            # 单次属性赋值，已取到旧索引引用的检索不受影响
+            retriever.vectorstore = vector_store
+        else:
+            # 链的类型需要变化（有/无知识库），下次使用时重建
+            qa_chains.remove(conv_id)
+
+def on_ingestion_committed(agent_id, vector_store):
+    """知识库导入任务写入索引后的回调：切换索引并标记智能体有知识库"""
+    agent_info = db.update_agent_fields(agent_id, {'has_knowledge_base': vector_store is not None})
+    if agent_info is None:
+        # 导入期间智能体已被删除，清理刚写入的向量存储
+        shutil.rmtree(os.path.join(VECTOR_STORE_FOLDER, agent_id), ignore_errors=True)
         return
-    
-    conv_data = conversations[conv_id]
-    conv_path = os.path.join(CONVERSATIONS_FOLDER, conv_id)
-    os.makedirs(conv_path, exist_ok=True)
-    
-    # 保存消息
-    with open(os.path.join(conv_path, 'messages.json'), 'w', encoding='utf-8') as f:
-        json.dump(conv_data['messages'], f, ensure_ascii=False, indent=2)
-    
-    # 保存对话信息
-    info = {
-        'agent_id': conv_data['agent_id'],
-        'title': conv_data.get('title', '新对话'),
-        'created_at': conv_data.get('created_at', time.time())
-    }
-    with open(os.path.join(conv_path, 'info.json'), 'w', encoding='utf-8') as f:
-        json.dump(info, f, ensure_ascii=False, indent=2)
 
-def get_qa_chain(conv_id):
-    """获取对话的QA链，如果需要则创建，支持对话历史恢复"""
-    if conv_id not in conversations:
-        return None
+    swap_agent_vector_store(agent_id, vector_store)
+    router.update_agent(agent_info)
 
-    conv_data = conversations[conv_id]
+def agent_has_vector_store(agent_id):
+    """智能体是否有知识库"""
+    return knowledge_base.has_vector_store(os.path.join(VECTOR_STORE_FOLDER, agent_id))
 
+def create_agent_qa_chain(agent_id, role_prompt, conversation_history, max_history_tokens=None):
+    """
+    为智能体创建QA链：有知识库时使用检索增强链，
+    没有知识库时使用纯对话链，跳过嵌入和检索
+    """
+    if agent_has_vector_store(agent_id):
+        # 向量存储从进程内缓存获取（未命中时才从磁盘加载）
+        vector_store = get_agent_vector_store(agent_id)
+        return rag_core.create_enhanced_qa_chain_with_context(
+            vector_store,
+            role_prompt,
+            conversation_history
+        )
+    return chat_chain.create_chat_chain_with_context(role_prompt, conversation_history, max_history_tokens)
+
+def assemble_conversation_context(conv_id, conv_data, agent_info):
+    """
+    在token预算内组装创建QA链所需的上下文：角色设定、摘要和最近的对话
+
+    较早的对话从摘要检查点恢复，只加载摘要之后的最近消息。有知识库的智能体
+    为每轮检索到的文档片段预留预算。
+
+    Returns:
+        context_budget.assemble_context()的结果，role_prompt中已包含摘要
+    """
+    role_prompt = agent_info.get('role', '你是一个有用的AI助手。')
+    message_count = conv_data['message_count']
+    covered_index = 0
+    summary = None
+    checkpoint = db.get_summary(conv_id)
+    if checkpoint is not None:
+        covered_index = checkpoint['covered_index']
+        summary = checkpoint['summary']
+    recent_messages = db.get_messages(
+        conv_id,
+        before=message_count,
+        limit=min(CONTEXT_HISTORY_MESSAGES, message_count - covered_index)
+    )
+
+    reserve_tokens = context_budget.CONTEXT_RETRIEVAL_RESERVE_TOKENS if agent_has_vector_store(agent_info['id']) else 0
+    context = context_budget.assemble_context(
+        role_prompt,
+        summary=summary,
+        messages=recent_messages,
+        reserve_tokens=reserve_tokens
+    )
+    if context['summary']:
+        context['role_prompt'] = (f"{context['role_prompt']}\n\n以下是本次对话较早内容的摘要，回答时可以参考：\n"
+                                  f"{context['summary']}")
+    return context
+
+def get_qa_chain(conv_id):
+    """获取对话的QA链，如果需要则创建，支持对话历史恢复"""
     # 如果QA链已经存在，直接返回
-    if conv_data['qa_chain'] is not None:
-        return conv_data['qa_chain']
+    qa_chain = qa_chains.get(conv_id)
+    if qa_chain is not None:
+        return qa_chain
+
+    conv_data = db.get_conversation(conv_id)
+    if conv_data is None:
+        return None
 
     # 否则，创建新的QA链
     agent_id = conv_data['agent_id']
-    if agent_id not in agents:
+    agent_info = db.get_agent(agent_id)
+    if agent_info is None:
         return None
 
-    agent_info = agents[agent_id]
-    vector_store_path = os.path.join(VECTOR_STORE_FOLDER, agent_id)
+    try:
+        context = assemble_conversation_context(conv_id, conv_data, agent_info)
+        report = context['report']
+        print(f"对话 {conv_id} 的上下文: {report['total_tokens']}/{report['budget']} tokens, "
+              f"{report['sections']['messages']['included']} 条历史消息")
+        qa_chain, _ = create_agent_qa_chain(
+            agent_id,
+            context['role_prompt'],
+            context['messages'],
+            context['history_tokens']
+        )
+        qa_chains.put(conv_id, agent_id, qa_chain, synced_count=conv_data['message_count'])
+        return qa_chain
+    except Exception as e:
+        print(f"加载QA链时出错: {e}")
+        return None
 
-    # 获取对话历史用于上下文恢复
-    conversation_history = conv_data.get('messages', [])
+def sync_qa_chain_memory(conv_id, qa_chain, message_count):
+    """
+    把QA链记忆中缺少的消息增量补充进去，保留检索器和LLM客户端不变
 
-    # 如果向量存储存在，加载它
-    if os.path.exists(vector_store_path):
-        try:
-            vector_store = rag_core.load_vector_store(vector_store_path)
-            # 使用增强的QA链创建方法，传入对话历史
-            qa_chain, _ = rag_core.create_enhanced_qa_chain_with_context(
-                vector_store,
-                agent_info.get('role', '你是一个有用的AI助手。'),
-                conversation_history
-            )
-            conv_data['qa_chain'] = qa_chain
-            return qa_chain
-        except Exception as e:
-            print(f"加载QA链时出错: {e}")
-            return None
-    else:
-        # 如果没有知识库，创建一个空的QA链
-        try:
-            from langchain_community.vectorstores import FAISS
-            from langchain_community.embeddings import DashScopeEmbeddings
-            from langchain.schema import Document
-
-            api_key = os.getenv("DASHSCOPE_API_KEY", "sk-ea76fba3b52045579e38a398598ff512")
-            embeddings = DashScopeEmbeddings(
-                model="text-embedding-v1",
-                dashscope_api_key=api_key
-            )
-
-            # 创建一个空的向量存储
-            empty_docs = [Document(page_content="这是一个空的知识库", metadata={"source": "none"})]
-            vector_store = FAISS.from_documents(empty_docs, embeddings)
-
-            # 使用增强的QA链创建方法，传入对话历史
-            qa_chain, _ = rag_core.create_enhanced_qa_chain_with_context(
-                vector_store,
-                agent_info.get('role', '你是一个有用的AI助手。'),
-                conversation_history
-            )
-            conv_data['qa_chain'] = qa_chain
-            return qa_chain
-        except Exception as e:
-            print(f"创建空QA链时出错: {e}")
-            return None
+    经过QA链回答的轮次已由链自己写入记忆，这里只补充没有经过链的消息，
+    例如转发给其他智能体的回答，开销只与缺少的消息数有关。
+
+    Args:
+        conv_id: 对话ID
+        qa_chain: 对话的QA链
+        message_count: 对话当前已持久化的消息数
+    """
+    synced_count = qa_chains.get_synced_count(conv_id)
+    if synced_count is None or synced_count >= message_count:
+        return
+
+    memory = getattr(qa_chain, 'memory', None)
+    if memory is not None and hasattr(memory, 'chat_memory'):
+        missing = db.get_messages(
+            conv_id,
+            before=message_count,
+            limit=min(message_count - synced_count, CONTEXT_HISTORY_MESSAGES)
+        )
+        chat_chain.append_to_memory(memory, missing)
+        print(f"对话 {conv_id} 的记忆补充了 {len(missing)} 条消息")
+    qa_chains.mark_synced(conv_id, message_count)
 
 def refresh_qa_chain_context(conv_id):
     """刷新QA链的上下文，用于长对话中保持记忆"""
-    if conv_id not in conversations:
+    conv_data = db.get_conversation(conv_id)
+    if conv_data is None:
         return False
 
-    conv_data = conversations[conv_id]
-    agent_id = conv_data['agent_id']
-
-    if agent_id not in agents:
+    if db.get_agent(conv_data['agent_id']) is None:
         return False
 
     # 强制重新创建QA链以更新上下文
-    conv_data['qa_chain'] = None
+    qa_chains.remove(conv_id)
 
     # 重新获取QA链，这会自动加载最新的对话历史
     qa_chain = get_qa_chain(conv_id)
@@ -207,80 +258,57 @@ def refresh_qa_chain_context(conv_id):
 
 # --- 智能体意图识别与消息路由 ---
 
-def detect_intent(message):
+def find_consult_agents(message, agent_info):
     """
-    检测用户消息的意图，判断是语文问题还是数学问题
-    返回意图类型: "CHINESE_TEACHER" 或 "MATH_TEACHER"
+    为问题寻找更合适的其他智能体，优先使用嵌入路由，
+    嵌入服务不可用时转发给所有其他专业智能体
+
+    Returns:
+        目标智能体信息列表，按相似度从高到低，不需要转发时为空
     """
-    # 数学问题的特征词
-    math_keywords = [
-        "数学", "计算", "方程", "加减乘除", "加法", "减法", "乘法", "除法", 
-        "代数", "几何", "三角", "函数", "微积分", "概率", "统计", 
-        "平方", "立方", "开方", "开根号", "+", "-", "*", "/", "=", "<", ">", "≠", "≤", "≥"
+    if embedding_cache.is_configured():
+        try:
+            ranked, current_score = router.rank(message, agent_info['id'], limit=agent_fanout.CONSULT_MAX_AGENTS)
+            for target_agent, score in ranked:
+                print(f"问题路由到 {target_agent['name']}，相似度 {score:.3f}（当前智能体 {current_score}）")
+            return [target_agent for target_agent, _ in ranked]
+        except Exception as e:
+            print(f"嵌入路由出错，转发给所有专业智能体: {e}")
+
+    return [
+        target_agent for target_agent in db.list_agents()
+        if target_agent['id'] != agent_info['id']
+        and target_agent.get('agent_type') not in agent_router.ROUTER_EXCLUDED_TYPES
     ]
-    
-    # 检查消息中是否包含数学关键词
-    for keyword in math_keywords:
-        if keyword in message:
-            return "MATH_TEACHER"
-    
-    # 默认为语文问题
-    return "CHINESE_TEACHER"
 
-async def route_message_to_agent(message, from_agent_id, to_agent_type, conv_id):
+def get_consult_chain(agent_info):
+    """获取智能体的咨询链，不存在时创建（有知识库时带检索）"""
+    agent_id = agent_info['id']
+    consult_chain = consult_chains.get(agent_id)
+    if consult_chain is None:
+        to_type_name = AGENT_TYPES.get(agent_info.get('agent_type'), '助手')
+        role_prompt = agent_info.get('role', f"你是一个{to_type_name}。")
+        vector_store = get_agent_vector_store(agent_id) if agent_has_vector_store(agent_id) else None
+        consult_chain = agent_fanout.ConsultChain(role_prompt, vector_store)
+        consult_chains.put(agent_id, agent_id, consult_chain)
+    return consult_chain
+
+async def route_message_to_agent(message, target_agents):
     """
-    将消息从一个智能体路由到另一个智能体
+    将消息同时转发给多个智能体，合并按时返回的回答（或返回最先得到的有效回答）
+
+    Returns:
+        转发得到的回答，所有智能体都失败或超时时返回None
     """
-    # 找到目标类型的智能体
-    target_agent = None
-    for agent_id, agent_info in agents.items():
-        if agent_info.get("agent_type") == to_agent_type:
-            target_agent = agent_info
-            break
-    
-    # 如果找不到目标类型的智能体，返回错误消息
-    if not target_agent:
-        return f"我需要请教{AGENT_TYPES[to_agent_type]}来回答这个问题，但目前系统中没有该类型的智能体。"
-    
-    # 构建转发消息
-    forwarded_message = f"[转发自{agents[from_agent_id]['name']}] {message}"
-    
-    # 获取目标智能体的QA链
-    vector_store_path = os.path.join(VECTOR_STORE_FOLDER, target_agent["id"])
-    vector_store = None
-    
-    try:
-        if os.path.exists(vector_store_path):
-            vector_store = rag_core.load_vector_store(vector_store_path)
-        else:
-            # 创建一个空的向量存储
-            from langchain_community.vectorstores import FAISS
-            from langchain_community.embeddings import DashScopeEmbeddings
-            from langchain.schema import Document
-            
-            api_key = os.getenv("DASHSCOPE_API_KEY", "sk-ea76fba3b52045579e38a398598ff512")
-            embeddings = DashScopeEmbeddings(
-                model="text-embedding-v1",
-                dashscope_api_key=api_key
-            )
-            
-            empty_docs = [Document(page_content="这是一个空的知识库", metadata={"source": "none"})]
-            vector_store = FAISS.from_documents(empty_docs, embeddings)
-    
-        # 创建目标智能体的QA链
-        role_prompt = target_agent.get("role", f"你是一个{AGENT_TYPES[to_agent_type]}。")
-        qa_chain, streaming_handler = rag_core.setup_streaming_qa_chain(vector_store, role_prompt)
-    
-        # 获取回答
-        response = qa_chain({"question": message})
-        answer = response["answer"]
-        
-        # 构建返回消息
-        return f"[{target_agent['name']}回答] {answer}"
+    targets = []
+    for target_agent in target_agents:
+        try:
+            targets.append((target_agent, get_consult_chain(target_agent)))
+        except Exception as e:
+            print(f"创建智能体 {target_agent['name']} 的咨询链时出错: {e}")
     
-    except Exception as e:
-        print(f"路由消息到智能体时出错: {e}")
-        return f"在尝试咨询{target_agent['name']}时发生错误。"
+    results = await agent_fanout.consult_agents(message, targets)
+    return agent_fanout.merge_answers(results)
 
 # --- 路由 ---
 
@@ -292,7 +320,7 @@ def index():
 @app.route('/api/agents', methods=['GET'])
 def get_agents():
     """获取所有智能体"""
-    return jsonify(list(agents.values()))
+    return jsonify(db.list_agents())
 
 @app.route('/api/agents', methods=['POST'])
 def create_agent():
@@ -323,6 +351,7 @@ def create_agent():
     }
     
     # 处理上传的文件
+    file_paths = []
     files = request.files.getlist('files')
     if files and files[0].filename:  # 检查是否有文件上传
         # 为这个智能体创建上传目录
@@ -335,66 +364,50 @@ def create_agent():
                 filename = secure_filename(file.filename)
                 file_path = os.path.join(agent_upload_dir, filename)
                 file.save(file_path)
-        
-        # 处理文档并创建向量存储
-        try:
-            # 加载文档
-            documents = rag_core.load_documents(agent_upload_dir)
-            
-            # 分割文档
-            chunks = rag_core.split_documents(documents)
-            
-            # 创建并保存向量存储
-            vector_store_path = os.path.join(VECTOR_STORE_FOLDER, agent_id)
-            rag_core.create_vector_store(chunks, vector_store_path)
-            
-            agent_info['has_knowledge_base'] = True
-        except Exception as e:
-            print(f"处理文档时出错: {e}")
-            agent_info['has_knowledge_base'] = False
-    else:
-        agent_info['has_knowledge_base'] = False
+                file_paths.append(file_path)
     
-    # 保存智能体信息
-    agents[agent_id] = agent_info
-    save_agent(agent_id, agent_info)
+    agent_info['has_knowledge_base'] = False
     
-    # 创建一个新的对话
+    # 保存智能体信息，必须在提交导入任务之前，任务完成时的回调要能找到该智能体
+    db.save_agent(agent_info)
+    router.update_agent(agent_info)
+    
+    # 文档解析和向量化在后台队列中进行，索引写入完成后才标记为有知识库；
+    # 这里只写入任务ID字段，不覆盖任务回调写入的has_knowledge_base
+    if file_paths:
+        vector_store_path = os.path.join(VECTOR_STORE_FOLDER, agent_id)
+        job_id = ingestion_queue.submit(agent_id, vector_store_path, file_paths)
+        agent_info['ingestion_job_id'] = job_id
+        db.update_agent_fields(agent_id, {'ingestion_job_id': job_id})
+    
+    # 创建一个新的对话（QA链延迟加载）
     conv_id = str(uuid.uuid4())
-    conversations[conv_id] = {
-        'qa_chain': None,  # 延迟加载
-        'agent_id': agent_id,
-        'messages': [],
-        'title': f"与 {agent_name} 的对话",
-        'created_at': time.time()
-    }
-    save_conversation(conv_id)
+    db.create_conversation(conv_id, agent_id, f"与 {agent_name} 的对话")
     
     return jsonify({
         'success': True,
         'message': '智能体创建成功',
         'agent': agent_info,
-        'conversation_id': conv_id
+        'conversation_id': conv_id,
+        'job_id': agent_info.get('ingestion_job_id')
     })
 
 @app.route('/api/conversations', methods=['GET'])
 def get_conversations():
     """获取所有对话"""
     result = []
-    for conv_id, conv_data in conversations.items():
-        agent_id = conv_data['agent_id']
-        agent_name = agents.get(agent_id, {}).get('name', '未知智能体')
+    # 按创建时间排序，最新的在前面
+    for conv_data in db.list_conversations():
+        agent_name = conv_data['agent_name'] or '未知智能体'
         
         result.append({
-            'id': conv_id,
-            'title': conv_data.get('title', f"与 {agent_name} 的对话"),
-            'agent_id': agent_id,
+            'id': conv_data['id'],
+            'title': conv_data['title'] or f"与 {agent_name} 的对话",
+            'agent_id': conv_data['agent_id'],
             'agent_name': agent_name,
-            'created_at': conv_data.get('created_at', time.time())
+            'created_at': conv_data['created_at']
         })
     
-    # 按创建时间排序，最新的在前面
-    result.sort(key=lambda x: x['created_at'], reverse=True)
     return jsonify(result)
 
 @app.route('/api/conversations', methods=['POST'])
@@ -403,23 +416,15 @@ def create_conversation():
     data = request.json
     agent_id = data.get('agent_id')
     
-    if not agent_id or agent_id not in agents:
+    agent_info = db.get_agent(agent_id) if agent_id else None
+    if agent_info is None:
         return jsonify({'error': '无效的智能体ID'}), 400
     
-    agent_info = agents[agent_id]
-    
     # 创建新的对话ID
     conv_id = str(uuid.uuid4())
     
-    # 创建对话
-    conversations[conv_id] = {
-        'qa_chain': None,  # 延迟加载
-        'agent_id': agent_id,
-        'messages': [],
-        'title': f"与 {agent_info['name']} 的对话",
-        'created_at': time.time()
-    }
-    save_conversation(conv_id)
+    # 创建对话（QA链延迟加载）
+    db.create_conversation(conv_id, agent_id, f"与 {agent_info['name']} 的对话")
     
     return jsonify({
         'id': conv_id,
@@ -429,27 +434,47 @@ def create_conversation():
 
 @app.route('/api/conversations/<conv_id>', methods=['GET'])
 def get_conversation(conv_id):
-    """获取特定对话的详细信息"""
-    if conv_id not in conversations:
+    """
+    获取特定对话的详细信息和一页消息
+
+    查询参数before（消息下标）和limit用于向前翻页：不带before时返回最新的一页，
+    返回的first_index可作为下一次请求的before。
+    """
+    conv_data = db.get_conversation(conv_id)
+    if conv_data is None:
         return jsonify({'error': '对话不存在'}), 404
     
-    conv_data = conversations[conv_id]
+    message_count = conv_data['message_count']
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', MESSAGE_PAGE_SIZE, type=int)
+    if before is None or before > message_count:
+        before = message_count
+    before = max(0, before)
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    
+    messages = db.get_messages(conv_id, before=before, limit=limit)
+    first_index = before - len(messages)
+    
     agent_id = conv_data['agent_id']
-    agent_info = agents.get(agent_id, {'name': '未知智能体'})
+    agent_info = db.get_agent(agent_id) or {'name': '未知智能体'}
     
     return jsonify({
         'id': conv_id,
-        'title': conv_data.get('title', f"与 {agent_info['name']} 的对话"),
+        'title': conv_data['title'] or f"与 {agent_info['name']} 的对话",
         'agent_id': agent_id,
         'agent_name': agent_info.get('name', '未知智能体'),
-        'messages': conv_data['messages'],
-        'created_at': conv_data.get('created_at', time.time())
+        'messages': messages,
+        'message_count': message_count,
+        'first_index': first_index,
+        'has_more': first_index > 0,
+        'created_at': conv_data['created_at']
     })
 
 @app.route('/api/conversations/<conv_id>/messages', methods=['POST'])
 def send_message(conv_id):
     """发送消息到对话"""
-    if conv_id not in conversations:
+    conv_data = db.get_conversation(conv_id)
+    if conv_data is None:
         return jsonify({'error': '对话不存在'}), 404
     
     # 获取消息内容
@@ -459,9 +484,10 @@ def send_message(conv_id):
     
     user_message = data['message']
     
-    # 获取当前对话的智能体ID
-    agent_id = conversations[conv_id]['agent_id']
-    if agent_id not in agents:
+    # 获取当前对话的智能体
+    agent_id = conv_data['agent_id']
+    current_agent = db.get_agent(agent_id)
+    if current_agent is None:
         return jsonify({'error': '智能体不存在'}), 404
     
     # 获取QA链
@@ -469,51 +495,41 @@ def send_message(conv_id):
     if qa_chain is None:
         return jsonify({'error': '无法加载对话'}), 500
     
-    # 添加用户消息到历史记录
+    # 用户消息与AI回复一起保存
     user_message_data = {
         'role': 'user',
         'content': user_message,
         'timestamp': time.time()
     }
-    conversations[conv_id]['messages'].append(user_message_data)
     
-    # 获取当前智能体信息
-    current_agent = agents[agent_id]
+    # 获取当前智能体类型
     agent_type = current_agent.get('agent_type', 'DEFAULT')
     
-    # 如果是语文老师智能体，检测意图
+    # 专业智能体检测问题是否更适合其他智能体回答
     intent_detected = False
     forwarded_response = None
     
-    if agent_type == "CHINESE_TEACHER":
-        detected_intent = detect_intent(user_message)
+    target_agents = find_consult_agents(user_message, current_agent) if agent_type != 'DEFAULT' else []
+    if target_agents:
+        intent_detected = True
         
-        # 如果检测到数学问题且当前智能体是语文老师
-        if detected_intent == "MATH_TEACHER":
-            intent_detected = True
-            
-            try:
-                # 异步调用需要在异步函数中使用
-                import asyncio
-                forwarded_response = asyncio.run(route_message_to_agent(
-                    user_message, agent_id, "MATH_TEACHER", conv_id
-                ))
-            except Exception as e:
-                print(f"转发消息时出错: {e}")
-                forwarded_response = f"我发现这是一个数学问题，但在尝试咨询数学老师时遇到了问题。"
+        try:
+            forwarded_response = asyncio.run(route_message_to_agent(user_message, target_agents))
+        except Exception as e:
+            print(f"转发消息时出错: {e}")
+        
+        # 咨询全部失败或超时时由当前智能体自己回答
+        if not forwarded_response:
+            intent_detected = False
     
     # 如果没有转发或者转发失败，使用当前智能体回答
     if not intent_detected or not forwarded_response:
         try:
-            # 每隔10轮对话刷新一次上下文，防止长对话中丢失记忆
-            message_count = len(conversations[conv_id]['messages'])
-            if message_count > 0 and message_count % 20 == 0:  # 每20条消息刷新一次
-                print(f"刷新对话 {conv_id} 的上下文，当前消息数: {message_count}")
-                refresh_qa_chain_context(conv_id)
-                qa_chain = get_qa_chain(conv_id)
-
-            response = qa_chain({"question": user_message})
-            ai_response = response["answer"]
+            # 补充记忆中缺少的消息（如之前转发的回答）
+            sync_qa_chain_memory(conv_id, qa_chain, conv_data['message_count'])
+
+            ai_response, stats = streaming.generate_answer(qa_chain, user_message)
+            print(f"对话 {conv_id} 回复完成: 首token {stats['ttft']}秒, {stats['tokens_per_sec']:.1f} tokens/秒")
         except Exception as e:
             print(f"获取回复时出错: {e}")
             return jsonify({'error': f'获取回复失败: {str(e)}'}), 500
@@ -528,10 +544,13 @@ def send_message(conv_id):
         'timestamp': time.time(),
         'forwarded': intent_detected  # 标记是否为转发的回答
     }
-    conversations[conv_id]['messages'].append(ai_message)
     
     # 保存对话
-    save_conversation(conv_id)
+    message_count = db.append_messages(conv_id, [user_message_data, ai_message])
+    summary_worker.schedule(conv_id)
+    if not intent_detected or not forwarded_response:
+        # 这一轮已由QA链写入记忆
+        qa_chains.mark_synced(conv_id, message_count)
     
     return jsonify({
         'success': True,
@@ -541,7 +560,7 @@ def send_message(conv_id):
 @app.route('/api/conversations/<conv_id>/title', methods=['PUT'])
 def update_conversation_title(conv_id):
     """更新对话标题"""
-    if conv_id not in conversations:
+    if db.get_conversation(conv_id) is None:
         return jsonify({'error': '对话不存在'}), 404
     
     data = request.json
@@ -550,35 +569,30 @@ def update_conversation_title(conv_id):
     if not new_title:
         return jsonify({'error': '标题不能为空'}), 400
     
-    conversations[conv_id]['title'] = new_title
-    save_conversation(conv_id)
+    db.update_conversation_title(conv_id, new_title)
     
     return jsonify({'success': True})
 
 @app.route('/api/conversations/<conv_id>', methods=['DELETE'])
 def delete_conversation(conv_id):
     """删除对话"""
-    if conv_id not in conversations:
+    if db.get_conversation(conv_id) is None:
         return jsonify({'error': '对话不存在'}), 404
 
-    # 从内存中删除
-    del conversations[conv_id]
-
-    # 从文件系统中删除
-    conv_path = os.path.join(CONVERSATIONS_FOLDER, conv_id)
-    if os.path.exists(conv_path):
-        try:
-            shutil.rmtree(conv_path)
-        except Exception as e:
-            print(f"删除对话文件夹时出错: {e}")
-            return jsonify({'error': f'删除对话文件失败: {str(e)}'}), 500
+    # 从内存和数据库中删除
+    qa_chains.remove(conv_id)
+    try:
+        db.delete_conversation(conv_id)
+    except Exception as e:
+        print(f"删除对话时出错: {e}")
+        return jsonify({'error': f'删除对话失败: {str(e)}'}), 500
 
     return jsonify({'success': True})
 
 @app.route('/api/conversations/<conv_id>/refresh-context', methods=['POST'])
 def refresh_conversation_context(conv_id):
     """手动刷新对话上下文，重新加载对话历史到AI记忆中"""
-    if conv_id not in conversations:
+    if db.get_conversation(conv_id) is None:
         return jsonify({'error': '对话不存在'}), 404
 
     try:
@@ -587,7 +601,7 @@ def refresh_conversation_context(conv_id):
             return jsonify({
                 'success': True,
                 'message': '对话上下文已刷新',
-                'message_count': len(conversations[conv_id]['messages'])
+                'message_count': db.get_conversation(conv_id)['message_count']
             })
         else:
             return jsonify({'error': '刷新上下文失败'}), 500
@@ -598,18 +612,19 @@ def refresh_conversation_context(conv_id):
 @app.route('/api/conversations/<conv_id>/memory-status', methods=['GET'])
 def get_conversation_memory_status(conv_id):
     """获取对话的记忆状态信息"""
-    if conv_id not in conversations:
+    conv_data = db.get_conversation(conv_id)
+    if conv_data is None:
         return jsonify({'error': '对话不存在'}), 404
 
-    conv_data = conversations[conv_id]
-    qa_chain = conv_data.get('qa_chain')
+    qa_chain = qa_chains.peek(conv_id)
+    agent_info = db.get_agent(conv_data['agent_id']) or {}
 
     memory_info = {
         'conversation_id': conv_id,
-        'total_messages': len(conv_data.get('messages', [])),
+        'total_messages': conv_data['message_count'],
         'qa_chain_loaded': qa_chain is not None,
-        'agent_id': conv_data.get('agent_id'),
-        'agent_name': agents.get(conv_data.get('agent_id'), {}).get('name', '未知智能体')
+        'agent_id': conv_data['agent_id'],
+        'agent_name': agent_info.get('name', '未知智能体')
     }
 
     if qa_chain and hasattr(qa_chain, 'memory'):
@@ -629,6 +644,25 @@ def get_conversation_memory_status(conv_id):
     else:
         memory_info['has_memory'] = False
 
+    memory_info['vector_store_cache'] = vector_store_cache.get_cache().stats()
+    memory_info['chain_pool'] = qa_chains.stats()
+    checkpoint = db.get_summary(conv_id)
+    memory_info['summary_covered_messages'] = checkpoint['covered_index'] if checkpoint else 0
+    memory_info['summary_worker'] = summary_worker.stats()
+    memory_info['agent_router'] = router.stats()
+    memory_info['consult_chain_pool'] = consult_chains.stats()
+    if agent_info:
+        memory_info['context_budget'] = assemble_conversation_context(conv_id, conv_data, agent_info)['report']
+    memory_info['embedding_cache'] = embedding_cache.get_cache().stats()
+    memory_info['tts_cache'] = tts_cache.get_cache().stats()
+    memory_info['stt_pool'] = stt_pool.stats()
+    # 没有配置嵌入服务时不创建嵌入模型，只报告执行器不可用
+    embedding_executor = embedding_cache.get_embeddings().executor if embedding_cache.is_configured() else None
+    if embedding_executor is not None:
+        memory_info['embedding_executor'] = embedding_executor.stats()
+    else:
+        memory_info['embedding_executor'] = {'available': False}
+
     return jsonify(memory_info)
 
 @app.route('/api/speech-to-text', methods=['POST'])
@@ -641,25 +675,18 @@ def process_speech():
     if audio_file.filename == '':
         return jsonify({'error': '没有选择音频文件'}), 400
     
+    # 客户端发送16kHz单声道16位PCM时可以指定format=pcm16，跳过解码
+    audio_format = request.form.get('format')
+    
     try:
-        # 保存上传的音频文件
-        temp_dir = os.path.join(UPLOAD_FOLDER, 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        filename = secure_filename(f"audio_{int(time.time())}.webm")
-        file_path = os.path.join(temp_dir, filename)
-        audio_file.save(file_path)
-        
-        # 使用Whisper模型转换语音为文本
-        text = speech_to_text.transcribe_audio(file_path)
-        
-        # 删除临时文件
-        try:
-            os.remove(file_path)
-        except:
-            pass
+        # 直接在内存中解码上传的音频，不保存文件，在语音识别进程池中识别
+        text = stt_pool.get_pool().transcribe(audio_file.read(), audio_format=audio_format)
         
         return jsonify({'text': text})
+    except stt_pool.STTOverloadedError as e:
+        return jsonify({'error': str(e)}), 503
+    except stt_pool.STTTimeoutError as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         print(f"语音转文本出错: {e}")
         return jsonify({'error': f'处理语音出错: {str(e)}'}), 500
@@ -673,6 +700,8 @@ def synthesize_speech():
     
     if not text:
         return jsonify({'error': '文本不能为空'}), 400
+    if not text_to_speech.is_valid_voice(voice):
+        return jsonify({'error': '不支持的语音'}), 400
     
     try:
         # 使用Edge TTS转换文本为语音
@@ -696,30 +725,26 @@ def synthesize_speech():
 @app.route('/api/conversations/<conv_id>/speak', methods=['POST'])
 def speak_message(conv_id):
     """将最后一条AI消息转换为语音"""
-    if conv_id not in conversations:
+    if db.get_conversation(conv_id) is None:
         return jsonify({'error': '对话不存在'}), 404
     
-    conv_data = conversations[conv_id]
-    messages = conv_data.get('messages', [])
-    
     # 找到最后一条AI消息
-    ai_messages = [msg for msg in messages if msg['role'] == 'assistant']
-    if not ai_messages:
+    last_ai_message = db.get_last_message(conv_id, role='assistant')
+    if last_ai_message is None:
         return jsonify({'error': '没有找到AI消息'}), 404
     
-    last_ai_message = ai_messages[-1]
     text = last_ai_message['content']
     
     try:
         # 使用Edge TTS转换文本为语音
-        audio_data = text_to_speech.text_to_speech_bytes(text)
+        success, result = text_to_speech.text_to_speech_bytes(text)
         
-        if audio_data is None:
-            return jsonify({'error': '生成语音失败'}), 500
+        if not success:
+            return jsonify({'error': f'生成语音失败: {result}'}), 500
         
         # 返回音频数据
         return send_file(
-            io.BytesIO(audio_data),
+            io.BytesIO(result),
             mimetype='audio/mp3',
             as_attachment=True,
             download_name=f"speech_{int(time.time())}.mp3"
@@ -728,10 +753,85 @@ def speak_message(conv_id):
         print(f"文本转语音出错: {e}")
         return jsonify({'error': f'生成语音出错: {str(e)}'}), 500
 
+def synthesize_speech_segment(text, voice="zh-CN-XiaoxiaoNeural"):
+    """合成一段文本的语音，供语音合成流水线使用"""
+    success, result = text_to_speech.text_to_speech_bytes(text, voice)
+    if not success:
+        raise RuntimeError(result)
+    return result
+
+def audio_segment_event(result):
+    """
+    把语音合成流水线的结果转换为发送给客户端的事件
+    
+    Returns:
+        {'type': 'audio', 'seq': 序号, 'text': 文本, 'audio': base64音频（失败时为None），
+         'synthesis_ms': 合成耗时（毫秒）, 'error': 错误信息}
+    """
+    return {
+        'type': 'audio',
+        'seq': result['seq'],
+        'text': result['text'],
+        'audio': base64.b64encode(result['audio']).decode('utf-8') if result['audio'] is not None else None,
+        'synthesis_ms': round(result['synthesis_ms'], 1),
+        'error': result['error']
+    }
+
+@app.route('/api/text-to-speech/stream', methods=['POST'])
+def synthesize_speech_stream():
+    """把整段文本按句子切分并行合成，按顺序以SSE流式返回每一段的音频"""
+    data = request.json
+    text = data.get('text', '').strip()
+    voice = data.get('voice', 'zh-CN-XiaoxiaoNeural')
+    
+    if not text:
+        return jsonify({'error': '文本不能为空'}), 400
+    if not text_to_speech.is_valid_voice(voice):
+        return jsonify({'error': '不支持的语音'}), 400
+    
+    def generate():
+        started_at = time.time()
+        segmenter = tts_pipeline.SentenceSegmenter()
+        pipeline = tts_pipeline.TTSPipeline(lambda segment: synthesize_speech_segment(segment, voice))
+        
+        # 每个请求最多同时合成几个句子（滑动窗口），每交付一段再提交下一段，
+        # 长文本不会占满共享的合成线程池；第一段合成完成后立即发送
+        segments = segmenter.feed(text) + segmenter.flush()
+        remaining = iter(segments)
+        for segment in itertools.islice(remaining, tts_pipeline.TTS_STREAM_WINDOW):
+            pipeline.submit(segment)
+        
+        failed = 0
+        try:
+            for result in pipeline.drain():
+                next_segment = next(remaining, None)
+                if next_segment is not None:
+                    pipeline.submit(next_segment)
+                if result['error'] is not None:
+                    failed += 1
+                yield f"data: {json.dumps(audio_segment_event(result))}\n\n"
+        finally:
+            # 客户端断开（GeneratorExit）时取消窗口中还没有开始的合成，其余句子不再提交
+            pipeline.close()
+        
+        done_data = {
+            'type': 'done',
+            'segments': len(segments),
+            'failed': failed,
+            'seconds': time.time() - started_at
+        }
+        yield f"data: {json.dumps(done_data)}\n\n"
+    
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
 @app.route('/api/conversations/<conv_id>/stream', methods=['POST'])
 def stream_conversation(conv_id):
     """流式处理对话，返回文本和音频流"""
-    if conv_id not in conversations:
+    conv_data = db.get_conversation(conv_id)
+    if conv_data is None:
         return jsonify({'error': '对话不存在'}), 404
     
     data = request.json
@@ -745,86 +845,65 @@ def stream_conversation(conv_id):
     if qa_chain is None:
         return jsonify({'error': '无法加载对话'}), 500
     
-    # 添加用户消息
+    # 补充记忆中缺少的消息
+    sync_qa_chain_memory(conv_id, qa_chain, conv_data['message_count'])
+    
+    # 用户消息在回复完成后与AI回复一起保存
     user_message = {
         'role': 'user',
         'content': message,
         'timestamp': time.time()
     }
-    conversations[conv_id]['messages'].append(user_message)
     
     # 创建生成器函数获取流式响应
     def generate():
+        # 按句子切分回复，语音在后台并行合成，按顺序发送
+        segmenter = tts_pipeline.SentenceSegmenter()
+        pipeline = tts_pipeline.TTSPipeline(synthesize_speech_segment)
         try:
-            # 创建文本累积器和语音合成队列
-            accumulated_text = ""
-            tts_queue = []
-            last_tts_time = time.time()
-            
-            # 初始化Edge TTS
-            tts = text_to_speech.TextToSpeech()
+            done_event = None
             
-            # 获取流式AI回复
-            for chunk in stream_llm_response(qa_chain, message):
-                if chunk:
-                    # 累积文本
-                    accumulated_text += chunk
-                    
-                    # 当累积足够的文本或等待足够长时间时，生成语音
-                    current_time = time.time()
-                    if (len(accumulated_text) > 10 and "。" in accumulated_text) or \
-                       (len(accumulated_text) > 20) or \
-                       (current_time - last_tts_time > 2 and len(accumulated_text) > 5):
-                        
-                        # 生成语音
-                        audio_data = asyncio.run(tts.text_to_speech_bytes_async(accumulated_text))
-                        
-                        # 发送文本和音频
-                        response_data = {
-                            'type': 'content',
-                            'text': accumulated_text,
-                            'audio': base64.b64encode(audio_data).decode('utf-8')
-                        }
-                        yield f"data: {json.dumps(response_data)}\n\n"
-                        
-                        # 重置累积文本和时间
-                        accumulated_text = ""
-                        last_tts_time = current_time
-                    
-                    # 如果没有累积足够文本，只发送文本更新
-                    elif chunk:
-                        response_data = {
-                            'type': 'partial',
-                            'text': chunk
-                        }
-                        yield f"data: {json.dumps(response_data)}\n\n"
-            
-            # 处理剩余的文本
-            if accumulated_text:
-                audio_data = asyncio.run(tts.text_to_speech_bytes_async(accumulated_text))
-                response_data = {
-                    'type': 'content',
-                    'text': accumulated_text,
-                    'audio': base64.b64encode(audio_data).decode('utf-8')
-                }
-                yield f"data: {json.dumps(response_data)}\n\n"
+            # 获取流式AI回复，每个token生成后立即发送，不等待语音合成
+            for event in streaming.stream_answer(qa_chain, message):
+                if event['type'] == 'done':
+                    done_event = event
+                    continue
+                
+                chunk = event['text']
+                yield f"data: {json.dumps({'type': 'partial', 'text': chunk})}\n\n"
+                
+                for segment in segmenter.feed(chunk):
+                    pipeline.submit(segment)
+                for result in pipeline.ready():
+                    yield f"data: {json.dumps(audio_segment_event(result))}\n\n"
             
-            # 添加完成标记
-            full_response = accumulated_text  # 最终完整响应
+            # 处理剩余的文本，等待还在合成的语音
+            for segment in segmenter.flush():
+                pipeline.submit(segment)
+            for result in pipeline.drain():
+                yield f"data: {json.dumps(audio_segment_event(result))}\n\n"
             
-            # 添加AI回复到对话历史
+            # 添加完整的AI回复到对话历史
             ai_message = {
                 'role': 'assistant',
-                'content': full_response,
+                'content': done_event['answer'],
                 'timestamp': time.time()
             }
-            conversations[conv_id]['messages'].append(ai_message)
             
-            # 保存对话
-            save_conversation(conv_id)
+            # 保存对话，这一轮已由QA链写入记忆
+            message_count = db.append_messages(conv_id, [user_message, ai_message])
+            qa_chains.mark_synced(conv_id, message_count)
+            summary_worker.schedule(conv_id)
             
-            # 发送完成信号
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
+            # 发送完成信号，附带首token延迟和生成速度
+            done_data = {
+                'type': 'done',
+                'ttft': done_event['ttft'],
+                'tokens': done_event['tokens'],
+                'tokens_per_sec': done_event['tokens_per_sec'],
+                'seconds': done_event['seconds']
+            }
+            yield f"data: {json.dumps(done_data)}\n\n"
             
         except Exception as e:
             print(f"流式处理出错: {e}")
@@ -834,9 +913,9 @@ def stream_conversation(conv_id):
                 'error': str(e)
             }
             yield f"data: {json.dumps(error_data)}\n\n"
-            
-            # 如果出错，回滚用户消息
-            conversations[conv_id]['messages'].pop()
+        finally:
+            # 客户端断开或出错时取消还没有开始的合成
+            pipeline.close()
     
     # 返回流式响应
     return Response(stream_with_context(generate()), 
@@ -844,32 +923,6 @@ def stream_conversation(conv_id):
                     headers={'Cache-Control': 'no-cache',
                              'X-Accel-Buffering': 'no'})
 
-def stream_llm_response(qa_chain, question):
-    """流式获取LLM响应"""
-    try:
-        # 实际发送问题并获取流式响应
-        _, streaming_handler = qa_chain
-        
-        # 以非阻塞方式启动回答生成
-        # 这里需要根据你的LLM接口调整
-        import threading
-        
-        def generate_response():
-            qa_chain.invoke({"question": question})
-        
-        # 在后台线程中启动生成
-        thread = threading.Thread(target=generate_response)
-        thread.start()
-        
-        # 从流式处理器中获取tokens
-        for token in streaming_handler.get_tokens():
-            if token:
-                yield token
-        
-    except Exception as e:
-        print(f"流式LLM响应出错: {e}")
-        yield ""
-
 # 添加WebSocket路由用于流式语音识别和回复
 @socketio.on('connect')
 def handle_connect():
@@ -878,6 +931,11 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     print('客户端已断开连接')
+    
+    # 放弃未结束的语音识别会话
+    transcription = active_transcriptions.pop(request.sid, None)
+    if transcription is not None and transcription['recognizer'] is not None:
+        transcription['recognizer'].close()
 
 # 用于存储进行中的语音识别任务
 active_transcriptions = {}
@@ -888,13 +946,22 @@ def start_voice_stream(data):
     session_id = request.sid
     conv_id = data.get('conversation_id')
     
-    if not conv_id or conv_id not in conversations:
+    if not conv_id or db.get_conversation(conv_id) is None:
         emit('error', {'message': '对话ID无效'})
         return
     
+    previous = active_transcriptions.pop(session_id, None)
+    if previous is not None and previous['recognizer'] is not None:
+        previous['recognizer'].close()
+    
     active_transcriptions[session_id] = {
         'conversation_id': conv_id,
-        'audio_chunks': []
+        # 收到第一段音频、确定格式后创建流式识别器
+        'recognizer': None,
+        # 客户端支持二进制音频帧时，回复的语音也以二进制帧发送
+        'binary_audio': bool(data.get('binary_audio')),
+        'audio_format': data.get('audio_format', 'webm'),
+        'last_seq': None
     }
     
     emit('voice_stream_started', {'status': 'ready'})
@@ -907,195 +974,300 @@ def handle_voice_data(data):
         emit('error', {'message': '未找到有效的语音流会话'})
         return
     
-    audio_chunk = data.get('audio_chunk')
-    if not audio_chunk:
-        return
-    
-    # 将base64编码的音频数据转换为二进制
-    audio_binary = base64.b64decode(audio_chunk.split(',')[1] if ',' in audio_chunk else audio_chunk)
-    
-    active_transcriptions[session_id]['audio_chunks'].append(audio_binary)
-    
-    # 每收到一定量的音频数据，进行一次实时转写
-    if len(active_transcriptions[session_id]['audio_chunks']) >= 3:  # 调整这个值以平衡响应速度和准确性
-        threading.Thread(target=process_audio_chunk, args=(session_id,)).start()
-
-def process_audio_chunk(session_id):
-    """处理积累的音频数据块，进行实时转写"""
-    if session_id not in active_transcriptions:
-        return
-        
-    # 复制当前数据块然后清空，允许继续接收新数据
-    audio_chunks = active_transcriptions[session_id]['audio_chunks'].copy()
-    active_transcriptions[session_id]['audio_chunks'] = []
-    
-    # 合并音频数据
-    from io import BytesIO
-    combined_audio = BytesIO()
-    for chunk in audio_chunks:
-        combined_audio.write(chunk)
-    combined_audio.seek(0)
-    
+    transcription = active_transcriptions[session_id]
+    if isinstance(data, (bytes, bytearray)):
+        # 二进制音频帧
+        try:
+            audio_format, seq, audio_binary = audio_frames.unpack_frame(data)
+        except ValueError as e:
+            emit('error', {'message': f'音频帧无效: {e}'})
+            return
+        # 忽略重复发送的帧
+        if transcription['last_seq'] is not None and seq <= transcription['last_seq']:
+            return
+        transcription['last_seq'] = seq
+        transcription['audio_format'] = audio_format
+    else:
+        # 兼容旧客户端：base64编码的字符串
+        audio_chunk = data.get('audio_chunk')
+        if not audio_chunk:
+            return
+        audio_binary = audio_frames.decode_legacy_chunk(audio_chunk)
+    
+    # 音频片段依次送入会话的解码器，解码后的PCM保存在识别器的缓冲区中
+    if transcription['recognizer'] is None:
+        transcription['recognizer'] = streaming_stt.StreamingRecognizer(transcription['audio_format'])
+    recognizer = transcription['recognizer']
+    recognizer.feed(audio_binary)
+    
+    # 积累了足够的新音频时进行一次实时转写
+    if recognizer.should_update():
+        threading.Thread(target=process_audio_chunk, args=(session_id, recognizer)).start()
+
+def process_audio_chunk(session_id, recognizer):
+    """识别会话中尚未确认的音频，发送部分转写结果"""
     try:
-        # 使用Whisper进行流式语音识别
-        partial_text = speech_to_text.transcribe_audio(combined_audio.read())
+        partial = recognizer.update()
+        if partial is None:
+            return
         
-        # 发送部分转写结果给客户端
-        socketio.emit('partial_transcript', {'text': partial_text}, room=session_id)
+        # 发送部分转写结果给客户端，committed部分不会再改变
+        socketio.emit('partial_transcript', {
+            'text': partial['committed'] + partial['tentative'],
+            'committed': partial['committed'],
+            'tentative': partial['tentative']
+        }, room=session_id)
     except Exception as e:
+        # 语音识别繁忙时放弃这一次部分结果
         print(f"流式语音识别出错: {e}")
 
 @socketio.on('end_voice_stream')
 def end_voice_stream(data):
-    """结束语音流并处理完整的语音"""
+    """结束语音流，只识别最后尚未确认的音频"""
     session_id = request.sid
-    if session_id not in active_transcriptions:
+    transcription = active_transcriptions.pop(session_id, None)
+    if transcription is None:
         emit('error', {'message': '未找到有效的语音流会话'})
         return
     
-    # 合并所有音频数据
-    audio_chunks = active_transcriptions[session_id]['audio_chunks']
-    conv_id = active_transcriptions[session_id]['conversation_id']
+    conv_id = transcription['conversation_id']
+    binary_audio = transcription['binary_audio']
+    recognizer = transcription['recognizer']
     
-    if not audio_chunks:
-        del active_transcriptions[session_id]
+    if recognizer is None:
         emit('voice_stream_ended', {'status': 'empty'})
         return
     
-    # 合并音频数据
-    from io import BytesIO
-    combined_audio = BytesIO()
-    for chunk in audio_chunks:
-        combined_audio.write(chunk)
-    combined_audio.seek(0)
-    
     try:
-        # 使用Whisper进行完整语音识别
-        final_text = speech_to_text.transcribe_audio(combined_audio.read())
+        final_text = recognizer.finish()
         
         # 发送最终转写结果给客户端
         emit('final_transcript', {'text': final_text})
         
         # 如果有识别结果，处理用户消息并生成回复
-        if final_text and conv_id in conversations:
+        if final_text and db.get_conversation(conv_id) is not None:
             threading.Thread(target=process_message_and_stream_reply, 
-                            args=(final_text, conv_id, session_id)).start()
+                            args=(final_text, conv_id, session_id, binary_audio)).start()
     except Exception as e:
         print(f"处理完整语音出错: {e}")
+        recognizer.close()
         emit('error', {'message': f'处理语音出错: {str(e)}'})
-    
-    # 清理资源
-    del active_transcriptions[session_id]
 
-def process_message_and_stream_reply(message, conv_id, session_id):
-    """处理用户消息并流式返回AI回复"""
-    if not message or conv_id not in conversations:
+def process_message_and_stream_reply(message, conv_id, session_id, binary_audio=False):
+    """
+    处理用户消息并流式返回AI回复
+    
+    Args:
+        message: 用户消息
+        conv_id: 对话ID
+        session_id: Socket.IO会话ID
+        binary_audio: 为True时语音以二进制音频帧（audio_frame事件）发送，否则以base64的data URL（audio_chunk事件）发送
+    """
+    conv_data = db.get_conversation(conv_id) if message else None
+    if conv_data is None:
         return
 
-    # 检查是否需要刷新上下文
-    message_count = len(conversations[conv_id]['messages'])
-    if message_count > 0 and message_count % 20 == 0:
-        print(f"流式处理中刷新对话 {conv_id} 的上下文，当前消息数: {message_count}")
-        refresh_qa_chain_context(conv_id)
-
     # 获取QA链
     qa_chain = get_qa_chain(conv_id)
     if qa_chain is None:
         socketio.emit('error', {'message': '无法加载对话'}, room=session_id)
         return
 
-    # 添加用户消息
+    # 补充记忆中缺少的消息
+    sync_qa_chain_memory(conv_id, qa_chain, conv_data['message_count'])
+
+    # 用户消息在回复完成后与AI回复一起保存
     user_message = {
         'role': 'user',
         'content': message,
         'timestamp': time.time()
     }
-    conversations[conv_id]['messages'].append(user_message)
     
+    segmenter = tts_pipeline.SentenceSegmenter()
+    pipeline = tts_pipeline.TTSPipeline(synthesize_speech_segment)
     try:
-        # 生成的回复文本
-        full_response = ""
+        done_event = None
         
-        # 获取模型的流式回复
-        for chunk in qa_chain.stream({"question": message}):
-            if "answer" in chunk:
-                # 发送部分回复给客户端
-                response_chunk = chunk["answer"]
-                full_response += response_chunk
-                socketio.emit('partial_response', {'text': response_chunk}, room=session_id)
-                
-                # 使用asyncio处理TTS的异步调用
-                if len(response_chunk.strip()) > 0 and response_chunk.strip()[-1] in '.!?。！？':
-                    # 当句子结束时，生成并发送语音片段
-                    tts_thread = threading.Thread(target=stream_tts_for_chunk, 
-                                              args=(response_chunk, session_id))
-                    tts_thread.start()
+        def emit_audio(results):
+            for result in results:
+                info = {
+                    'seq': result['seq'],
+                    'text': result['text'],
+                    'synthesis_ms': round(result['synthesis_ms'], 1),
+                    'error': result['error']
+                }
+                if binary_audio:
+                    # 合成失败的段落发送空的音频帧，客户端按序号跳过
+                    frame = audio_frames.pack_frame(result['audio'] or b'', 'mp3', result['seq'])
+                    socketio.emit('audio_frame', (frame, info), room=session_id)
+                else:
+                    if result['audio'] is not None:
+                        info['audio_data'] = audio_frames.encode_legacy_chunk(result['audio'], 'mp3')
+                    socketio.emit('audio_chunk', info, room=session_id)
+        
+        # 获取模型的流式回复，语音按句子在后台并行合成并按顺序发送
+        for event in streaming.stream_answer(qa_chain, message):
+            if event['type'] == 'done':
+                done_event = event
+                continue
+            
+            response_chunk = event['text']
+            socketio.emit('partial_response', {'text': response_chunk}, room=session_id)
+            
+            for segment in segmenter.feed(response_chunk):
+                pipeline.submit(segment)
+            emit_audio(pipeline.ready())
+        
+        for segment in segmenter.flush():
+            pipeline.submit(segment)
+        emit_audio(pipeline.drain())
         
         # 添加AI回复到对话历史
         ai_message = {
             'role': 'assistant',
-            'content': full_response,
+            'content': done_event['answer'],
             'timestamp': time.time()
         }
-        conversations[conv_id]['messages'].append(ai_message)
         
-        # 保存对话
-        save_conversation(conv_id)
+        # 保存对话，这一轮已由QA链写入记忆
+        message_count = db.append_messages(conv_id, [user_message, ai_message])
+        qa_chains.mark_synced(conv_id, message_count)
+        summary_worker.schedule(conv_id)
         
         # 发送完成信号
         socketio.emit('response_complete', {'message_id': str(uuid.uuid4())}, room=session_id)
     
     except Exception as e:
         print(f"处理消息时出错: {e}")
-        # 如果出错，回滚用户消息
-        conversations[conv_id]['messages'].pop()
         socketio.emit('error', {'message': f'处理消息时出错: {str(e)}'}, room=session_id)
-
-def stream_tts_for_chunk(text_chunk, session_id):
-    """为文本块生成语音并流式发送"""
-    try:
-        # 生成语音
-        audio_data = text_to_speech.text_to_speech_bytes(text_chunk)
-        
-        if audio_data:
-            # 将二进制音频数据转换为base64编码
-            audio_b64 = base64.b64encode(audio_data).decode('utf-8')
-            
-            # 发送语音数据给客户端
-            socketio.emit('audio_chunk', {
-                'audio_data': f'data:audio/mp3;base64,{audio_b64}'
-            }, room=session_id)
-    except Exception as e:
-        print(f"生成语音出错: {e}")
+    finally:
+        # 出错时取消还没有开始的合成
+        pipeline.close()
 
 @app.route('/api/agents/<agent_id>', methods=['GET'])
 def get_agent(agent_id):
     """获取特定智能体的详细信息"""
-    if agent_id not in agents:
+    agent_info = db.get_agent(agent_id)
+    if agent_info is None:
+        return jsonify({'error': '智能体不存在'}), 404
+    
+    return jsonify(agent_info)
+
+@app.route('/api/agents/<agent_id>/documents', methods=['GET'])
+def list_agent_documents(agent_id):
+    """获取智能体知识库中的文件列表"""
+    if db.get_agent(agent_id) is None:
+        return jsonify({'error': '智能体不存在'}), 404
+    
+    vector_store_path = os.path.join(VECTOR_STORE_FOLDER, agent_id)
+    try:
+        manifest = knowledge_base.load_manifest(vector_store_path)
+    except Exception as e:
+        print(f"读取知识库文件列表时出错: {e}")
+        return jsonify({'error': f'读取知识库失败: {str(e)}'}), 500
+    
+    return jsonify([
+        {'filename': filename, 'chunks': len(chunk_ids)}
+        for filename, chunk_ids in sorted(manifest.items())
+    ])
+
+@app.route('/api/agents/<agent_id>/documents', methods=['POST'])
+def add_agent_documents(agent_id):
+    """向智能体的知识库增量添加文件，只对新文件进行嵌入"""
+    agent_info = db.get_agent(agent_id)
+    if agent_info is None:
+        return jsonify({'error': '智能体不存在'}), 404
+    
+    files = request.files.getlist('files')
+    if not files or not files[0].filename:
+        return jsonify({'error': '没有上传文件'}), 400
+    
+    agent_upload_dir = os.path.join(UPLOAD_FOLDER, agent_id)
+    os.makedirs(agent_upload_dir, exist_ok=True)
+    
+    file_paths = []
+    for file in files:
+        if file and allowed_file(file.filename):
+            filename = secure_filename(file.filename)
+            file_path = os.path.join(agent_upload_dir, filename)
+            file.save(file_path)
+            file_paths.append(file_path)
+    
+    if not file_paths:
+        return jsonify({'error': '没有支持的文件类型'}), 400
+    
+    vector_store_path = os.path.join(VECTOR_STORE_FOLDER, agent_id)
+    job_id = ingestion_queue.submit(agent_id, vector_store_path, file_paths)
+    
+    # 只更新任务ID字段，任务可能已经完成并写入了has_knowledge_base
+    db.update_agent_fields(agent_id, {'ingestion_job_id': job_id})
+    
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'files': [os.path.basename(path) for path in file_paths]
+    }), 202
+
+@app.route('/api/ingestion-jobs/<job_id>', methods=['GET'])
+def get_ingestion_job(job_id):
+    """获取知识库导入任务的进度，包括每个文件的处理阶段和文档块数量"""
+    job = ingestion_queue.get_job(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job)
+
+@app.route('/api/agents/<agent_id>/documents/<filename>', methods=['DELETE'])
+def remove_agent_document(agent_id, filename):
+    """从智能体的知识库中删除一个文件"""
+    if db.get_agent(agent_id) is None:
+        return jsonify({'error': '智能体不存在'}), 404
+    
+    filename = secure_filename(filename)
+    try:
+        vector_store_path = os.path.join(VECTOR_STORE_FOLDER, agent_id)
+        found, vector_store = knowledge_base.remove_document(
+            vector_store_path, filename,
+            on_commit=lambda new_store: swap_agent_vector_store(agent_id, new_store)
+        )
+        if not found:
+            return jsonify({'error': '知识库中没有该文件'}), 404
+    except Exception as e:
+        print(f"删除知识库文件时出错: {e}")
+        return jsonify({'error': f'删除文件失败: {str(e)}'}), 500
+    
+    # 删除上传的原始文件
+    file_path = os.path.join(UPLOAD_FOLDER, agent_id, filename)
+    if os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except Exception as e:
+            print(f"删除上传文件时出错: {e}")
+    
+    agent_info = db.update_agent_fields(agent_id, {'has_knowledge_base': vector_store is not None})
+    if agent_info is None:
         return jsonify({'error': '智能体不存在'}), 404
+    router.update_agent(agent_info)
     
-    return jsonify(agents[agent_id])
+    return jsonify({'success': True, 'agent': agent_info})
 
 @app.route('/api/agents/<agent_id>', methods=['DELETE'])
 def delete_agent(agent_id):
     """删除智能体及其相关资源"""
-    if agent_id not in agents:
+    agent_info = db.get_agent(agent_id)  # 保存用于返回
+    if agent_info is None:
         return jsonify({'error': '智能体不存在'}), 404
     
     try:
-        # 1. 删除与该智能体相关的对话
-        related_conv_ids = []
-        for conv_id, conv_data in list(conversations.items()):
-            if conv_data['agent_id'] == agent_id:
-                related_conv_ids.append(conv_id)
+        # 1. 从数据库中删除智能体及其相关的对话和消息
+        related_conv_ids = db.delete_agent(agent_id)
+        router.remove_agent(agent_id)
+        consult_chains.remove(agent_id)
         
-        # 删除关联的对话
         for conv_id in related_conv_ids:
             # 从内存中删除
-            if conv_id in conversations:
-                del conversations[conv_id]
+            qa_chains.remove(conv_id)
             
-            # 从文件系统中删除
+            # 删除迁移前遗留的对话文件夹
             conv_path = os.path.join(CONVERSATIONS_FOLDER, conv_id)
             if os.path.exists(conv_path):
                 try:
@@ -1112,6 +1284,7 @@ def delete_agent(agent_id):
                 print(f"删除智能体上传文件夹时出错: {e}")
         
         # 3. 删除智能体的向量存储
+        vector_store_cache.get_cache().invalidate(agent_id)
         vector_store_path = os.path.join(VECTOR_STORE_FOLDER, agent_id)
         if os.path.exists(vector_store_path):
             try:
@@ -1119,7 +1292,7 @@ def delete_agent(agent_id):
             except Exception as e:
                 print(f"删除智能体向量存储时出错: {e}")
         
-        # 4. 删除智能体文件夹
+        # 4. 删除迁移前遗留的智能体文件夹
         agent_path = os.path.join(AGENTS_FOLDER, agent_id)
         if os.path.exists(agent_path):
             try:
@@ -1127,10 +1300,6 @@ def delete_agent(agent_id):
             except Exception as e:
                 print(f"删除智能体文件夹时出错: {e}")
         
-        # 5. 从内存中删除
-        agent_info = agents[agent_id]  # 保存用于返回
-        del agents[agent_id]
-        
         return jsonify({
             'success': True,
             'message': '智能体删除成功',
@@ -1144,9 +1313,41 @@ def delete_agent(agent_id):
 
 # --- 初始化 ---
 
-# 加载已保存的智能体和对话
-load_agents()
-load_conversations()
+def init_services():
+    """
+    创建数据库连接、后台任务和路由器，只在服务进程中调用一次
+
+    用python run.py或python app.py启动时自动调用；由其他WSGI服务器加载时需要先调用本函数。
+    """
+    global db, ingestion_queue, summary_worker, router
+    if db is not None:
+        return
+
+    db = storage.get_storage()
+
+    # 首次启动时把旧版文件夹中的智能体和对话导入数据库
+    db.migrate_from_folders(AGENTS_FOLDER, CONVERSATIONS_FOLDER)
+
+    ingestion_queue = ingestion_jobs.IngestionQueue(on_ingestion_committed)
+
+    # 长对话的滚动摘要在后台生成，请求中不等待摘要
+    summary_worker = conversation_summary.SummaryWorker(db)
+
+    # 按嵌入相似度在智能体之间转发问题，智能体画像在后台线程中预先计算，算好之前不路由
+    # 嵌入模型在第一次计算画像时才创建，没有配置API密钥时服务照常启动
+    router = agent_router.AgentRouter(
+        lambda text: embedding_cache.get_embeddings().embed_query(text),
+        lambda agent_id: knowledge_base.load_centroid(os.path.join(VECTOR_STORE_FOLDER, agent_id))
+    )
+    router.set_agents(db.list_agents())
+
+    # 上下文预算使用的分词器只从本地加载，请求中不会下载
+    context_budget.load_tokenizer()
+
+def main():
+    """初始化服务并启动Web服务器"""
+    init_services()
+    socketio.run(app, debug=True, port=5001, allow_unsafe_werkzeug=True)
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True, port=5001, allow_unsafe_werkzeug=True) 
\ No newline at end of file
+    main() 
\ No newline at end of file
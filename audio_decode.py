@@ -0,0 +1,94 @@
+"""
+音频解码模块 - 在内存中把音频数据解码为Whisper需要的16kHz单声道float32数组，不写临时文件
+
+优先使用PyAV（进程内解码），未安装时通过管道调用ffmpeg；16kHz的16位PCM直接转换，不经过解码。
+"""
+
+import threading
+import subprocess
+from io import BytesIO
+import numpy as np
+
+# Whisper使用的采样率
+SAMPLE_RATE = 16000
+
+try:
+    import av
+except ImportError:
+    av = None
+
+_fallback_logged = False
+_fallback_lock = threading.Lock()
+
+
+def _log_fallback_once(reason):
+    """第一次改用ffmpeg管道时输出日志，之后不再重复"""
+    global _fallback_logged
+    with _fallback_lock:
+        if _fallback_logged:
+            return
+        _fallback_logged = True
+    print(f"{reason}，音频解码改用ffmpeg管道（之后不再提示）")
+
+
+def pcm16_to_float32(data):
+    """
+    把16位小端PCM转换为float32数组
+
+    Args:
+        data: PCM数据
+
+    Returns:
+        取值在[-1, 1)之间的float32数组
+    """
+    # 丢弃不完整的最后一个采样
+    usable = len(data) - len(data) % 2
+    return np.frombuffer(data[:usable], dtype="<i2").astype(np.float32) / 32768.0
+
+def _decode_with_av(data):
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+    chunks = []
+    with av.open(BytesIO(data), mode="r") as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+        # 取出重采样器中剩余的数据
+        for resampled in resampler.resample(None):
+            chunks.append(resampled.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks).astype(np.float32) / 32768.0
+
+def _decode_with_ffmpeg(data):
+    command = [
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-threads", "0",
+        "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE),
+        "pipe:1"
+    ]
+    process = subprocess.run(command, input=data, capture_output=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg解码失败: {process.stderr.decode('utf-8', errors='ignore').strip()}")
+    return pcm16_to_float32(process.stdout)
+
+def decode_audio(data, audio_format=None):
+    """
+    把音频数据解码为16kHz单声道float32数组
+
+    Args:
+        data: 音频二进制数据
+        audio_format: 音频格式，为'pcm16'时表示已经是16kHz单声道16位PCM，直接转换
+
+    Returns:
+        float32数组
+    """
+    if audio_format == 'pcm16':
+        return pcm16_to_float32(data)
+    if av is None:
+        _log_fallback_once("未安装PyAV")
+    else:
+        try:
+            return _decode_with_av(data)
+        except Exception as e:
+            _log_fallback_once(f"PyAV解码失败: {e}")
+    return _decode_with_ffmpeg(data)
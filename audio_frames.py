@@ -0,0 +1,85 @@
+"""
+音频帧模块 - 通过Socket.IO二进制消息收发音频，每帧带一个小的类型化头部（版本、格式、序号）
+
+帧结构（网络字节序）:
+    版本(1字节) | 格式(1字节) | 序号(4字节) | 音频数据
+"""
+
+import struct
+import base64
+
+AUDIO_FRAME_VERSION = 1
+AUDIO_FRAME_HEADER = struct.Struct("!BBI")
+
+# 格式编号与名称
+AUDIO_FORMATS = {
+    0: 'webm',
+    1: 'mp3',
+    2: 'pcm16',  # 16kHz单声道16位小端PCM
+    3: 'wav',
+    4: 'ogg'
+}
+AUDIO_FORMAT_IDS = {name: format_id for format_id, name in AUDIO_FORMATS.items()}
+
+MIME_TYPES = {
+    'webm': 'audio/webm',
+    'mp3': 'audio/mp3',
+    'wav': 'audio/wav',
+    'ogg': 'audio/ogg'
+}
+
+
+def pack_frame(payload, audio_format, seq):
+    """
+    打包音频帧
+
+    Args:
+        payload: 音频数据
+        audio_format: 格式名称，见AUDIO_FORMATS
+        seq: 序号
+
+    Returns:
+        帧的二进制数据
+    """
+    header = AUDIO_FRAME_HEADER.pack(AUDIO_FRAME_VERSION, AUDIO_FORMAT_IDS[audio_format], seq & 0xFFFFFFFF)
+    return header + payload
+
+def unpack_frame(frame):
+    """
+    解析音频帧
+
+    Args:
+        frame: 帧的二进制数据
+
+    Returns:
+        (格式名称, 序号, 音频数据)
+
+    Raises:
+        ValueError: 帧过短、版本不支持或格式未知
+    """
+    if len(frame) < AUDIO_FRAME_HEADER.size:
+        raise ValueError("音频帧长度不足")
+    version, format_id, seq = AUDIO_FRAME_HEADER.unpack_from(frame)
+    if version != AUDIO_FRAME_VERSION:
+        raise ValueError(f"不支持的音频帧版本: {version}")
+    if format_id not in AUDIO_FORMATS:
+        raise ValueError(f"未知的音频格式: {format_id}")
+    return AUDIO_FORMATS[format_id], seq, bytes(memoryview(frame)[AUDIO_FRAME_HEADER.size:])
+
+def decode_legacy_chunk(audio_chunk):
+    """
+    解析旧客户端发送的base64字符串（可以带data URL前缀）
+
+    Returns:
+        音频数据
+    """
+    return base64.b64decode(audio_chunk.split(',')[1] if ',' in audio_chunk else audio_chunk)
+
+def encode_legacy_chunk(payload, audio_format):
+    """
+    把音频数据编码为旧客户端使用的data URL
+
+    Returns:
+        data URL字符串
+    """
+    return f"data:{MIME_TYPES.get(audio_format, 'application/octet-stream')};base64,{base64.b64encode(payload).decode('utf-8')}"
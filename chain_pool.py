@@ -0,0 +1,185 @@
+"""
+QA链池模块 - 限制内存中保留的对话QA链数量，淘汰最久未使用和长时间空闲的链
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# 池中最多保留的QA链数量
+CHAIN_POOL_MAX_SIZE = int(os.getenv("CHAIN_POOL_MAX_SIZE", "64"))
+# QA链空闲多久（秒）后被淘汰
+CHAIN_POOL_IDLE_TTL = float(os.getenv("CHAIN_POOL_IDLE_TTL", "1800"))
+
+
+class _PoolEntry:
+    """池条目"""
+
+    __slots__ = ('agent_id', 'chain', 'synced_count', 'last_used')
+
+    def __init__(self, agent_id, chain, synced_count):
+        self.agent_id = agent_id
+        self.chain = chain
+        self.synced_count = synced_count  # 链的记忆已包含的持久化消息数
+        self.last_used = time.monotonic()
+
+
+class ChainPool:
+    """
+    按对话ID保存QA链
+
+    超出容量时淘汰最久未使用的链，空闲超过idle_ttl的链由后台线程定期淘汰。
+    被淘汰的链不做任何持久化，下次使用时由调用方根据保存的对话历史重建。
+    """
+
+    def __init__(self, max_size=CHAIN_POOL_MAX_SIZE, idle_ttl=CHAIN_POOL_IDLE_TTL):
+        """
+        Args:
+            max_size: 最多保留的QA链数量
+            idle_ttl: 空闲淘汰时间（秒），小于等于0表示不按空闲时间淘汰
+        """
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()  # {conv_id: _PoolEntry}，末尾为最近使用
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+        self.hits = 0
+        self.misses = 0
+        self.lru_evictions = 0
+        self.idle_evictions = 0
+
+    def get(self, conv_id):
+        """
+        获取对话的QA链
+
+        Returns:
+            QA链，不在池中（或已空闲过期）时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(conv_id)
+            if entry is None or self._is_idle(entry, time.monotonic()):
+                if entry is not None:
+                    del self._entries[conv_id]
+                    self.idle_evictions += 1
+                self.misses += 1
+                return None
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(conv_id)
+            self.hits += 1
+            return entry.chain
+
+    def peek(self, conv_id):
+        """获取对话的QA链但不更新使用时间和统计，用于状态查询"""
+        with self._lock:
+            entry = self._entries.get(conv_id)
+            return entry.chain if entry is not None else None
+
+    def put(self, conv_id, agent_id, chain, synced_count=0):
+        """
+        放入（或替换）对话的QA链，超出容量时淘汰最久未使用的链
+
+        Args:
+            conv_id: 对话ID
+            agent_id: 对话所属的智能体ID
+            chain: QA链
+            synced_count: 创建链时记忆已包含的持久化消息数
+        """
+        with self._lock:
+            self._entries.pop(conv_id, None)
+            self._entries[conv_id] = _PoolEntry(agent_id, chain, synced_count)
+            while len(self._entries) > self.max_size:
+                evicted_id, _ = self._entries.popitem(last=False)
+                self.lru_evictions += 1
+                print(f"QA链池已满，淘汰对话 {evicted_id} 的QA链")
+            self._ensure_sweeper()
+
+    def get_synced_count(self, conv_id):
+        """获取QA链记忆已包含的持久化消息数，链不在池中时返回None"""
+        with self._lock:
+            entry = self._entries.get(conv_id)
+            return entry.synced_count if entry is not None else None
+
+    def mark_synced(self, conv_id, synced_count):
+        """记录QA链记忆已包含的持久化消息数（只会增加）"""
+        with self._lock:
+            entry = self._entries.get(conv_id)
+            if entry is not None and synced_count > entry.synced_count:
+                entry.synced_count = synced_count
+
+    def remove(self, conv_id):
+        """移除对话的QA链，返回是否存在"""
+        with self._lock:
+            return self._entries.pop(conv_id, None) is not None
+
+    def chains_for_agent(self, agent_id):
+        """
+        获取某个智能体的所有QA链
+
+        Returns:
+            [(对话ID, QA链)]
+        """
+        with self._lock:
+            return [(conv_id, entry.chain) for conv_id, entry in self._entries.items()
+                    if entry.agent_id == agent_id]
+
+    def evict_idle(self):
+        """
+        淘汰空闲超时的QA链
+
+        Returns:
+            淘汰的数量
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle_ids = [conv_id for conv_id, entry in self._entries.items() if self._is_idle(entry, now)]
+            for conv_id in idle_ids:
+                del self._entries[conv_id]
+            self.idle_evictions += len(idle_ids)
+        if idle_ids:
+            print(f"淘汰了 {len(idle_ids)} 个空闲的QA链")
+        return len(idle_ids)
+
+    def stats(self):
+        """获取QA链池统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'idle_ttl': self.idle_ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'lru_evictions': self.lru_evictions,
+                'idle_evictions': self.idle_evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    # --- 内部方法（调用方需持有self._lock） ---
+
+    def _is_idle(self, entry, now):
+        return self.idle_ttl > 0 and now - entry.last_used > self.idle_ttl
+
+    def _ensure_sweeper(self):
+        if self._sweeper is None and self.idle_ttl > 0:
+            self._sweeper = threading.Thread(target=self._sweep, daemon=True)
+            self._sweeper.start()
+
+    def _sweep(self):
+        # 检查间隔取空闲时间的一半，链最多在过期后半个周期内被淘汰
+        interval = max(1.0, self.idle_ttl / 2)
+        while True:
+            time.sleep(interval)
+            self.evict_idle()
+
+
+# 单例模式，整个进程共享一个QA链池
+_instance = None
+
+def get_pool():
+    """获取ChainPool实例（单例模式）"""
+    global _instance
+    if _instance is None:
+        _instance = ChainPool()
+    return _instance
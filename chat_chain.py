@@ -0,0 +1,115 @@
+"""
+纯对话链模块 - 为没有知识库的智能体提供不经过嵌入和检索的对话链
+"""
+
+import os
+from typing import Optional
+from langchain.chains import LLMChain
+from langchain.memory import ConversationBufferWindowMemory
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_ollama import ChatOllama
+import context_budget
+
+# 本地Ollama模型配置
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen2.5:3b")
+OLLAMA_TEMPERATURE = float(os.getenv("OLLAMA_TEMPERATURE", "0.7"))
+
+# 记忆中保留的对话轮数（一问一答为一轮）
+MEMORY_WINDOW_TURNS = 10
+
+_llm = None
+
+def get_llm():
+    """获取共享的LLM客户端（单例模式）"""
+    global _llm
+    if _llm is None:
+        _llm = ChatOllama(model=OLLAMA_MODEL, temperature=OLLAMA_TEMPERATURE)
+    return _llm
+
+class TokenBudgetWindowMemory(ConversationBufferWindowMemory):
+    """在轮数窗口之外再按token预算裁剪历史，单条超长消息不会撑大每一轮的提示词"""
+
+    max_token_limit: Optional[int] = None
+
+    @property
+    def buffer_as_messages(self):
+        messages = super().buffer_as_messages
+        if self.max_token_limit is None:
+            return messages
+        selected, _ = context_budget.select_recent_messages(messages, self.max_token_limit)
+        return selected
+
+def create_chat_memory(conversation_history=None, max_history_tokens=None):
+    """
+    创建对话记忆并恢复历史消息
+
+    Args:
+        conversation_history: 对话历史消息列表，格式与messages.json一致
+        max_history_tokens: 每轮放入提示词的历史消息token上限，None表示只按轮数限制
+
+    Returns:
+        对话记忆对象
+    """
+    memory = TokenBudgetWindowMemory(
+        max_token_limit=max_history_tokens,
+        k=MEMORY_WINDOW_TURNS,
+        memory_key="chat_history",
+        input_key="question",
+        output_key="answer",
+        return_messages=True
+    )
+
+    append_to_memory(memory, conversation_history or [])
+    return memory
+
+def append_to_memory(memory, messages):
+    """
+    把消息追加到已有的对话记忆中，不重建记忆对象
+
+    窗口记忆只保留窗口内会用到的消息，避免长对话中记忆无限增长。
+
+    Args:
+        memory: 对话记忆对象（带chat_memory属性）
+        messages: 要追加的消息列表，格式与messages.json一致
+    """
+    window = getattr(memory, 'k', None)
+    if window is not None:
+        messages = messages[-window * 2:]
+
+    for message in messages:
+        if message.get('role') == 'user':
+            memory.chat_memory.add_user_message(message['content'])
+        elif message.get('role') == 'assistant':
+            memory.chat_memory.add_ai_message(message['content'])
+
+    if window is not None and len(memory.chat_memory.messages) > window * 2:
+        del memory.chat_memory.messages[:-window * 2]
+
+def create_chat_chain_with_context(role_prompt, conversation_history=None, max_history_tokens=None):
+    """
+    创建不带检索的对话链，调用方式与rag_core.create_enhanced_qa_chain_with_context一致：
+    chain({"question": ...})返回包含"answer"的字典
+
+    Args:
+        role_prompt: 智能体的角色设定
+        conversation_history: 对话历史消息列表
+        max_history_tokens: 每轮放入提示词的历史消息token上限
+
+    Returns:
+        (对话链, None)，第二项对应检索链的流式处理器，纯对话链不需要
+    """
+    # 角色设定中的花括号需要转义，否则会被当作模板变量
+    system_prompt = (role_prompt or "你是一个有用的AI助手。").replace("{", "{{").replace("}", "}}")
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("human", "{question}")
+    ])
+
+    chain = LLMChain(
+        llm=get_llm(),
+        prompt=prompt,
+        memory=create_chat_memory(conversation_history, max_history_tokens),
+        output_key="answer"
+    )
+    return chain, None
@@ -0,0 +1,219 @@
+"""
+上下文预算模块 - 按token数而不是消息条数组装提示词上下文
+
+按优先级依次放入角色设定、对话摘要、检索到的文档片段和最近的对话，
+超出预算的部分被截断或丢弃，并报告每一部分占用的token数。
+"""
+
+import os
+import threading
+
+# 提示词上下文的token预算（不含用户本轮的问题）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# 有知识库时为每轮检索到的文档片段预留的token数
+CONTEXT_RETRIEVAL_RESERVE_TOKENS = int(os.getenv("CONTEXT_RETRIEVAL_RESERVE_TOKENS", "1000"))
+# 与本地模型（qwen2.5:3b）对应的分词器：本地目录或已下载到缓存中的模型名，不会在运行时下载；
+# 为空、transformers不可用或本地没有该分词器时使用估算
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "Qwen/Qwen2.5-3B-Instruct")
+# 每条消息的格式开销（角色标记、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def load_tokenizer(name_or_path=CONTEXT_TOKENIZER):
+    """
+    在服务启动时加载分词器，只使用本地文件，失败时继续使用估算
+
+    Args:
+        name_or_path: 分词器的本地目录或缓存中的模型名
+
+    Returns:
+        是否加载成功
+    """
+    global _tokenizer
+    if not name_or_path:
+        print("没有配置分词器，上下文预算使用估算的token数")
+        return False
+    with _tokenizer_lock:
+        if _tokenizer is not None:
+            return True
+        try:
+            from transformers import AutoTokenizer
+            _tokenizer = AutoTokenizer.from_pretrained(name_or_path, local_files_only=True)
+            print(f"已加载分词器 {name_or_path} 用于上下文预算")
+            return True
+        except ImportError:
+            print("未安装transformers，上下文预算使用估算的token数")
+        except Exception as e:
+            print(f"本地没有可用的分词器 {name_or_path}，上下文预算使用估算的token数: {e}")
+    return False
+
+def _get_tokenizer():
+    """已加载的分词器，没有加载时返回None（使用估算）；请求中不会触发加载"""
+    return _tokenizer
+
+def tokenizer_name():
+    """当前使用的分词器名称"""
+    return CONTEXT_TOKENIZER if _get_tokenizer() is not None else "heuristic"
+
+def _estimate_char_tokens(char):
+    # 中日韩字符大约每个字一个token，其他字符大约四个一个token
+    return 1.0 if ord(char) >= 0x2E80 else 0.25
+
+def count_tokens(text):
+    """
+    计算文本的token数
+
+    Args:
+        text: 文本
+
+    Returns:
+        token数
+    """
+    if not text:
+        return 0
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    return int(sum(_estimate_char_tokens(char) for char in text) + 0.999)
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    把文本截断到不超过max_tokens个token
+
+    Returns:
+        截断后的文本
+    """
+    if max_tokens <= 0:
+        return ""
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        token_ids = tokenizer.encode(text, add_special_tokens=False)
+        if len(token_ids) <= max_tokens:
+            return text
+        return tokenizer.decode(token_ids[:max_tokens])
+
+    used = 0.0
+    for index, char in enumerate(text):
+        used += _estimate_char_tokens(char)
+        if used > max_tokens:
+            return text[:index]
+    return text
+
+def _message_content(message):
+    # 同时支持messages.json格式的字典和LangChain的消息对象
+    if isinstance(message, dict):
+        return message.get('content', '')
+    return getattr(message, 'content', '')
+
+def _document_content(document):
+    return document if isinstance(document, str) else getattr(document, 'page_content', '')
+
+def message_tokens(message):
+    """计算一条消息的token数（含格式开销）"""
+    return count_tokens(_message_content(message)) + MESSAGE_OVERHEAD_TOKENS
+
+def select_recent_messages(messages, max_tokens):
+    """
+    从最新的消息开始往前选取，直到用完预算，保证选中的消息是连续的最近消息
+
+    Args:
+        messages: 按时间排序的消息列表（字典或LangChain消息对象）
+        max_tokens: token预算
+
+    Returns:
+        (选中的消息列表（按时间排序）, 占用的token数)
+    """
+    selected = []
+    used = 0
+    for message in reversed(messages):
+        tokens = message_tokens(message)
+        if used + tokens > max_tokens:
+            break
+        selected.append(message)
+        used += tokens
+    selected.reverse()
+    return selected, used
+
+def assemble_context(role_prompt, summary=None, documents=None, messages=None,
+                     budget=CONTEXT_TOKEN_BUDGET, reserve_tokens=0):
+    """
+    按优先级在token预算内组装上下文：角色设定 > 对话摘要 > 检索片段 > 最近对话
+
+    角色设定和摘要超出剩余预算时被截断；检索片段按排序依次放入，放不下的被丢弃；
+    最近对话从最新的一条往前放入，直到预算用完。
+
+    Args:
+        role_prompt: 角色设定
+        summary: 较早对话的摘要
+        documents: 检索到的文档片段（字符串或Document），按相关度排序
+        messages: 最近的对话消息，按时间排序
+        budget: 总token预算
+        reserve_tokens: 在放入最近对话之前额外预留的token数（例如留给每轮检索的片段）
+
+    Returns:
+        {'role_prompt', 'summary', 'documents', 'messages', 'history_tokens', 'report'}，
+        history_tokens为最近对话可用的预算，report为每一部分的token统计
+    """
+    remaining = budget
+
+    role_tokens = count_tokens(role_prompt)
+    role_truncated = role_tokens > remaining
+    if role_truncated:
+        role_prompt = truncate_to_tokens(role_prompt, remaining)
+        role_tokens = count_tokens(role_prompt)
+    remaining -= role_tokens
+
+    summary_tokens = 0
+    summary_truncated = False
+    if summary:
+        summary_tokens = count_tokens(summary)
+        if summary_tokens > remaining:
+            summary_truncated = True
+            summary = truncate_to_tokens(summary, remaining)
+            summary_tokens = count_tokens(summary)
+        remaining -= summary_tokens
+
+    selected_documents = []
+    document_tokens = 0
+    for document in documents or []:
+        tokens = count_tokens(_document_content(document))
+        if tokens <= remaining:
+            selected_documents.append(document)
+            document_tokens += tokens
+            remaining -= tokens
+
+    history_tokens = max(0, remaining - reserve_tokens)
+    selected_messages, message_tokens_used = select_recent_messages(messages or [], history_tokens)
+
+    report = {
+        'budget': budget,
+        'tokenizer': tokenizer_name(),
+        'total_tokens': role_tokens + summary_tokens + document_tokens + message_tokens_used,
+        'reserved_tokens': reserve_tokens,
+        'sections': {
+            'role': {'tokens': role_tokens, 'truncated': role_truncated},
+            'summary': {'tokens': summary_tokens, 'truncated': summary_truncated},
+            'documents': {
+                'tokens': document_tokens,
+                'included': len(selected_documents),
+                'dropped': len(documents or []) - len(selected_documents)
+            },
+            'messages': {
+                'tokens': message_tokens_used,
+                'included': len(selected_messages),
+                'dropped': len(messages or []) - len(selected_messages)
+            }
+        }
+    }
+
+    return {
+        'role_prompt': role_prompt,
+        'summary': summary,
+        'documents': selected_documents,
+        'messages': selected_messages,
+        'history_tokens': history_tokens,
+        'report': report
+    }
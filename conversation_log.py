@@ -0,0 +1,49 @@
+"""
+对话日志模块 - 读取旧版文件夹布局中保存的对话消息（JSONL日志或更早的messages.json），
+只在迁移到SQLite时使用
+"""
+
+import os
+import json
+
+MESSAGES_LOG_FILENAME = 'messages.jsonl'
+LEGACY_MESSAGES_FILENAME = 'messages.json'
+
+
+def has_messages(conv_path):
+    """对话目录中是否有消息记录（JSONL日志或旧版JSON）"""
+    return (os.path.exists(os.path.join(conv_path, MESSAGES_LOG_FILENAME)) or
+            os.path.exists(os.path.join(conv_path, LEGACY_MESSAGES_FILENAME)))
+
+def read_messages(conv_path):
+    """
+    读取对话的全部消息，不修改对话目录中的文件
+
+    如果上次写入时进程崩溃，日志中不完整或损坏的行会被跳过。
+
+    Args:
+        conv_path: 对话目录
+
+    Returns:
+        消息列表
+    """
+    log_path = os.path.join(conv_path, MESSAGES_LOG_FILENAME)
+    if not os.path.exists(log_path):
+        legacy_path = os.path.join(conv_path, LEGACY_MESSAGES_FILENAME)
+        if os.path.exists(legacy_path):
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return []
+
+    with open(log_path, 'rb') as f:
+        lines = f.readlines()
+
+    messages = []
+    for index, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            messages.append(json.loads(line.decode('utf-8')))
+        except (UnicodeDecodeError, ValueError):
+            print(f"对话日志 {log_path} 第 {index + 1} 行不完整或已损坏，已跳过")
+    return messages
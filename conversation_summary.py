@@ -0,0 +1,128 @@
+"""
+对话摘要模块 - 在后台线程中为长对话生成滚动摘要，并把摘要检查点持久化
+"""
+
+import os
+import queue
+import threading
+import chat_chain
+
+# 最近的多少条消息不做摘要（这些消息会原样放进对话记忆）
+SUMMARY_KEEP_RECENT_MESSAGES = chat_chain.MEMORY_WINDOW_TURNS * 2
+# 至少积累多少条未摘要的消息才进行一次摘要
+SUMMARY_MIN_NEW_MESSAGES = int(os.getenv("SUMMARY_MIN_NEW_MESSAGES", "10"))
+# 单次摘要调用最多处理的消息数，落后较多时分多次完成
+SUMMARY_MAX_MESSAGES_PER_CALL = int(os.getenv("SUMMARY_MAX_MESSAGES_PER_CALL", "40"))
+
+SUMMARY_PROMPT = """请把下面的对话内容与已有摘要合并，生成一份新的简明摘要。
+摘要需要保留用户的身份、目标、偏好，以及讨论过的关键问题和结论，不超过300字。
+
+已有摘要：
+{summary}
+
+新的对话内容：
+{dialogue}
+
+新的摘要："""
+
+
+def summarize(previous_summary, messages):
+    """
+    把新的消息合并到已有摘要中
+
+    Args:
+        previous_summary: 已有的摘要，没有时为空字符串
+        messages: 需要合并的消息列表
+
+    Returns:
+        新的摘要
+    """
+    role_names = {'user': '用户', 'assistant': '助手'}
+    dialogue = "\n".join(
+        f"{role_names.get(message.get('role'), message.get('role'))}: {message.get('content', '')}"
+        for message in messages
+    )
+    prompt = SUMMARY_PROMPT.format(summary=previous_summary or "（无）", dialogue=dialogue)
+    response = chat_chain.get_llm().invoke(prompt)
+    return getattr(response, 'content', response).strip()
+
+
+class SummaryWorker:
+    """
+    后台摘要线程
+
+    对话每完成一轮后调用schedule()，摘要在后台线程中生成，
+    用户的请求不会等待任何摘要调用。
+    """
+
+    def __init__(self, db):
+        """
+        Args:
+            db: storage.Storage实例
+        """
+        self.db = db
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+        self.summarized_messages = 0
+        self.summary_calls = 0
+        self.failures = 0
+
+    def schedule(self, conv_id):
+        """
+        安排对对话进行一次摘要检查，同一对话排队中时不会重复加入
+
+        Args:
+            conv_id: 对话ID
+        """
+        with self._lock:
+            if conv_id in self._pending:
+                return
+            self._pending.add(conv_id)
+        self._queue.put(conv_id)
+
+    def stats(self):
+        """获取摘要统计信息"""
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'summary_calls': self.summary_calls,
+                'summarized_messages': self.summarized_messages,
+                'failures': self.failures
+            }
+
+    def _run(self):
+        while True:
+            conv_id = self._queue.get()
+            with self._lock:
+                self._pending.discard(conv_id)
+            try:
+                self._summarize_conversation(conv_id)
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                print(f"生成对话 {conv_id} 的摘要时出错: {e}")
+
+    def _summarize_conversation(self, conv_id):
+        conv_data = self.db.get_conversation(conv_id)
+        if conv_data is None:
+            return
+
+        checkpoint = self.db.get_summary(conv_id) or {'summary': '', 'covered_index': 0}
+        summary = checkpoint['summary']
+        covered_index = checkpoint['covered_index']
+        target_index = conv_data['message_count'] - SUMMARY_KEEP_RECENT_MESSAGES
+
+        while target_index - covered_index >= SUMMARY_MIN_NEW_MESSAGES:
+            end_index = min(target_index, covered_index + SUMMARY_MAX_MESSAGES_PER_CALL)
+            messages = self.db.get_messages(conv_id, before=end_index, limit=end_index - covered_index)
+            summary = summarize(summary, messages)
+            covered_index = end_index
+            self.db.save_summary(conv_id, summary, covered_index)
+            with self._lock:
+                self.summary_calls += 1
+                self.summarized_messages += len(messages)
+            print(f"对话 {conv_id} 的摘要已更新，覆盖前 {covered_index} 条消息")
@@ -0,0 +1,245 @@
+"""
+嵌入缓存模块 - 按(模型名, 文本哈希)持久化缓存文本向量，避免重复调用嵌入API
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from array import array
+from langchain_core.embeddings import Embeddings
+
+# 缓存配置
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-v1")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join("embedding_cache", "embeddings.sqlite3"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))
+
+
+def text_hash(text):
+    """计算文本内容的哈希值"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """基于SQLite的嵌入向量缓存，超出容量时淘汰最久未访问的条目"""
+
+    def __init__(self, db_path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        """
+        初始化缓存
+
+        Args:
+            db_path: SQLite数据库文件路径
+            max_entries: 最多缓存的向量条数
+        """
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)")
+        self._conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, model, texts):
+        """
+        批量查询缓存
+
+        Args:
+            model: 模型名称（查询向量和文档向量应使用不同的名称）
+            texts: 文本列表
+
+        Returns:
+            与texts等长的列表，命中为向量(list[float])，未命中为None
+        """
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            unique_hashes = list(set(hashes))
+            # SQLite对参数个数有限制，分批查询
+            for start in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model] + batch
+                ).fetchall()
+                for row_hash, blob in rows:
+                    vector = array('f')
+                    vector.frombytes(blob)
+                    found[row_hash] = vector.tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, row_hash) for row_hash in found]
+                )
+                self._conn.commit()
+
+            results = [found.get(h) for h in hashes]
+            hit_count = sum(1 for r in results if r is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+
+    def put_many(self, model, texts, vectors):
+        """
+        批量写入缓存
+
+        Args:
+            model: 模型名称
+            texts: 文本列表
+            vectors: 与texts对应的向量列表
+        """
+        now = time.time()
+        rows = [
+            (model, text_hash(text), array('f', vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_access) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._evict_if_needed()
+            self._conn.commit()
+
+    def stats(self):
+        """获取缓存统计信息"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    def _evict_if_needed(self):
+        """淘汰最久未访问的条目（调用方需持有self._lock）"""
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # 一次多淘汰10%，避免每次写入都触发淘汰
+        to_evict = count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_access LIMIT ?)",
+            (to_evict,)
+        )
+        self.evictions += to_evict
+
+
+class CachedEmbeddings(Embeddings):
+    """为任意LangChain嵌入模型加上持久化缓存，文档和查询都会先查缓存"""
+
+    def __init__(self, embeddings, cache, model_name=EMBEDDING_MODEL, executor=None):
+        """
+        Args:
+            embeddings: 实际调用API的嵌入模型
+            cache: EmbeddingCache实例
+            model_name: 模型名称，作为缓存键的一部分
+            executor: 可选的EmbeddingExecutor，用于批量并发嵌入未命中的文档
+        """
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+        self.executor = executor
+
+    def embed_documents(self, texts):
+        """嵌入文档，只有缓存未命中的文本才会调用API"""
+        model = f"{self.model_name}:document"
+        results = self.cache.get_many(model, texts)
+
+        # 同一批次中重复的文本只嵌入一次
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, results) if vector is None))
+        if missing:
+            if self.executor is not None:
+                # 每个批次完成后立即写入缓存，中途失败时重新执行只需嵌入剩余部分
+                vectors = self.executor.embed(
+                    missing,
+                    on_batch_done=lambda texts, batch_vectors: self.cache.put_many(model, texts, batch_vectors)
+                )
+            else:
+                vectors = self.embeddings.embed_documents(missing)
+                self.cache.put_many(model, missing, vectors)
+            computed = dict(zip(missing, vectors))
+            results = [vector if vector is not None else computed[text] for text, vector in zip(texts, results)]
+
+        return results
+
+    def embed_query(self, text):
+        """嵌入查询文本（DashScope对查询和文档使用不同的text_type，因此单独缓存）"""
+        model = f"{self.model_name}:query"
+        vector = self.cache.get_many(model, [text])[0]
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put_many(model, [text], [vector])
+        return vector
+
+
+# 单例模式，整个进程共享一个缓存连接
+_cache = None
+_embeddings = None
+
+def get_cache():
+    """获取EmbeddingCache实例（单例模式）"""
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache()
+    return _cache
+
+def is_configured():
+    """是否设置了DashScope API密钥（没有设置时嵌入、检索和嵌入路由都不可用）"""
+    return bool(os.getenv("DASHSCOPE_API_KEY"))
+
+def get_embeddings():
+    """
+    获取带缓存的DashScope嵌入模型（单例模式）
+
+    文档嵌入经过EmbeddingExecutor批量并发执行，重试由执行器按批次负责。
+    设置环境变量DASHSCOPE_HTTP_BASE_URL可以把请求指向本地的替身服务进行测试。
+
+    Raises:
+        RuntimeError: 没有设置环境变量DASHSCOPE_API_KEY
+    """
+    global _embeddings
+    if _embeddings is None:
+        from langchain_community.embeddings import DashScopeEmbeddings
+        from embedding_executor import EmbeddingExecutor
+
+        if not is_configured():
+            raise RuntimeError("未设置环境变量DASHSCOPE_API_KEY，无法使用DashScope嵌入模型")
+        dashscope_embeddings = DashScopeEmbeddings(
+            model=EMBEDDING_MODEL,
+            dashscope_api_key=os.getenv("DASHSCOPE_API_KEY"),
+            max_retries=1
+        )
+        _embeddings = CachedEmbeddings(
+            dashscope_embeddings,
+            get_cache(),
+            executor=EmbeddingExecutor(dashscope_embeddings.embed_documents)
+        )
+    return _embeddings
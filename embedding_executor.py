@@ -0,0 +1,200 @@
+"""
+嵌入执行器模块 - 把文本打包成批次并发调用嵌入API，带令牌桶限流和按批次重试
+"""
+
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 执行器配置（DashScope text-embedding-v1单次请求最多25条文本）
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "25"))
+EMBEDDING_BATCH_MAX_CHARS = int(os.getenv("EMBEDDING_BATCH_MAX_CHARS", "40000"))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+EMBEDDING_REQUESTS_PER_SECOND = float(os.getenv("EMBEDDING_REQUESTS_PER_SECOND", "10"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "5"))
+
+
+class EmbeddingBatchError(Exception):
+    """部分批次在重试后仍然失败"""
+
+    def __init__(self, failed_batches, total_batches, last_error):
+        super().__init__(f"{failed_batches}/{total_batches} 个嵌入批次失败: {last_error}")
+        self.failed_batches = failed_batches
+        self.total_batches = total_batches
+        self.last_error = last_error
+
+
+class TokenBucket:
+    """令牌桶限流器，限制每秒发出的请求数"""
+
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate: 每秒补充的令牌数
+            capacity: 桶容量，即允许的突发请求数，默认与rate相同
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """获取一个令牌，桶空时阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def pack_batches(texts, max_batch_size=EMBEDDING_BATCH_SIZE, max_batch_chars=EMBEDDING_BATCH_MAX_CHARS):
+    """
+    按条数和总字符数把文本打包成批次，保持原有顺序
+
+    Returns:
+        [(起始下标, 文本列表)]
+    """
+    batches = []
+    start = 0
+    current = []
+    current_chars = 0
+    for index, text in enumerate(texts):
+        if current and (len(current) >= max_batch_size or current_chars + len(text) > max_batch_chars):
+            batches.append((start, current))
+            start = index
+            current = []
+            current_chars = 0
+        current.append(text)
+        current_chars += len(text)
+    if current:
+        batches.append((start, current))
+    return batches
+
+
+class EmbeddingExecutor:
+    """并发执行嵌入批次，单个批次失败时只重试该批次"""
+
+    def __init__(self, embed_batch, max_batch_size=EMBEDDING_BATCH_SIZE,
+                 max_batch_chars=EMBEDDING_BATCH_MAX_CHARS, max_concurrency=EMBEDDING_CONCURRENCY,
+                 requests_per_second=EMBEDDING_REQUESTS_PER_SECOND, max_retries=EMBEDDING_MAX_RETRIES,
+                 backoff_base=1.0, backoff_max=30.0):
+        """
+        Args:
+            embed_batch: 嵌入一个批次的函数，接收文本列表，返回向量列表
+            max_batch_size: 每批最多文本条数
+            max_batch_chars: 每批最多字符数
+            max_concurrency: 同时进行的请求数
+            requests_per_second: 每秒最多发出的请求数
+            max_retries: 单个批次最多重试次数
+            backoff_base: 指数退避的基础等待秒数
+            backoff_max: 单次退避的最长等待秒数
+        """
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_batch_chars = max_batch_chars
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._limiter = TokenBucket(requests_per_second)
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="embedding")
+        self._lock = threading.Lock()
+
+        self.total_chunks = 0
+        self.total_batches = 0
+        self.total_retries = 0
+        self.failed_batches = 0
+        self.last_run = None
+
+    def embed(self, texts, on_batch_done=None):
+        """
+        嵌入所有文本
+
+        Args:
+            texts: 文本列表
+            on_batch_done: 每个批次成功后的回调，参数为(文本列表, 向量列表)。
+                调用方可在这里持久化结果，失败后重新执行时即可从中断处继续
+
+        Returns:
+            与texts等长的向量列表
+
+        Raises:
+            EmbeddingBatchError: 有批次在重试后仍然失败（成功的批次已经通过回调交付）
+        """
+        started_at = time.monotonic()
+        batches = pack_batches(texts, self.max_batch_size, self.max_batch_chars)
+        futures = [(start, batch, self._pool.submit(self._run_batch, batch)) for start, batch in batches]
+
+        results = [None] * len(texts)
+        embedded = 0
+        failed = 0
+        last_error = None
+        for start, batch, future in futures:
+            try:
+                vectors = future.result()
+            except Exception as e:
+                failed += 1
+                last_error = e
+                continue
+            results[start:start + len(batch)] = vectors
+            embedded += len(batch)
+            if on_batch_done is not None:
+                on_batch_done(batch, vectors)
+
+        elapsed = time.monotonic() - started_at
+        with self._lock:
+            self.total_chunks += embedded
+            self.total_batches += len(batches)
+            self.failed_batches += failed
+            self.last_run = {
+                'chunks': embedded,
+                'batches': len(batches),
+                'failed_batches': failed,
+                'seconds': elapsed,
+                'chunks_per_sec': embedded / elapsed if elapsed > 0 else 0.0
+            }
+        print(f"嵌入完成: {embedded} 个文本块, {len(batches)} 个批次, "
+              f"{self.last_run['chunks_per_sec']:.1f} 块/秒")
+
+        if failed:
+            raise EmbeddingBatchError(failed, len(batches), last_error)
+        return results
+
+    def stats(self):
+        """获取执行器统计信息"""
+        with self._lock:
+            return {
+                'total_chunks': self.total_chunks,
+                'total_batches': self.total_batches,
+                'total_retries': self.total_retries,
+                'failed_batches': self.failed_batches,
+                'last_run': self.last_run
+            }
+
+    def _run_batch(self, batch):
+        attempt = 0
+        while True:
+            self._limiter.acquire()
+            try:
+                vectors = self.embed_batch(batch)
+                if len(vectors) != len(batch):
+                    raise ValueError(f"嵌入结果数量 {len(vectors)} 与批次大小 {len(batch)} 不一致")
+                return vectors
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    print(f"嵌入批次在 {attempt} 次重试后仍然失败: {e}")
+                    raise
+                delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+                delay += random.uniform(0, delay / 2)
+                attempt += 1
+                with self._lock:
+                    self.total_retries += 1
+                print(f"嵌入批次失败，{delay:.1f} 秒后第 {attempt} 次重试: {e}")
+                time.sleep(delay)
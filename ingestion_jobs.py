@@ -0,0 +1,214 @@
+"""
+知识库导入任务模块 - 在后台队列中处理文档导入，文件解析在进程池中并行执行
+"""
+
+import os
+import time
+import uuid
+import queue
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import knowledge_base
+
+# 并行解析文档的进程数
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", str(os.cpu_count() or 2)))
+# 内存中保留的已结束任务数量
+MAX_FINISHED_JOBS = 200
+# 解析结果的暂存目录
+SPOOL_DIR = os.path.join(tempfile.gettempdir(), "ingestion_spool")
+
+
+class IngestionQueue:
+    """
+    知识库导入队列
+
+    任务按提交顺序由一个后台线程依次处理：先在进程池中并行地逐页解析和分割文件，
+    文档块写入磁盘上的暂存文件；再从暂存文件中按批次读出、嵌入并写入向量存储，
+    整个过程的内存占用只与批次大小有关。写入完成后调用on_commit通知调用方。
+    """
+
+    def __init__(self, on_commit, max_workers=INGESTION_WORKERS):
+        """
+        Args:
+            on_commit: 索引写入完成后的回调，参数为(agent_id, vector_store)，调用时持有该知识库的更新锁
+            max_workers: 解析文档的进程数
+        """
+        self.on_commit = on_commit
+        self.max_workers = max_workers
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()  # {job_id: job}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._worker = None  # 第一次提交任务时才启动，只导入模块或创建队列不会启动线程
+
+    def submit(self, agent_id, vector_store_path, file_paths):
+        """
+        提交导入任务
+
+        Args:
+            agent_id: 智能体ID
+            vector_store_path: 向量存储目录
+            file_paths: 要导入的文件路径列表
+
+        Returns:
+            任务ID
+        """
+        job_id = str(uuid.uuid4())
+        job = {
+            'id': job_id,
+            'agent_id': agent_id,
+            'vector_store_path': vector_store_path,
+            'status': 'queued',
+            'error': None,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'files': OrderedDict(
+                (os.path.basename(path), {'path': path, 'stage': 'queued', 'chunks': 0, 'indexed': 0, 'error': None})
+                for path in file_paths
+            )
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        self._queue.put(job_id)
+        return job_id
+
+    def get_job(self, job_id):
+        """
+        获取任务状态
+
+        Returns:
+            任务状态字典，任务不存在时返回None
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {
+                'id': job['id'],
+                'agent_id': job['agent_id'],
+                'status': job['status'],
+                'error': job['error'],
+                'created_at': job['created_at'],
+                'started_at': job['started_at'],
+                'finished_at': job['finished_at'],
+                'total_chunks': sum(f['chunks'] for f in job['files'].values()),
+                'indexed_chunks': sum(f['indexed'] for f in job['files'].values()),
+                'files': [
+                    {'filename': name, 'stage': f['stage'], 'chunks': f['chunks'],
+                     'indexed': f['indexed'], 'error': f['error']}
+                    for name, f in job['files'].items()
+                ]
+            }
+
+    def _get_executor(self):
+        if self._executor is None:
+            # 使用spawn启动子进程，避免在多线程的服务进程中fork
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._executor
+
+    def _set_file_stage(self, job, filename, stage, chunks=None, error=None):
+        with self._lock:
+            file_state = job['files'][filename]
+            file_state['stage'] = stage
+            if chunks is not None:
+                file_state['chunks'] = chunks
+            if error is not None:
+                file_state['error'] = error
+
+    def _set_file_indexed(self, job, filename, indexed):
+        with self._lock:
+            job['files'][filename]['indexed'] = indexed
+
+    def _finish(self, job, status, error=None):
+        with self._lock:
+            job['status'] = status
+            job['error'] = error
+            job['finished_at'] = time.time()
+            # 只保留最近的已结束任务
+            finished = [job_id for job_id, j in self._jobs.items() if j['finished_at'] is not None]
+            for job_id in finished[:-MAX_FINISHED_JOBS]:
+                del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            try:
+                self._process(job)
+            except Exception as e:
+                print(f"知识库导入任务 {job_id} 出错: {e}")
+                self._finish(job, 'failed', str(e))
+
+    def _process(self, job):
+        spool_dir = os.path.join(SPOOL_DIR, job['id'])
+        os.makedirs(spool_dir, exist_ok=True)
+        try:
+            self._process_files(job, spool_dir)
+        finally:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+    def _process_files(self, job, spool_dir):
+        with self._lock:
+            job['status'] = 'parsing'
+            job['started_at'] = time.time()
+
+        # 1. 在进程池中并行解析和分割文件，文档块写入暂存文件
+        executor = self._get_executor()
+        futures = {}
+        for index, (filename, file_state) in enumerate(job['files'].items()):
+            self._set_file_stage(job, filename, 'parsing')
+            spool_path = os.path.join(spool_dir, f"{index}.jsonl")
+            future = executor.submit(knowledge_base.spool_file_chunks, file_state['path'], spool_path)
+            futures[future] = (filename, spool_path)
+
+        spooled_files = OrderedDict()
+        for future in as_completed(futures):
+            filename, spool_path = futures[future]
+            try:
+                chunk_count = future.result()
+                self._set_file_stage(job, filename, 'parsed', chunks=chunk_count)
+                if chunk_count:
+                    spooled_files[filename] = spool_path
+            except Exception as e:
+                print(f"解析文件 {filename} 时出错: {e}")
+                self._set_file_stage(job, filename, 'failed', error=str(e))
+
+        if not spooled_files:
+            self._finish(job, 'failed', '没有可以索引的文档内容')
+            return
+
+        # 2. 按批次从暂存文件读出文档块，嵌入并写入向量存储
+        with self._lock:
+            job['status'] = 'indexing'
+        for filename in spooled_files:
+            self._set_file_stage(job, filename, 'indexing')
+
+        file_chunks = OrderedDict(
+            (filename, knowledge_base.iter_spooled_chunks(spool_path))
+            for filename, spool_path in spooled_files.items()
+        )
+        # 3. 索引写入完成后通知调用方，回调时仍持有该知识库的更新锁
+        knowledge_base.add_file_chunks(
+            job['vector_store_path'],
+            file_chunks,
+            on_progress=lambda filename, indexed: self._set_file_indexed(job, filename, indexed),
+            on_commit=lambda vector_store: self.on_commit(job['agent_id'], vector_store)
+        )
+
+        for filename in spooled_files:
+            self._set_file_stage(job, filename, 'done')
+        self._finish(job, 'completed')
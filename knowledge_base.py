@@ -0,0 +1,358 @@
+"""
+知识库模块 - 创建、加载和增量更新智能体的FAISS向量存储，嵌入统一经过持久化缓存
+"""
+
+import os
+import json
+import uuid
+import shutil
+import threading
+from itertools import islice
+import numpy as np
+from langchain.schema import Document
+from langchain_community.vectorstores import FAISS
+from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
+import rag_core
+import embedding_cache
+
+# 向量存储目录中记录每个文件对应文档块ID的清单文件
+MANIFEST_FILENAME = 'documents.json'
+# 知识库所有文档块向量的平均值，用于智能体路由
+CENTROID_FILENAME = 'centroid.npy'
+# 记录当前版本子目录名称的指针文件，整个文件通过os.replace原子替换
+POINTER_FILENAME = 'CURRENT'
+# 版本子目录名称的前缀
+VERSION_PREFIX = 'v-'
+# 旧版本直接保存在向量存储目录下的文件
+_LEGACY_FILENAMES = ('index.faiss', 'index.pkl', MANIFEST_FILENAME, CENTROID_FILENAME)
+
+# 每批嵌入并写入索引的文档块数量，决定导入过程的内存上限
+INGESTION_BATCH_SIZE = int(os.getenv("INGESTION_BATCH_SIZE", "256"))
+# 流式读取TXT文件时每段的最大字符数
+TEXT_BLOCK_CHARS = 20000
+
+# 按向量存储目录区分的更新锁，同一知识库的更新串行执行
+_update_locks = {}
+_update_locks_guard = threading.Lock()
+
+
+def _get_update_lock(vector_store_path):
+    with _update_locks_guard:
+        return _update_locks.setdefault(os.path.abspath(vector_store_path), threading.Lock())
+
+def current_path(vector_store_path):
+    """
+    获取向量存储当前版本所在的目录
+
+    向量存储目录下每次写入都生成一个新的版本子目录，指针文件记录当前版本；
+    没有指针文件的旧版本向量存储直接使用该目录本身。
+
+    Args:
+        vector_store_path: 向量存储目录
+
+    Returns:
+        当前版本的目录
+    """
+    try:
+        with open(os.path.join(vector_store_path, POINTER_FILENAME), 'r', encoding='utf-8') as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return vector_store_path
+    return os.path.join(vector_store_path, version)
+
+def has_vector_store(vector_store_path):
+    """向量存储是否存在（有可以加载的索引）"""
+    return os.path.exists(os.path.join(current_path(vector_store_path), 'index.faiss'))
+
+def _source_name(document):
+    """文档块所属的文件名"""
+    return os.path.basename(document.metadata.get('source', ''))
+
+def _new_chunk_ids(chunks):
+    return [str(uuid.uuid4()) for _ in chunks]
+
+def _iter_text_blocks(file_path):
+    """按行读取TXT文件，每凑够一段就产出一个文档，不把整个文件读入内存"""
+    block = []
+    block_chars = 0
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            block.append(line)
+            block_chars += len(line)
+            if block_chars >= TEXT_BLOCK_CHARS:
+                yield Document(page_content=''.join(block), metadata={'source': file_path})
+                block = []
+                block_chars = 0
+    if block:
+        yield Document(page_content=''.join(block), metadata={'source': file_path})
+
+def iter_file_documents(file_path):
+    """
+    逐页（逐段）加载单个文件
+
+    Args:
+        file_path: PDF、DOCX或TXT文件路径
+
+    Returns:
+        文档的生成器
+    """
+    extension = file_path.rsplit('.', 1)[-1].lower()
+    if extension == 'pdf':
+        return PyPDFLoader(file_path).lazy_load()
+    elif extension == 'docx':
+        # docx2txt只能整体解析，一个文件产出一个文档
+        return Docx2txtLoader(file_path).lazy_load()
+    elif extension == 'txt':
+        return _iter_text_blocks(file_path)
+    raise ValueError(f"不支持的文件类型: {file_path}")
+
+def iter_file_chunks(file_path):
+    """逐页加载并分割单个文件，产出文档块"""
+    for page in iter_file_documents(file_path):
+        for chunk in rag_core.split_documents([page]):
+            yield chunk
+
+def spool_file_chunks(file_path, spool_path):
+    """
+    把文件分割后的文档块逐个写入JSONL暂存文件（模块级函数，可以在进程池中执行）
+
+    Args:
+        file_path: 文件路径
+        spool_path: 暂存文件路径
+
+    Returns:
+        文档块数量
+    """
+    count = 0
+    with open(spool_path, 'w', encoding='utf-8') as f:
+        for chunk in iter_file_chunks(file_path):
+            f.write(json.dumps({'page_content': chunk.page_content, 'metadata': chunk.metadata}, ensure_ascii=False))
+            f.write('\n')
+            count += 1
+    return count
+
+def iter_spooled_chunks(spool_path):
+    """从JSONL暂存文件中逐个读出文档块"""
+    with open(spool_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            data = json.loads(line)
+            yield Document(page_content=data['page_content'], metadata=data['metadata'])
+
+def _iter_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def load_vector_store(vector_store_path):
+    """
+    从磁盘加载向量存储，查询向量同样经过嵌入缓存
+
+    Args:
+        vector_store_path: 向量存储目录
+
+    Returns:
+        加载的向量存储
+    """
+    return FAISS.load_local(
+        current_path(vector_store_path),
+        embedding_cache.get_embeddings(),
+        allow_dangerous_deserialization=True
+    )
+
+def load_manifest(vector_store_path, vector_store=None):
+    """
+    读取文件到文档块ID的清单，旧版本创建的向量存储没有清单时从文档存储中重建
+
+    Args:
+        vector_store_path: 向量存储目录
+        vector_store: 已加载的向量存储，用于重建清单
+
+    Returns:
+        {文件名: [文档块ID]}
+    """
+    version_path = current_path(vector_store_path)
+    manifest_path = os.path.join(version_path, MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    if vector_store is None:
+        if not has_vector_store(version_path):
+            return {}
+        vector_store = load_vector_store(version_path)
+
+    manifest = {}
+    for chunk_id in vector_store.index_to_docstore_id.values():
+        document = vector_store.docstore.search(chunk_id)
+        manifest.setdefault(_source_name(document), []).append(chunk_id)
+    return manifest
+
+def compute_centroid(vector_store, batch_size=4096):
+    """
+    计算向量存储中所有向量的平均值（分批读取，不一次性复制整个索引）
+
+    Returns:
+        float32的numpy向量，索引为空时返回None
+    """
+    index = vector_store.index
+    if index.ntotal == 0:
+        return None
+    total = np.zeros(index.d, dtype=np.float64)
+    for start in range(0, index.ntotal, batch_size):
+        count = min(batch_size, index.ntotal - start)
+        total += index.reconstruct_n(start, count).sum(axis=0)
+    return (total / index.ntotal).astype(np.float32)
+
+def load_centroid(vector_store_path, vector_store=None):
+    """
+    读取知识库的向量平均值，旧版本创建的向量存储没有保存时从索引中计算
+
+    Returns:
+        float32的numpy向量，没有知识库时返回None
+    """
+    version_path = current_path(vector_store_path)
+    centroid_path = os.path.join(version_path, CENTROID_FILENAME)
+    if os.path.exists(centroid_path):
+        return np.load(centroid_path)
+
+    if vector_store is None:
+        if not has_vector_store(version_path):
+            return None
+        vector_store = load_vector_store(version_path)
+    return compute_centroid(vector_store)
+
+def add_file_chunks(vector_store_path, file_chunks, batch_size=INGESTION_BATCH_SIZE, on_progress=None,
+                    on_commit=None):
+    """
+    向知识库增量添加文件，只嵌入这些文件的文档块；同名文件会先删除旧的文档块
+
+    文档块按批次嵌入并写入索引，可以传入生成器，内存占用只与批次大小有关。
+    更新在从磁盘重新加载的副本上进行，正在服务的向量存储对象不会被修改，
+    调用方在on_commit中整体替换，替换时仍持有该知识库的更新锁，
+    多次更新按写入顺序生效。
+
+    Args:
+        vector_store_path: 向量存储目录
+        file_chunks: {文件名: 文档块列表或生成器}
+        batch_size: 每批嵌入的文档块数量
+        on_progress: 每批写入后的回调，参数为(文件名, 该文件已写入的文档块数量)
+        on_commit: 写入磁盘后的回调，参数为更新后的向量存储（知识库为空时为None）
+
+    Returns:
+        更新后的向量存储
+    """
+    embeddings = embedding_cache.get_embeddings()
+
+    with _get_update_lock(vector_store_path):
+        vector_store = load_vector_store(vector_store_path) if has_vector_store(vector_store_path) else None
+        manifest = load_manifest(vector_store_path, vector_store)
+
+        for filename, chunks in file_chunks.items():
+            old_ids = manifest.pop(filename, None)
+            if old_ids and vector_store is not None:
+                vector_store.delete(old_ids)
+
+            file_ids = []
+            for batch in _iter_batches(chunks, batch_size):
+                texts = [chunk.page_content for chunk in batch]
+                metadatas = [chunk.metadata for chunk in batch]
+                ids = _new_chunk_ids(batch)
+                text_embeddings = list(zip(texts, embeddings.embed_documents(texts)))
+                if vector_store is None:
+                    vector_store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+                else:
+                    vector_store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+                file_ids.extend(ids)
+                if on_progress is not None:
+                    on_progress(filename, len(file_ids))
+
+            if file_ids:
+                manifest[filename] = file_ids
+            else:
+                print(f"文件 {filename} 没有可索引的内容，已跳过")
+
+        if vector_store is not None and not manifest:
+            # 替换后知识库中已没有任何文件
+            shutil.rmtree(vector_store_path, ignore_errors=True)
+            vector_store = None
+        elif vector_store is not None:
+            _commit(vector_store_path, vector_store, manifest)
+        if on_commit is not None:
+            on_commit(vector_store)
+        return vector_store
+
+def remove_document(vector_store_path, filename, on_commit=None):
+    """
+    从知识库中删除一个文件的全部文档块
+
+    Args:
+        vector_store_path: 向量存储目录
+        filename: 文件名
+        on_commit: 删除生效后的回调（仍持有更新锁），参数为更新后的向量存储（知识库被删空时为None）
+
+    Returns:
+        (是否找到该文件, 更新后的向量存储)；知识库被删空时向量存储为None，目录也会被删除
+    """
+    with _get_update_lock(vector_store_path):
+        if not has_vector_store(vector_store_path):
+            return False, None
+
+        vector_store = load_vector_store(vector_store_path)
+        manifest = load_manifest(vector_store_path, vector_store)
+        ids = manifest.pop(filename, None)
+        if ids is None:
+            return False, vector_store
+
+        if not manifest:
+            shutil.rmtree(vector_store_path)
+            vector_store = None
+        else:
+            vector_store.delete(ids)
+            _commit(vector_store_path, vector_store, manifest)
+        if on_commit is not None:
+            on_commit(vector_store)
+        return True, vector_store
+
+def _commit(vector_store_path, vector_store, manifest):
+    """
+    把新索引完整写入新的版本子目录，再原子替换指针文件切换到新版本
+
+    读取方任何时候都能通过指针找到一个完整的版本。上一个版本暂时保留，
+    让切换前已经读到旧指针的加载可以完成，更早的版本在这里删除。
+    """
+    os.makedirs(vector_store_path, exist_ok=True)
+    version = f"{VERSION_PREFIX}{uuid.uuid4().hex}"
+    version_path = os.path.join(vector_store_path, version)
+    vector_store.save_local(version_path)
+    with open(os.path.join(version_path, MANIFEST_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    centroid = compute_centroid(vector_store)
+    if centroid is not None:
+        np.save(os.path.join(version_path, CENTROID_FILENAME), centroid)
+
+    previous_path = current_path(vector_store_path)
+    pointer_path = os.path.join(vector_store_path, POINTER_FILENAME)
+    tmp_pointer_path = f"{pointer_path}.tmp-{uuid.uuid4().hex}"
+    with open(tmp_pointer_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_pointer_path, pointer_path)
+
+    _remove_stale_versions(vector_store_path, keep={version, os.path.basename(previous_path)},
+                           keep_legacy=previous_path == vector_store_path)
+
+def _remove_stale_versions(vector_store_path, keep, keep_legacy):
+    """删除不再被引用的版本子目录，以及已被取代两次的旧版本文件"""
+    for name in os.listdir(vector_store_path):
+        path = os.path.join(vector_store_path, name)
+        if name.startswith(VERSION_PREFIX) and name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+        elif name in _LEGACY_FILENAMES and not keep_legacy:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"删除旧版本向量存储文件出错: {e}")
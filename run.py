@@ -0,0 +1,10 @@
+"""
+应用启动脚本
+
+语音识别和文档解析的工作进程以spawn方式启动，会把主模块重新导入为__mp_main__。
+以本脚本作为主模块时，工作进程只导入这个空壳，不会再导入Flask应用及其依赖。
+"""
+
+if __name__ == '__main__':
+    import app
+    app.main()
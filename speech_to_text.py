@@ -2,12 +2,11 @@
 语音转文本模块 - 使用OpenAI的Whisper模型
 """
 
-import os
-import tempfile
+import threading
 import numpy as np
 import torch
 import whisper
-from datetime import datetime
+import audio_decode
 
 class SpeechToText:
     """使用Whisper模型将语音转换为文本"""
@@ -29,66 +28,103 @@ class SpeechToText:
         self.model = whisper.load_model(model_name, device=device)
         print(f"Whisper模型加载完成，使用设备: {device}")
     
-    def transcribe_audio(self, audio_file, language="zh"):
+    def _transcribe(self, audio_file, language, audio_format, word_timestamps=False):
+        # 二进制数据在内存中解码，不写临时文件
+        if isinstance(audio_file, (bytes, bytearray)):
+            audio_file = audio_decode.decode_audio(bytes(audio_file), audio_format)
+        
+        if isinstance(audio_file, np.ndarray) and audio_file.size == 0:
+            return None
+        
+        # 使用Whisper模型转录音频
+        return self.model.transcribe(
+            audio_file,
+            language=language,
+            task="transcribe",
+            word_timestamps=word_timestamps
+        )
+    
+    def transcribe_audio(self, audio_file, language="zh", audio_format=None):
         """
-        将音频文件转换为文本
+        将音频转换为文本
         
         Args:
-            audio_file: 音频文件路径或二进制数据
+            audio_file: 音频文件路径、二进制数据或16kHz的float32数组
             language: 音频语言，默认为中文
+            audio_format: 二进制数据的格式，为'pcm16'时跳过解码
             
         Returns:
             转换后的文本
         """
         try:
-            # 如果是二进制数据，先保存为临时文件
-            if isinstance(audio_file, bytes):
-                with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as temp_file:
-                    temp_filename = temp_file.name
-                    temp_file.write(audio_file)
-                
-                audio_file = temp_filename
+            result = self._transcribe(audio_file, language, audio_format)
+            return result["text"].strip() if result is not None else ""
             
-            # 使用Whisper模型转录音频
-            result = self.model.transcribe(
-                audio_file,
-                language=language,
-                task="transcribe"
-            )
+        except Exception as e:
+            print(f"音频转文本出错: {e}")
+            return ""
+    
+    def transcribe_segments(self, audio_file, language="zh", audio_format=None):
+        """
+        将音频转换为带时间戳的分段文本，每个分段附带词级时间戳
+        
+        Args:
+            audio_file: 音频文件路径、二进制数据或16kHz的float32数组
+            language: 音频语言，默认为中文
+            audio_format: 二进制数据的格式，为'pcm16'时跳过解码
             
-            # 如果使用了临时文件，删除它
-            if 'temp_filename' in locals():
-                try:
-                    os.remove(temp_filename)
-                except:
-                    pass
-                
-            return result["text"].strip()
+        Returns:
+            分段列表，每项为{'start': 开始时间（秒）, 'end': 结束时间（秒）, 'text': 文本,
+            'words': [{'start', 'end', 'text'}]}
+        """
+        try:
+            result = self._transcribe(audio_file, language, audio_format, word_timestamps=True)
+            if result is None:
+                return []
+            return [
+                {
+                    'start': segment['start'],
+                    'end': segment['end'],
+                    'text': segment['text'],
+                    'words': [
+                        {'start': word['start'], 'end': word['end'], 'text': word['word']}
+                        for word in segment.get('words', [])
+                    ]
+                }
+                for segment in result["segments"]
+            ]
             
         except Exception as e:
             print(f"音频转文本出错: {e}")
-            return ""
+            return []
 
 # 单例模式，避免重复加载模型
 _instance = None
+_instance_lock = threading.Lock()
 
 def get_transcriber(model_name="base", device=None):
-    """获取SpeechToText实例（单例模式）"""
+    """
+    获取SpeechToText实例（单例模式）
+    
+    实例不能被多个线程同时使用，服务中的并发请求应通过stt_pool进程池识别
+    """
     global _instance
-    if _instance is None:
-        _instance = SpeechToText(model_name, device)
-    return _instance
+    with _instance_lock:
+        if _instance is None:
+            _instance = SpeechToText(model_name, device)
+        return _instance
 
-def transcribe_audio(audio_data, language="zh"):
+def transcribe_audio(audio_data, language="zh", audio_format=None):
     """
     将音频数据转换为文本的便捷函数
     
     Args:
-        audio_data: 音频二进制数据或文件路径
+        audio_data: 音频二进制数据、文件路径或16kHz的float32数组
         language: 音频语言，默认为中文
+        audio_format: 二进制数据的格式，为'pcm16'时跳过解码
         
     Returns:
         转换后的文本
     """
     transcriber = get_transcriber()
-    return transcriber.transcribe_audio(audio_data, language) 
\ No newline at end of file
+    return transcriber.transcribe_audio(audio_data, language, audio_format) 
\ No newline at end of file
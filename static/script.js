@@ -48,6 +48,9 @@ document.addEventListener('DOMContentLoaded', () => {
     let voiceCallTimer = null;
     let silenceDetector = null;
     let selectedAgentId = null; // 新增 - 当前选择的智能体ID
+    let oldestLoadedIndex = 0; // 当前对话已加载的最早一条消息的下标，大于0表示还有更早的消息
+    let isLoadingOlderMessages = false;
+    const MESSAGE_PAGE_SIZE = 50;
     const SILENCE_THRESHOLD = 0.01;
     const SILENCE_DURATION = 1000; // 1秒静音视为说话结束
 
@@ -69,6 +72,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- 事件监听 ---
 
+    // 滚动到顶部附近时加载更早的消息
+    chatMessages.addEventListener('scroll', () => {
+        if (chatMessages.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
+
     // 打开新建对话弹窗
     newChatBtn.addEventListener('click', () => {
         modal.style.display = 'block';
@@ -153,6 +163,12 @@ document.addEventListener('DOMContentLoaded', () => {
             // 添加欢迎消息
             appendMessage(`你好！我是${data.agent.name}。${data.agent.role ? '我的角色是: ' + data.agent.role : ''}`, 'assistant');
             
+            // 知识库在后台导入，轮询导入进度
+            if (data.job_id) {
+                appendSystemMessage('知识库正在后台处理，完成前将仅使用对话记忆回答');
+                pollIngestionJob(data.job_id);
+            }
+            
             // 重新加载历史记录
             await loadHistory();
             
@@ -420,6 +436,30 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    /**
+     * 轮询知识库导入任务，完成或失败时提示用户
+     */
+    async function pollIngestionJob(jobId) {
+        try {
+            const response = await fetch(`/api/ingestion-jobs/${jobId}`);
+            if (!response.ok) return;
+            const job = await response.json();
+            
+            if (job.status === 'completed') {
+                appendSystemMessage(`知识库处理完成，共 ${job.total_chunks} 个文档片段`);
+                return;
+            }
+            if (job.status === 'failed') {
+                appendSystemMessage(`知识库处理失败: ${job.error || '未知错误'}`);
+                return;
+            }
+            
+            setTimeout(() => pollIngestionJob(jobId), 2000);
+        } catch (e) {
+            console.error('获取知识库导入进度出错:', e);
+        }
+    }
+    
     // --- 功能函数 ---
 
     /**
@@ -482,7 +522,8 @@ document.addEventListener('DOMContentLoaded', () => {
         if (conversationId === currentConversationId) return;
         
         try {
-            const response = await fetch(`/api/conversations/${conversationId}`);
+            // 只加载最新的一页消息，更早的消息在向上滚动时加载
+            const response = await fetch(`/api/conversations/${conversationId}?limit=${MESSAGE_PAGE_SIZE}`);
             if (!response.ok) {
                 throw new Error('获取对话失败');
             }
@@ -502,6 +543,7 @@ document.addEventListener('DOMContentLoaded', () => {
             conversation.messages.forEach(msg => {
                 appendMessage(msg.content, msg.role);
             });
+            oldestLoadedIndex = conversation.first_index;
             
             // 更新历史列表中的活跃项
             document.querySelectorAll('.history-item').forEach(item => {
@@ -517,6 +559,47 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    /**
+     * 加载当前对话中更早的一页消息，插入到聊天窗口顶部并保持滚动位置
+     */
+    async function loadOlderMessages() {
+        if (isLoadingOlderMessages || !currentConversationId || oldestLoadedIndex <= 0) return;
+        
+        const conversationId = currentConversationId;
+        isLoadingOlderMessages = true;
+        try {
+            const response = await fetch(
+                `/api/conversations/${conversationId}?before=${oldestLoadedIndex}&limit=${MESSAGE_PAGE_SIZE}`
+            );
+            if (!response.ok) {
+                throw new Error('获取历史消息失败');
+            }
+            
+            const conversation = await response.json();
+            // 加载期间已切换到其他对话
+            if (conversationId !== currentConversationId) return;
+            
+            const fragment = document.createDocumentFragment();
+            const messageEls = conversation.messages.map(msg => createMessageElement(msg.content, msg.role));
+            messageEls.forEach(el => fragment.appendChild(el));
+            
+            // 插入后保持用户当前看到的内容不跳动
+            const previousScrollHeight = chatMessages.scrollHeight;
+            chatMessages.insertBefore(fragment, chatMessages.firstChild);
+            chatMessages.scrollTop += chatMessages.scrollHeight - previousScrollHeight;
+            
+            oldestLoadedIndex = conversation.first_index;
+            
+            if (window.MathJax && messageEls.length > 0) {
+                window.MathJax.typesetPromise(messageEls).catch((err) => console.error('MathJax error:', err));
+            }
+        } catch (error) {
+            console.error('加载历史消息错误:', error);
+        } finally {
+            isLoadingOlderMessages = false;
+        }
+    }
+
     /**
      * 处理消息中的LaTeX公式，确保正确显示
      */
@@ -586,11 +669,11 @@ document.addEventListener('DOMContentLoaded', () => {
     }
     
     /**
-     * 在聊天中添加消息
+     * 创建消息元素
      * @param {string} text - 消息文本
      * @param {string} sender - 发送者类型 ('user' 或 'assistant')
      */
-    function appendMessage(text, sender) {
+    function createMessageElement(text, sender) {
         // 创建消息元素
         const messageEl = document.createElement('div');
         messageEl.classList.add('message');
@@ -644,6 +727,17 @@ document.addEventListener('DOMContentLoaded', () => {
             messageEl.innerHTML = `<p>${processedText}</p><div class="thinking-dots"><div></div><div></div><div></div></div>`;
         }
         
+        return messageEl;
+    }
+    
+    /**
+     * 在聊天中添加消息
+     * @param {string} text - 消息文本
+     * @param {string} sender - 发送者类型 ('user' 或 'assistant')
+     */
+    function appendMessage(text, sender) {
+        const messageEl = createMessageElement(text, sender);
+        
         // 添加到聊天区域
         chatMessages.appendChild(messageEl);
         
@@ -657,58 +751,48 @@ document.addEventListener('DOMContentLoaded', () => {
     }
     
     /**
-     * 将文本分段，确保每段不超过最大长度，且在句子边界处分割
+     * 读取服务器发送的事件流（SSE），每收到一个事件调用一次onEvent，onEvent返回false时停止读取
      */
-    function splitTextIntoChunks(text, maxChunkLength = 300) {
-        // 如果文本长度不超过最大长度，直接返回
-        if (text.length <= maxChunkLength) {
-            return [text];
-        }
+    async function readServerSentEvents(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
         
-        // 句子结束标记
-        const sentenceEndings = ['.', '!', '?', '。', '！', '？', '\n\n'];
-        const chunks = [];
-        let startIndex = 0;
-        
-        while (startIndex < text.length) {
-            // 计算理想的结束位置
-            let endIndex = Math.min(startIndex + maxChunkLength, text.length);
-            
-            // 如果没有到达文本末尾，尝试找到合适的句子边界
-            if (endIndex < text.length) {
-                // 从理想位置向前查找句子结束标记
-                let boundaryFound = false;
-                
-                // 向后查找100个字符，寻找句子结束标记
-                for (let i = 0; i < 100 && endIndex - i > startIndex; i++) {
-                    const charPos = endIndex - i;
-                    if (sentenceEndings.includes(text[charPos - 1])) {
-                        endIndex = charPos;
-                        boundaryFound = true;
-                        break;
-                    }
-                }
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) {
+                return;
+            }
+            buffer += decoder.decode(value, { stream: true });
+            
+            // 事件之间以空行分隔
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
                 
-                // 如果向后找不到，向前找最近的句子结束标记
-                if (!boundaryFound) {
-                    for (let i = 0; i < 100 && endIndex + i < text.length; i++) {
-                        const charPos = endIndex + i;
-                        if (sentenceEndings.includes(text[charPos])) {
-                            endIndex = charPos + 1; // 包含句子结束标记
-                            break;
-                        }
-                    }
+                const data = rawEvent.split('\n')
+                    .filter(line => line.startsWith('data: '))
+                    .map(line => line.slice(6))
+                    .join('\n');
+                if (data && onEvent(JSON.parse(data)) === false) {
+                    await reader.cancel();
+                    return;
                 }
             }
-            
-            // 添加当前块
-            chunks.push(text.substring(startIndex, endIndex));
-            
-            // 更新起始位置
-            startIndex = endIndex;
         }
-        
-        return chunks;
+    }
+    
+    /**
+     * 把base64编码的数据转换为Blob
+     */
+    function base64ToBlob(base64, mimeType) {
+        const binary = atob(base64);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return new Blob([bytes], { type: mimeType });
     }
 
     /**
@@ -716,6 +800,7 @@ document.addEventListener('DOMContentLoaded', () => {
      */
     function clearChatMessages() {
         chatMessages.innerHTML = '';
+        oldestLoadedIndex = 0;
     }
 
     /**
@@ -1239,6 +1324,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // 修改语音通话播放语音的部分，使其可被打断
+    // 服务器按句子并行合成语音并按顺序流式返回，收到第一段就开始播放，后面的段落边播边接收
     async function playAIResponseWithInterruption(text) {
         // 如果有正在播放的音频，先停止
         if (currentlyPlayingAudio) {
@@ -1248,6 +1334,9 @@ document.addEventListener('DOMContentLoaded', () => {
         // 更新全局状态
         const prevIsAISpeaking = isAISpeaking;
         
+        // 已收到、等待播放的音频段
+        const pendingSegments = [];
+        
         try {
             // 添加播放状态指示器
             const statusElement = document.createElement('div');
@@ -1255,7 +1344,7 @@ document.addEventListener('DOMContentLoaded', () => {
             statusElement.style.color = '#2196F3';
             statusElement.style.fontSize = '12px';
             statusElement.style.marginTop = '5px';
-            statusElement.innerHTML = '<i class="fas fa-volume-up"></i> 正在播放语音...';
+            statusElement.innerHTML = '<i class="fas fa-volume-up"></i> 正在生成语音...';
             
             // 找到最后一条AI消息并添加状态指示器
             const messages = document.querySelectorAll('.message.assistant');
@@ -1264,222 +1353,138 @@ document.addEventListener('DOMContentLoaded', () => {
                 lastMessage.appendChild(statusElement);
             }
             
-            // 将长文本分段
-            const textChunks = splitTextIntoChunks(text);
-            const totalChunks = textChunks.length;
+            let playbackStarted = false;
+            let isPlaying = false;
+            let streamFinished = false;
+            let receivedSegments = 0;
+            let totalSegments = null;
             
-            // 如果分段后超过3段，分段处理
-            if (totalChunks > 3) {
-                // 创建音频元素数组
-                const audioElements = [];
-                
-                // 按顺序处理每个文本段
-                for (let i = 0; i < totalChunks; i++) {
-                    try {
-                        // 更新状态指示器
-                        if (statusElement) {
-                            statusElement.innerHTML = `<i class="fas fa-volume-up"></i> 正在处理语音 (${i+1}/${totalChunks})`;
-                        }
-                        
-                        // 获取当前段的语音数据
-                        const ttsResponse = await fetch('/api/text-to-speech', {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json'
-                            },
-                            body: JSON.stringify({
-                                text: textChunks[i]
-                            })
-                        });
-                        
-                        if (!ttsResponse.ok) {
-                            const errorData = await ttsResponse.json();
-                            throw new Error(errorData.error || `处理第${i+1}段失败`);
-                        }
-                        
-                        // 获取音频blob
-                        const audioBlob = await ttsResponse.blob();
-                        
-                        // 检查blob是否有效
-                        if (audioBlob.size === 0) {
-                            throw new Error(`第${i+1}段获取到的音频数据为空`);
-                        }
-                        
-                        const audioUrl = URL.createObjectURL(audioBlob);
-                        
-                        // 创建音频元素
-                        const audio = new Audio(audioUrl);
-                        audioElements.push({
-                            audio: audio,
-                            url: audioUrl
-                        });
-                    } catch (chunkError) {
-                        console.error(`处理第${i+1}段出错:`, chunkError);
-                        // 继续处理下一段
-                    }
-                    
-                    // 如果用户已经打断播放或语音通话已停止，中止处理
-                    if (!isVoiceCallActive || !isAISpeaking) {
-                        // 清理已创建的资源
-                        audioElements.forEach(item => URL.revokeObjectURL(item.url));
-                        
-                        // 移除状态指示器
-                        if (statusElement && statusElement.parentNode) {
-                            statusElement.parentNode.removeChild(statusElement);
-                        }
-                        
-                        return;
-                    }
-                }
-                
-                // 如果没有成功处理任何文本段，抛出错误
-                if (audioElements.length === 0) {
-                    throw new Error('所有文本段处理失败');
+            const removeStatusElement = () => {
+                if (statusElement.parentNode) {
+                    statusElement.parentNode.removeChild(statusElement);
                 }
+            };
+            
+            const releasePendingSegments = () => {
+                pendingSegments.forEach(segment => URL.revokeObjectURL(segment.url));
+                pendingSegments.length = 0;
+            };
+            
+            // 语音通话已停止，或者开始播放后被用户打断
+            const isCancelled = () => !isVoiceCallActive || (playbackStarted && !isAISpeaking);
+            
+            const finishPlayback = () => {
+                currentlyPlayingAudio = null;
+                isAISpeaking = false;
+                removeStatusElement();
                 
-                // 设置音频连续播放
-                for (let i = 0; i < audioElements.length - 1; i++) {
-                    const currentAudio = audioElements[i].audio;
-                    const nextAudio = audioElements[i + 1].audio;
-                    
-                    currentAudio.onended = () => {
-                        // 释放当前音频资源
-                        URL.revokeObjectURL(audioElements[i].url);
-                        
-                        // 如果语音通话已停止，不继续播放
-                        if (!isVoiceCallActive) {
-                            return;
-                        }
-                        
-                        // 播放下一段
-                        nextAudio.play().catch(err => {
-                            console.error('播放下一段失败:', err);
-                            // 出错时继续到下一段
-                            if (nextAudio.onended) {
-                                nextAudio.onended();
-                            }
-                        });
-                    };
-                }
-                
-                // 最后一段播放完成后的处理
-                const lastAudio = audioElements[audioElements.length - 1].audio;
-                lastAudio.onended = () => {
-                    // 释放最后一段资源
-                    URL.revokeObjectURL(audioElements[audioElements.length - 1].url);
-                    
-                    // 重置状态
-                    currentlyPlayingAudio = null;
-                    isAISpeaking = false;
-                    
-                    // 移除状态指示器
-                    if (statusElement && statusElement.parentNode) {
-                        statusElement.parentNode.removeChild(statusElement);
-                    }
-                    
-                    if (isVoiceCallActive) {
-                        appendSystemMessage("请继续说话...");
-                    }
-                };
-                
-                // 开始播放第一段
-                const firstAudio = audioElements[0].audio;
-                currentlyPlayingAudio = firstAudio;
-                isAISpeaking = true;
-                
-                try {
-                    await firstAudio.play();
-                } catch (playError) {
-                    throw new Error(`无法开始播放: ${playError.message}`);
+                if (isVoiceCallActive) {
+                    appendSystemMessage("请继续说话...");
                 }
-            } else {
-                // 使用Edge TTS转换文本为语音
-                const ttsResponse = await fetch('/api/text-to-speech', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        text: text
-                    })
-                });
-                
-                if (!ttsResponse.ok) {
-                    const errorData = await ttsResponse.json();
-                    throw new Error(errorData.error || '获取语音失败');
+            };
+            
+            // 播放下一段，没有已收到的段落时等待下一段到达
+            const playNextSegment = () => {
+                if (isCancelled()) {
+                    releasePendingSegments();
+                    return;
                 }
                 
-                // 获取音频blob
-                const audioBlob = await ttsResponse.blob();
-                
-                // 检查播放是否被取消
-                if (!isVoiceCallActive) {
-                    if (statusElement && statusElement.parentNode) {
-                        statusElement.parentNode.removeChild(statusElement);
+                const segment = pendingSegments.shift();
+                if (!segment) {
+                    isPlaying = false;
+                    if (streamFinished) {
+                        finishPlayback();
                     }
                     return;
                 }
                 
-                // 检查blob是否有效
-                if (audioBlob.size === 0) {
-                    throw new Error('获取到的音频数据为空');
-                }
-                
-                const audioUrl = URL.createObjectURL(audioBlob);
-                
-                // 创建音频元素并播放
-                const audio = new Audio(audioUrl);
+                isPlaying = true;
+                const audio = new Audio(segment.url);
                 currentlyPlayingAudio = audio;
                 isAISpeaking = true; // 标记AI开始说话
+                playbackStarted = true;
+                statusElement.innerHTML = `<i class="fas fa-volume-up"></i> 正在播放语音 (${segment.seq + 1}/${totalSegments || '...'})`;
                 
-                // 更新状态指示器
-                if (statusElement) {
-                    statusElement.innerHTML = '<i class="fas fa-volume-up"></i> 正在播放...';
-                }
-                
-                // 播放完成后继续录音
-                audio.onended = () => {
-                    URL.revokeObjectURL(audioUrl);
-                    currentlyPlayingAudio = null;
-                    isAISpeaking = false; // 标记AI结束说话
-                    
-                    // 移除状态指示器
-                    if (statusElement && statusElement.parentNode) {
-                        statusElement.parentNode.removeChild(statusElement);
-                    }
-                    
-                    if (isVoiceCallActive) {
-                        appendSystemMessage("请继续说话...");
-                    }
+                const playFollowing = () => {
+                    URL.revokeObjectURL(segment.url);
+                    playNextSegment();
                 };
-                
-                // 播放出错时处理
+                audio.onended = playFollowing;
                 audio.onerror = (e) => {
                     console.error('播放音频出错:', e);
-                    URL.revokeObjectURL(audioUrl);
-                    currentlyPlayingAudio = null;
-                    isAISpeaking = false; // 标记AI结束说话
-                    
-                    // 移除状态指示器
-                    if (statusElement && statusElement.parentNode) {
-                        statusElement.parentNode.removeChild(statusElement);
-                    }
-                    
-                    if (isVoiceCallActive) {
-                        appendSystemMessage("播放语音出错，请继续说话...");
-                    }
+                    playFollowing();
                 };
+                audio.play().catch(err => {
+                    console.error(`播放第${segment.seq + 1}段失败:`, err);
+                    // 出错时继续到下一段
+                    audio.onended = null;
+                    audio.onerror = null;
+                    playFollowing();
+                });
+            };
+            
+            const ttsResponse = await fetch('/api/text-to-speech/stream', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    text: text
+                })
+            });
+            
+            if (!ttsResponse.ok) {
+                const errorData = await ttsResponse.json();
+                throw new Error(errorData.error || '获取语音失败');
+            }
+            
+            await readServerSentEvents(ttsResponse, (event) => {
+                // 如果用户已经打断播放或语音通话已停止，中止接收
+                if (isCancelled()) {
+                    return false;
+                }
                 
-                // 开始播放
-                try {
-                    await audio.play();
-                } catch (playError) {
-                    throw new Error(`无法播放音频: ${playError.message}`);
+                if (event.type === 'audio') {
+                    if (!event.audio) {
+                        console.error(`第${event.seq + 1}段语音合成失败:`, event.error);
+                        return true;
+                    }
+                    receivedSegments++;
+                    pendingSegments.push({
+                        seq: event.seq,
+                        url: URL.createObjectURL(base64ToBlob(event.audio, 'audio/mp3'))
+                    });
+                    if (!isPlaying) {
+                        playNextSegment();
+                    }
+                } else if (event.type === 'done') {
+                    totalSegments = event.segments;
                 }
+                return true;
+            });
+            streamFinished = true;
+            
+            if (isCancelled()) {
+                releasePendingSegments();
+                removeStatusElement();
+                return;
+            }
+            
+            // 如果没有成功合成任何段落，抛出错误
+            if (receivedSegments === 0) {
+                throw new Error('所有文本段处理失败');
+            }
+            
+            // 所有段落都已播放完时结束，否则由最后一段播放完成后结束
+            if (!isPlaying) {
+                finishPlayback();
             }
             
         } catch (error) {
             console.error('播放语音错误:', error);
+            pendingSegments.forEach(segment => URL.revokeObjectURL(segment.url));
+            pendingSegments.length = 0;
             isAISpeaking = prevIsAISpeaking; // 恢复之前的状态
             
             if (isVoiceCallActive) {
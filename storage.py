@@ -0,0 +1,367 @@
+"""
+存储模块 - 使用SQLite（WAL模式）保存智能体、对话和消息
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+import conversation_log
+
+DB_PATH = os.getenv("APP_DB_PATH", "app.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS agents (
+    id TEXT PRIMARY KEY,
+    agent_type TEXT,
+    created_at REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_agents_agent_type ON agents (agent_type);
+CREATE INDEX IF NOT EXISTS idx_agents_created_at ON agents (created_at);
+
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    agent_id TEXT NOT NULL,
+    title TEXT,
+    created_at REAL,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_agent_id ON conversations (agent_id);
+CREATE INDEX IF NOT EXISTS idx_conversations_created_at ON conversations (created_at);
+
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    role TEXT,
+    timestamp REAL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, idx)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    conversation_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    covered_index INTEGER NOT NULL,
+    updated_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class Storage:
+    """SQLite存储，每个线程使用独立的连接"""
+
+    def __init__(self, db_path=DB_PATH):
+        """
+        Args:
+            db_path: 数据库文件路径
+        """
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write_transaction(self):
+        """开始时即获取写锁的事务，事务内先读后写不会与其他连接的写入交错"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    # --- 智能体 ---
+
+    def get_agent(self, agent_id):
+        """获取智能体信息，不存在时返回None"""
+        row = self._connection().execute("SELECT data FROM agents WHERE id = ?", (agent_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def list_agents(self):
+        """获取所有智能体，按创建时间排序"""
+        rows = self._connection().execute("SELECT data FROM agents ORDER BY created_at").fetchall()
+        return [json.loads(row['data']) for row in rows]
+
+    def list_agents_by_type(self, agent_type):
+        """获取指定类型的智能体，按创建时间排序"""
+        rows = self._connection().execute(
+            "SELECT data FROM agents WHERE agent_type = ? ORDER BY created_at", (agent_type,)
+        ).fetchall()
+        return [json.loads(row['data']) for row in rows]
+
+    def save_agent(self, agent_info):
+        """保存（新增或更新）智能体信息"""
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO agents (id, agent_type, created_at, data) VALUES (?, ?, ?, ?)",
+                (agent_info['id'], agent_info.get('agent_type'), agent_info.get('created_at'),
+                 json.dumps(agent_info, ensure_ascii=False))
+            )
+
+    def update_agent_fields(self, agent_id, fields):
+        """
+        只更新智能体信息中的指定字段，不覆盖其他请求或后台任务同时写入的字段
+
+        Args:
+            agent_id: 智能体ID
+            fields: {字段名: 新值}
+
+        Returns:
+            更新后的智能体信息，智能体不存在时返回None
+        """
+        with self._write_transaction() as conn:
+            row = conn.execute("SELECT data FROM agents WHERE id = ?", (agent_id,)).fetchone()
+            if row is None:
+                return None
+            agent_info = json.loads(row['data'])
+            agent_info.update(fields)
+            conn.execute("UPDATE agents SET data = ? WHERE id = ?",
+                         (json.dumps(agent_info, ensure_ascii=False), agent_id))
+        return agent_info
+
+    def delete_agent(self, agent_id):
+        """
+        删除智能体及其所有对话和消息
+
+        Returns:
+            被删除的对话ID列表
+        """
+        with self._connection() as conn:
+            conv_ids = [row['id'] for row in conn.execute(
+                "SELECT id FROM conversations WHERE agent_id = ?", (agent_id,)
+            ).fetchall()]
+            conn.execute(
+                "DELETE FROM messages WHERE conversation_id IN (SELECT id FROM conversations WHERE agent_id = ?)",
+                (agent_id,)
+            )
+            conn.execute(
+                "DELETE FROM conversation_summaries WHERE conversation_id IN "
+                "(SELECT id FROM conversations WHERE agent_id = ?)",
+                (agent_id,)
+            )
+            conn.execute("DELETE FROM conversations WHERE agent_id = ?", (agent_id,))
+            conn.execute("DELETE FROM agents WHERE id = ?", (agent_id,))
+        return conv_ids
+
+    # --- 对话 ---
+
+    def create_conversation(self, conv_id, agent_id, title, created_at=None):
+        """创建对话"""
+        with self._connection() as conn:
+            self._insert_conversation(conn, conv_id, agent_id, title, created_at)
+
+    def _insert_conversation(self, conn, conv_id, agent_id, title, created_at=None):
+        conn.execute(
+            "INSERT INTO conversations (id, agent_id, title, created_at) VALUES (?, ?, ?, ?)",
+            (conv_id, agent_id, title, created_at if created_at is not None else time.time())
+        )
+
+    def get_conversation(self, conv_id):
+        """获取对话的基本信息（不含消息），不存在时返回None"""
+        row = self._connection().execute(
+            "SELECT id, agent_id, title, created_at, message_count FROM conversations WHERE id = ?", (conv_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def list_conversations(self):
+        """获取所有对话的基本信息和所属智能体名称，最新的在前面"""
+        rows = self._connection().execute("""
+            SELECT c.id, c.agent_id, c.title, c.created_at, c.message_count,
+                   json_extract(a.data, '$.name') AS agent_name
+            FROM conversations c LEFT JOIN agents a ON a.id = c.agent_id
+            ORDER BY c.created_at DESC
+        """).fetchall()
+        return [dict(row) for row in rows]
+
+    def update_conversation_title(self, conv_id, title):
+        """更新对话标题"""
+        with self._connection() as conn:
+            conn.execute("UPDATE conversations SET title = ? WHERE id = ?", (title, conv_id))
+
+    def delete_conversation(self, conv_id):
+        """删除对话及其消息"""
+        with self._connection() as conn:
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conv_id,))
+            conn.execute("DELETE FROM conversation_summaries WHERE conversation_id = ?", (conv_id,))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conv_id,))
+
+    # --- 消息 ---
+
+    def get_messages(self, conv_id, before=None, limit=None):
+        """
+        获取对话的消息，按顺序排列
+
+        Args:
+            conv_id: 对话ID
+            before: 只返回下标小于该值的消息，None表示从最新的消息开始
+            limit: 最多返回的消息数（取最靠近before的若干条），None表示不限制
+
+        Returns:
+            消息列表
+        """
+        query = "SELECT data FROM messages WHERE conversation_id = ?"
+        params = [conv_id]
+        if before is not None:
+            query += " AND idx < ?"
+            params.append(before)
+        query += " ORDER BY idx DESC LIMIT ?"
+        params.append(limit if limit is not None else -1)
+        rows = self._connection().execute(query, params).fetchall()
+        return [json.loads(row['data']) for row in reversed(rows)]
+
+    def get_last_message(self, conv_id, role=None):
+        """获取对话中最后一条（指定角色的）消息，没有时返回None"""
+        query = "SELECT data FROM messages WHERE conversation_id = ?"
+        params = [conv_id]
+        if role is not None:
+            query += " AND role = ?"
+            params.append(role)
+        row = self._connection().execute(query + " ORDER BY idx DESC LIMIT 1", params).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def append_messages(self, conv_id, messages):
+        """
+        在对话末尾追加消息，并更新对话的消息数
+
+        读取消息数和写入消息在同一个写事务中，并发追加时下标不会重复。
+
+        Returns:
+            追加后的消息总数
+        """
+        with self._write_transaction() as conn:
+            return self._append_messages(conn, conv_id, messages)
+
+    def _append_messages(self, conn, conv_id, messages):
+        """在调用方的写事务中追加消息"""
+        row = conn.execute("SELECT message_count FROM conversations WHERE id = ?", (conv_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"对话不存在: {conv_id}")
+        start = row['message_count']
+        conn.executemany(
+            "INSERT INTO messages (conversation_id, idx, role, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+            [(conv_id, start + offset, message.get('role'), message.get('timestamp'),
+              json.dumps(message, ensure_ascii=False))
+             for offset, message in enumerate(messages)]
+        )
+        total = start + len(messages)
+        conn.execute("UPDATE conversations SET message_count = ? WHERE id = ?", (total, conv_id))
+        return total
+
+    # --- 对话摘要 ---
+
+    def get_summary(self, conv_id):
+        """
+        获取对话的摘要检查点
+
+        Returns:
+            {'summary', 'covered_index', 'updated_at'}，covered_index表示摘要覆盖了下标小于它的消息；
+            没有摘要时返回None
+        """
+        row = self._connection().execute(
+            "SELECT summary, covered_index, updated_at FROM conversation_summaries WHERE conversation_id = ?",
+            (conv_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def save_summary(self, conv_id, summary, covered_index):
+        """保存对话的摘要检查点，对话已被删除时不保存"""
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO conversation_summaries (conversation_id, summary, covered_index, updated_at) "
+                "SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM conversations WHERE id = ?)",
+                (conv_id, summary, covered_index, time.time(), conv_id)
+            )
+
+    # --- 迁移 ---
+
+    def migrate_from_folders(self, agents_folder, conversations_folder):
+        """
+        从旧版的文件夹布局（agents/<id>/info.json、conversations/<id>/）一次性导入数据，
+        已经迁移过时直接返回
+
+        Returns:
+            (导入的智能体数, 导入的对话数)
+        """
+        conn = self._connection()
+        if conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_folders'").fetchone():
+            return 0, 0
+
+        agent_count = 0
+        if os.path.isdir(agents_folder):
+            for agent_id in os.listdir(agents_folder):
+                info_path = os.path.join(agents_folder, agent_id, 'info.json')
+                if os.path.exists(info_path) and self.get_agent(agent_id) is None:
+                    with open(info_path, 'r', encoding='utf-8') as f:
+                        self.save_agent(json.load(f))
+                    agent_count += 1
+
+        conv_count = 0
+        if os.path.isdir(conversations_folder):
+            for conv_id in os.listdir(conversations_folder):
+                conv_path = os.path.join(conversations_folder, conv_id)
+                info_path = os.path.join(conv_path, 'info.json')
+                if not os.path.exists(info_path) or not conversation_log.has_messages(conv_path):
+                    continue
+                if self.get_conversation(conv_id) is not None:
+                    continue
+                with open(info_path, 'r', encoding='utf-8') as f:
+                    info = json.load(f)
+                messages = conversation_log.read_messages(conv_path)
+                # 对话和消息在同一个事务中写入，中途失败时不会留下没有消息的对话
+                with self._write_transaction() as conn:
+                    self._insert_conversation(conn, conv_id, info['agent_id'], info.get('title', '新对话'),
+                                              info.get('created_at'))
+                    self._append_messages(conn, conv_id, messages)
+                conv_count += 1
+
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_folders', ?)",
+                         (str(time.time()),))
+        print(f"已从文件夹迁移 {agent_count} 个智能体和 {conv_count} 个对话到 {self.db_path}")
+        return agent_count, conv_count
+
+
+# 单例模式，整个进程共享一个Storage
+_instance = None
+
+def get_storage():
+    """获取Storage实例（单例模式）"""
+    global _instance
+    if _instance is None:
+        _instance = Storage()
+    return _instance
+
+
+if __name__ == '__main__':
+    # 用法: python storage.py migrate [agents目录] [conversations目录]
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print("用法: python storage.py migrate [agents目录] [conversations目录]")
+        sys.exit(1)
+
+    agents_folder = sys.argv[2] if len(sys.argv) > 2 else 'agents'
+    conversations_folder = sys.argv[3] if len(sys.argv) > 3 else 'conversations'
+    get_storage().migrate_from_folders(agents_folder, conversations_folder)
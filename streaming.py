@@ -0,0 +1,147 @@
+"""
+流式回答模块 - 在工作线程中执行问答链，通过队列把LLM生成的token逐个交给调用方
+"""
+
+import os
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from langchain.chains import LLMChain
+from langchain_core.callbacks import BaseCallbackHandler
+
+# 同时执行的流式回答数量
+STREAM_WORKERS = int(os.getenv("STREAM_WORKERS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix="stream")
+
+
+class TokenQueueCallbackHandler(BaseCallbackHandler):
+    """
+    把生成回答的LLM输出的新token放入队列
+
+    检索链在有对话历史时会先调用同一个LLM把问题改写为独立问题，这部分输出不属于回答。
+    wait_for_retrieval为True时只转发检索完成之后开始的LLM调用的token。
+    """
+
+    def __init__(self, token_queue, wait_for_retrieval=False):
+        """
+        Args:
+            token_queue: token队列
+            wait_for_retrieval: 是否忽略检索完成之前的LLM调用
+        """
+        self.queue = token_queue
+        self.retrieved = not wait_for_retrieval
+        self._answer_runs = set()
+
+    def on_retriever_end(self, documents, **kwargs):
+        self.retrieved = True
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        if self.retrieved:
+            self._answer_runs.add(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        if self.retrieved:
+            self._answer_runs.add(run_id)
+
+    def on_llm_new_token(self, token, *, run_id=None, **kwargs):
+        if token and run_id in self._answer_runs:
+            self.queue.put(('token', token))
+
+
+def _run_llm_chain(chain, question, token_queue):
+    # 纯对话链：直接流式调用LLM，结束后把这一轮写入链的记忆
+    inputs = chain.prep_inputs({"question": question})
+    prompt_inputs = {key: inputs[key] for key in chain.prompt.input_variables}
+    messages = chain.prompt.format_prompt(**prompt_inputs).to_messages()
+
+    parts = []
+    for chunk in chain.llm.stream(messages):
+        text = getattr(chunk, 'content', chunk)
+        if text:
+            parts.append(text)
+            token_queue.put(('token', text))
+
+    answer = "".join(parts)
+    chain.prep_outputs(inputs, {chain.output_key: answer})
+    return answer
+
+def _run_callback_chain(chain, question, token_queue):
+    # 检索链等其他链：通过回调接收LLM生成的token，有检索器时只接收检索之后生成回答的token
+    handler = TokenQueueCallbackHandler(token_queue, wait_for_retrieval=hasattr(chain, 'retriever'))
+    response = chain.invoke({"question": question}, config={"callbacks": [handler]})
+    return response["answer"]
+
+def _run(chain, question, token_queue):
+    try:
+        if isinstance(chain, LLMChain):
+            answer = _run_llm_chain(chain, question, token_queue)
+        else:
+            answer = _run_callback_chain(chain, question, token_queue)
+        token_queue.put(('done', answer))
+    except Exception as e:
+        token_queue.put(('error', e))
+
+def stream_answer(chain, question):
+    """
+    流式获取问答链的回答
+
+    Args:
+        chain: 问答链，输入为{"question": ...}，输出包含"answer"
+        question: 问题
+
+    Yields:
+        {'type': 'token', 'text': 新生成的文本}，最后是
+        {'type': 'done', 'answer': 完整回答, 'ttft': 首个token的延迟（秒）,
+         'tokens': token数, 'tokens_per_sec': 生成速度, 'seconds': 总耗时}
+
+    Raises:
+        问答链执行时的异常
+    """
+    token_queue = queue.Queue()
+    started_at = time.monotonic()
+    future = _executor.submit(_run, chain, question, token_queue)
+
+    first_token_at = None
+    tokens = 0
+    while True:
+        kind, payload = token_queue.get()
+        if kind == 'token':
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            tokens += 1
+            yield {'type': 'token', 'text': payload}
+        elif kind == 'error':
+            raise payload
+        else:
+            answer = payload
+            break
+    future.result()
+
+    if tokens == 0 and answer:
+        # LLM没有逐个输出token时，把完整回答作为一次输出
+        first_token_at = time.monotonic()
+        tokens = 1
+        yield {'type': 'token', 'text': answer}
+
+    finished_at = time.monotonic()
+    generation_seconds = finished_at - first_token_at if first_token_at is not None else 0.0
+    yield {
+        'type': 'done',
+        'answer': answer,
+        'ttft': (first_token_at - started_at) if first_token_at is not None else None,
+        'tokens': tokens,
+        'tokens_per_sec': tokens / generation_seconds if generation_seconds > 0 else 0.0,
+        'seconds': finished_at - started_at
+    }
+
+def generate_answer(chain, question):
+    """
+    非流式地获取回答，内部同样经过stream_answer
+
+    Returns:
+        (完整回答, done事件中的统计信息)
+    """
+    for event in stream_answer(chain, question):
+        if event['type'] == 'done':
+            return event['answer'], event
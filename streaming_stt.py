@@ -0,0 +1,276 @@
+"""
+流式语音识别模块 - 为每个语音会话维护一个持续运行的解码器和滚动的PCM缓冲区，只识别尚未确认的滑动窗口
+
+部分结果采用LocalAgreement策略：连续两次识别结果的公共前缀视为稳定，在词的边界确认，
+已确认的词对应的音频按词级时间戳立即从缓冲区中移除，已确认的文本不会再改变，
+结束时只识别最后未确认的音频。
+"""
+
+import os
+import re
+import threading
+import subprocess
+import audio_decode
+import stt_pool
+
+# 两次部分识别之间至少新增的音频时长（秒）
+STREAM_MIN_UPDATE_SECONDS = float(os.getenv("STREAM_MIN_UPDATE_SECONDS", "1.0"))
+# 未确认音频的最大时长（秒），超出时强制确认较早的分段
+STREAM_MAX_WINDOW_SECONDS = float(os.getenv("STREAM_MAX_WINDOW_SECONDS", "15"))
+# 部分识别的截止时间（秒）
+STREAM_PARTIAL_DEADLINE = float(os.getenv("STREAM_PARTIAL_DEADLINE", "5"))
+# 未确认音频缓冲区的上限（秒），识别持续失败时丢弃最早的音频
+STREAM_MAX_BUFFER_SECONDS = float(os.getenv("STREAM_MAX_BUFFER_SECONDS", "60"))
+
+_BYTES_PER_SECOND = audio_decode.SAMPLE_RATE * 2
+
+# 中日韩字符每个字是一个token，其他文字按空白分词，token保留前面的空白以便原样拼接
+_CJK = r'\u2E80-\u9FFF\uF900-\uFAFF\uFF00-\uFFEF'
+_TOKEN = re.compile(rf'\s*(?:[{_CJK}]|[^\s{_CJK}]+)')
+
+
+def tokenize(text):
+    """把识别结果切分为用于比较的token"""
+    return _TOKEN.findall(text)
+
+def _hypothesis_words(segments):
+    """
+    把识别分段展开为带时间戳的词，每个词按tokenize()切分，比较和确认都使用同一份token序列
+
+    没有词级时间戳时整个分段作为一个词。
+    """
+    words = []
+    for segment_index, segment in enumerate(segments):
+        for word in segment.get('words') or [segment]:
+            tokens = tokenize(word['text'])
+            if tokens:
+                words.append({'start': word['start'], 'end': word['end'], 'tokens': tokens,
+                              'segment': segment_index})
+    return words
+
+def _common_prefix_length(previous, current):
+    length = 0
+    for previous_token, current_token in zip(previous, current):
+        if previous_token.strip() != current_token.strip():
+            break
+        length += 1
+    return length
+
+def _join_text(head, tail):
+    # 两段都是西文时用空格连接，中文直接连接
+    if head and tail and head[-1].isalnum() and tail[0].isalnum() \
+            and not re.match(rf'[{_CJK}]', head[-1]) and not re.match(rf'[{_CJK}]', tail[0]):
+        return f"{head} {tail}"
+    return head + tail
+
+
+class FFmpegStreamDecoder:
+    """持续运行的ffmpeg进程，把连续到达的容器格式音频片段（如MediaRecorder的webm）解码为16kHz单声道16位PCM"""
+
+    def __init__(self, on_pcm):
+        """
+        Args:
+            on_pcm: 收到解码后PCM数据的回调
+        """
+        self.process = subprocess.Popen(
+            [
+                "ffmpeg", "-loglevel", "error",
+                # 尽快输出，不为探测格式缓冲大量数据
+                "-probesize", "32768", "-analyzeduration", "0", "-fflags", "nobuffer",
+                "-i", "pipe:0",
+                "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(audio_decode.SAMPLE_RATE),
+                "pipe:1"
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        self._reader = threading.Thread(target=self._read, args=(on_pcm,), daemon=True)
+        self._reader.start()
+
+    def _read(self, on_pcm):
+        while True:
+            data = self.process.stdout.read1(65536)
+            if not data:
+                return
+            on_pcm(data)
+
+    def write(self, data):
+        """写入一段编码后的音频"""
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except OSError as e:
+            print(f"写入音频解码器出错: {e}")
+
+    def close(self, timeout=5):
+        """关闭输入，等待剩余的音频解码完成"""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self._reader.join(timeout)
+        self.kill()
+
+    def kill(self):
+        """立即结束解码进程"""
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+class StreamingRecognizer:
+    """
+    单个语音会话的流式识别器
+
+    feed()接收音频片段，update()识别未确认的窗口并返回部分结果，finish()返回最终结果。
+    同一时间只进行一次识别，识别期间到达的音频在下一次识别时处理。
+    """
+
+    def __init__(self, audio_format='webm', language="zh"):
+        """
+        Args:
+            audio_format: 音频格式，'pcm16'表示16kHz单声道16位PCM，直接放入缓冲区；其他格式经ffmpeg解码
+            language: 音频语言
+        """
+        self.audio_format = audio_format
+        self.language = language
+        self._lock = threading.Lock()  # 保护PCM缓冲区
+        self._update_lock = threading.Lock()  # 保证同一时间只进行一次识别
+        self._pcm = bytearray()  # 未确认部分的PCM
+        self._buffer_start = 0  # 缓冲区开头在整个音频流中的字节位置
+        self._max_buffer_bytes = int(STREAM_MAX_BUFFER_SECONDS * audio_decode.SAMPLE_RATE) * 2
+        self._received_bytes = 0
+        self._last_update_bytes = 0
+        self.dropped_bytes = 0  # 因缓冲区超出上限而丢弃的音频
+
+        self.committed_text = ""  # 已确认的文本，对应的音频已移出缓冲区，不会再改变
+        self._previous_tokens = None  # 上一次识别未确认部分得到的token
+        self._previous_start = None  # 上一次识别的未确认部分在音频流中的开始位置
+
+        self._decoder = FFmpegStreamDecoder(self._append_pcm) if audio_format != 'pcm16' else None
+
+    def feed(self, data):
+        """接收一段音频"""
+        if self._decoder is not None:
+            self._decoder.write(data)
+        else:
+            self._append_pcm(data)
+
+    def should_update(self):
+        """是否积累了足够的新音频并且没有正在进行的识别"""
+        with self._lock:
+            enough_audio = self._received_bytes - self._last_update_bytes >= STREAM_MIN_UPDATE_SECONDS * _BYTES_PER_SECOND
+        return enough_audio and not self._update_lock.locked()
+
+    def update(self):
+        """
+        识别未确认的窗口
+
+        Returns:
+            {'committed': 已确认的文本, 'tentative': 尚未稳定的文本}，正在识别或没有音频时返回None
+
+        Raises:
+            stt_pool.STTOverloadedError, stt_pool.STTTimeoutError
+        """
+        if not self._update_lock.acquire(blocking=False):
+            return None
+        try:
+            with self._lock:
+                audio = audio_decode.pcm16_to_float32(bytes(self._pcm))
+                start = self._buffer_start
+                self._last_update_bytes = self._received_bytes
+            if audio.size == 0:
+                return None
+
+            segments = stt_pool.get_pool().transcribe(audio, self.language, deadline=STREAM_PARTIAL_DEADLINE,
+                                                      with_segments=True)
+            return self._apply_hypothesis(segments, audio.size / audio_decode.SAMPLE_RATE, start)
+        finally:
+            self._update_lock.release()
+
+    def finish(self):
+        """
+        结束会话，只识别最后未确认的音频
+
+        Returns:
+            完整的识别结果
+        """
+        if self._decoder is not None:
+            self._decoder.close()
+        with self._update_lock:
+            with self._lock:
+                audio = audio_decode.pcm16_to_float32(bytes(self._pcm))
+                self._trim_to(self._buffer_start + len(self._pcm))
+            tail = ""
+            if audio.size > 0:
+                tail = stt_pool.get_pool().transcribe(audio, self.language)
+            # 缓冲区中只有已确认文本之后的音频，已确认的文本保持不变
+            return _join_text(self.committed_text.strip(), tail.strip())
+
+    def close(self):
+        """放弃会话（如客户端断开连接）"""
+        if self._decoder is not None:
+            self._decoder.kill()
+
+    def _append_pcm(self, data):
+        with self._lock:
+            self._pcm += data
+            self._received_bytes += len(data)
+            overflow = len(self._pcm) - self._max_buffer_bytes
+            if overflow > 0:
+                # 识别持续失败时缓冲区不再确认和缩短，丢弃最早的音频避免无限增长
+                overflow += overflow % 2
+                if self.dropped_bytes == 0:
+                    print(f"流式识别缓冲区超过 {STREAM_MAX_BUFFER_SECONDS:.0f} 秒，丢弃最早的音频")
+                self.dropped_bytes += overflow
+                self._trim_to(self._buffer_start + overflow)
+
+    def _trim_to(self, position):
+        """移除缓冲区中音频流位置position之前的数据（调用方需持有self._lock）"""
+        count = position - self._buffer_start
+        if count > 0:
+            del self._pcm[:count]
+            self._buffer_start = position
+
+    def _apply_hypothesis(self, segments, window_seconds, start):
+        words = _hypothesis_words(segments)
+        tokens = [token for word in words for token in word['tokens']]
+
+        # LocalAgreement：与上一次识别结果一致的前缀是稳定的；
+        # 两次识别的音频开头不同（期间有音频被丢弃）时不能比较
+        stable = 0
+        if self._previous_tokens is not None and self._previous_start == start:
+            stable = _common_prefix_length(self._previous_tokens, tokens)
+
+        # 窗口过长时强制确认除最后一段以外的分段
+        if window_seconds > STREAM_MAX_WINDOW_SECONDS and len(segments) > 1:
+            forced = sum(len(word['tokens']) for word in words if word['segment'] < len(segments) - 1)
+            stable = max(stable, forced)
+
+        # 只在词的边界确认，确认的词对应的音频可以按时间戳移出缓冲区
+        confirmed_words = 0
+        confirmed = 0
+        for word in words:
+            if confirmed + len(word['tokens']) > stable:
+                break
+            confirmed += len(word['tokens'])
+            confirmed_words += 1
+
+        trim_position = start
+        if confirmed_words > 0:
+            trim_seconds = words[confirmed_words - 1]['end']
+            if confirmed_words < len(words):
+                # 时间戳有误差，不切到下一个词的开头之后
+                trim_seconds = min(trim_seconds, words[confirmed_words]['start'])
+            trim_position = start + int(max(trim_seconds, 0.0) * audio_decode.SAMPLE_RATE) * 2
+            with self._lock:
+                self._trim_to(trim_position)
+            self.committed_text += "".join(tokens[:confirmed])
+
+        self._previous_tokens = tokens[confirmed:]
+        self._previous_start = trim_position
+        return {
+            'committed': self.committed_text,
+            'tentative': "".join(tokens[confirmed:])
+        }
@@ -0,0 +1,328 @@
+"""
+语音识别进程池 - 在多个工作进程中运行Whisper模型
+
+请求进入有界队列，队列满时直接拒绝；每个请求带截止时间，排队超时的请求不再识别；
+统计每个工作进程的利用率，工作进程意外退出时自动重启。
+"""
+
+import os
+import time
+import queue
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+# Whisper模型名称
+STT_MODEL = os.getenv("STT_MODEL", "base")
+# 每个工作进程使用的torch计算线程数
+STT_THREADS_PER_WORKER = int(os.getenv("STT_THREADS_PER_WORKER", "2"))
+# 工作进程数，默认按CPU核数和每个进程的线程数计算
+STT_WORKERS = int(os.getenv("STT_WORKERS", str(max(1, (os.cpu_count() or 2) // STT_THREADS_PER_WORKER))))
+# 最多排队等待的请求数，超出时拒绝新请求
+STT_QUEUE_SIZE = int(os.getenv("STT_QUEUE_SIZE", str(STT_WORKERS * 2)))
+# 请求的默认截止时间（秒）
+STT_DEADLINE = float(os.getenv("STT_DEADLINE", "30"))
+
+
+class STTOverloadedError(Exception):
+    """排队的请求已满，新请求被拒绝"""
+
+
+class STTTimeoutError(Exception):
+    """请求没有在截止时间内完成"""
+
+
+def _worker_main(worker_id, model_name, threads, device, request_queue, result_queue):
+    """工作进程：加载模型后依次处理请求"""
+    import torch
+    import speech_to_text
+
+    # 限制每个进程的计算线程数，避免多个进程争抢CPU
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    transcriber = speech_to_text.SpeechToText(model_name, device)
+    result_queue.put(('ready', worker_id, None, None))
+
+    while True:
+        item = request_queue.get()
+        if item is None:
+            break
+        request_id, audio, language, audio_format, with_segments, deadline = item
+        # 排队期间已经超过截止时间，调用方不再等待结果
+        if time.time() > deadline:
+            result_queue.put(('expired', worker_id, request_id, None))
+            continue
+
+        result_queue.put(('started', worker_id, request_id, None))
+        try:
+            if with_segments:
+                result = transcriber.transcribe_segments(audio, language, audio_format)
+            else:
+                result = transcriber.transcribe_audio(audio, language, audio_format)
+            result_queue.put(('done', worker_id, request_id, result))
+        except Exception as e:
+            result_queue.put(('failed', worker_id, request_id, str(e)))
+
+
+class STTPool:
+    """Whisper工作进程池"""
+
+    def __init__(self, workers=STT_WORKERS, threads_per_worker=STT_THREADS_PER_WORKER,
+                 queue_size=STT_QUEUE_SIZE, model_name=STT_MODEL, device=None):
+        """
+        启动工作进程
+
+        Args:
+            workers: 工作进程数
+            threads_per_worker: 每个工作进程的torch计算线程数
+            queue_size: 最多排队等待的请求数
+            model_name: Whisper模型名称
+            device: 计算设备，为None时自动选择
+        """
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.queue_size = queue_size
+        self.model_name = model_name
+        self.device = device
+
+        # 使用spawn启动子进程，避免在多线程的服务进程中fork
+        self._context = multiprocessing.get_context('spawn')
+        self._request_queue = self._context.Queue()
+        self._result_queue = self._context.Queue()
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._pending = {}  # {请求ID: 请求状态}
+        self._workers = {}  # {工作进程ID: 工作进程状态}
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.expired = 0
+        self.total_wait_seconds = 0.0
+        self.total_latency_seconds = 0.0
+
+        for worker_id in range(workers):
+            self._start_worker(worker_id)
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+        print(f"语音识别进程池已启动: {workers} 个进程, 每个进程 {threads_per_worker} 个线程")
+
+    def submit(self, audio, language="zh", audio_format=None, deadline=STT_DEADLINE, with_segments=False):
+        """
+        提交识别请求
+
+        Args:
+            audio: 音频二进制数据或16kHz的float32数组
+            language: 音频语言
+            audio_format: 二进制数据的格式，为'pcm16'时跳过解码
+            deadline: 截止时间（秒）
+            with_segments: 为True时返回带时间戳的分段，见SpeechToText.transcribe_segments
+
+        Returns:
+            Future，结果为识别出的文本（或分段列表）
+
+        Raises:
+            STTOverloadedError: 排队的请求已满
+        """
+        now = time.time()
+        with self._lock:
+            # 正在识别的请求最多每个进程一个，其余都在排队
+            if len(self._pending) >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise STTOverloadedError(f"语音识别繁忙，已有 {len(self._pending)} 个请求在处理或排队")
+            request_id = next(self._request_ids)
+            future = Future()
+            self._pending[request_id] = {
+                'future': future,
+                'submitted_at': now,
+                'deadline': now + deadline,
+                'started_at': None,
+                'worker_id': None
+            }
+            self.submitted += 1
+        self._request_queue.put((request_id, audio, language, audio_format, with_segments, now + deadline))
+        return future
+
+    def transcribe(self, audio, language="zh", audio_format=None, deadline=STT_DEADLINE, with_segments=False):
+        """
+        识别音频并等待结果，参数同submit()
+
+        Returns:
+            识别出的文本（或分段列表）
+
+        Raises:
+            STTOverloadedError: 排队的请求已满
+            STTTimeoutError: 没有在截止时间内完成
+        """
+        future = self.submit(audio, language, audio_format, deadline, with_segments)
+        try:
+            return future.result(timeout=deadline)
+        except FutureTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise STTTimeoutError(f"语音识别超过 {deadline:.0f} 秒未完成")
+
+    def stats(self):
+        """获取进程池统计信息"""
+        now = time.time()
+        with self._lock:
+            workers = []
+            for worker_id, worker in sorted(self._workers.items()):
+                busy_seconds = worker['busy_seconds']
+                if worker['busy_since'] is not None:
+                    busy_seconds += now - worker['busy_since']
+                uptime = now - worker['started_at']
+                workers.append({
+                    'id': worker_id,
+                    'pid': worker['process'].pid,
+                    'alive': worker['process'].is_alive(),
+                    'ready': worker['ready'],
+                    'busy': worker['request_id'] is not None,
+                    'completed': worker['completed'],
+                    'restarts': worker['restarts'],
+                    'busy_seconds': busy_seconds,
+                    'utilization': busy_seconds / uptime if uptime > 0 else 0.0
+                })
+            running = sum(1 for request in self._pending.values() if request['started_at'] is not None)
+            finished = self.completed + self.failed
+            return {
+                'workers': workers,
+                'threads_per_worker': self.threads_per_worker,
+                'queued': len(self._pending) - running,
+                'running': running,
+                'queue_size': self.queue_size,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'expired': self.expired,
+                'avg_wait_ms': self.total_wait_seconds / finished * 1000 if finished else 0.0,
+                'avg_latency_ms': self.total_latency_seconds / finished * 1000 if finished else 0.0
+            }
+
+    def _start_worker(self, worker_id, restarts=0):
+        process = self._context.Process(
+            target=_worker_main,
+            args=(worker_id, self.model_name, self.threads_per_worker, self.device,
+                  self._request_queue, self._result_queue),
+            daemon=True
+        )
+        process.start()
+        self._workers[worker_id] = {
+            'process': process,
+            'started_at': time.time(),
+            'ready': False,
+            'request_id': None,
+            'busy_since': None,
+            'busy_seconds': 0.0,
+            'completed': 0,
+            'restarts': restarts,
+            'stopped': False
+        }
+
+    def _dispatch(self):
+        last_check = time.time()
+        while True:
+            try:
+                message = self._result_queue.get(timeout=1.0)
+            except queue.Empty:
+                message = None
+            if message is not None:
+                with self._lock:
+                    self._handle_message(*message)
+            if time.time() - last_check >= 1.0:
+                self._check_workers()
+                last_check = time.time()
+
+    def _handle_message(self, kind, worker_id, request_id, payload):
+        # 调用方需持有self._lock
+        worker = self._workers[worker_id]
+        if kind == 'ready':
+            worker['ready'] = True
+            return
+
+        request = self._pending.get(request_id)
+        if request is None:
+            return
+        now = time.time()
+
+        if kind == 'started':
+            request['started_at'] = now
+            request['worker_id'] = worker_id
+            worker['request_id'] = request_id
+            worker['busy_since'] = now
+            return
+
+        del self._pending[request_id]
+        if kind == 'expired':
+            self.expired += 1
+            if not request['future'].done():
+                request['future'].set_exception(STTTimeoutError("请求在排队期间超过截止时间"))
+            return
+
+        worker['request_id'] = None
+        if worker['busy_since'] is not None:
+            worker['busy_seconds'] += now - worker['busy_since']
+            worker['busy_since'] = None
+        worker['completed'] += 1
+        self.total_wait_seconds += request['started_at'] - request['submitted_at']
+        self.total_latency_seconds += now - request['submitted_at']
+
+        if kind == 'done':
+            self.completed += 1
+            request['future'].set_result(payload)
+        else:
+            self.failed += 1
+            request['future'].set_exception(RuntimeError(payload))
+
+    def _check_workers(self):
+        """重启意外退出的工作进程，正在处理的请求标记为失败，释放排队超时的请求"""
+        now = time.time()
+        with self._lock:
+            # 排队超时的请求仍在进程间队列中，工作进程取到后会直接跳过，这里先释放排队名额
+            for request_id, request in list(self._pending.items()):
+                if request['started_at'] is None and now > request['deadline']:
+                    del self._pending[request_id]
+                    self.expired += 1
+                    if not request['future'].done():
+                        request['future'].set_exception(STTTimeoutError("请求在排队期间超过截止时间"))
+
+            for worker_id, worker in list(self._workers.items()):
+                if worker['stopped'] or worker['process'].is_alive():
+                    continue
+                exitcode = worker['process'].exitcode
+                request = self._pending.pop(worker['request_id'], None) if worker['request_id'] is not None else None
+                if request is not None:
+                    self.failed += 1
+                    request['future'].set_exception(RuntimeError("语音识别进程意外退出"))
+                # 模型没有加载成功就退出的进程不再重启，避免反复失败
+                if not worker['ready']:
+                    print(f"语音识别进程 {worker_id} 启动失败 (exitcode={exitcode})")
+                    worker['stopped'] = True
+                    continue
+                print(f"语音识别进程 {worker_id} 已退出 (exitcode={exitcode})，正在重启")
+                self._start_worker(worker_id, worker['restarts'] + 1)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """获取全局语音识别进程池，第一次调用时启动工作进程"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = STTPool()
+        return _pool
+
+def stats():
+    """获取进程池统计信息，进程池还没有启动时返回None"""
+    return _pool.stats() if _pool is not None else None
@@ -0,0 +1,98 @@
+"""
+embedding_executor模块测试：用注入的假嵌入函数代替DashScope服务，
+检查批次打包、令牌桶限流、只重试失败的批次，以及中断后从缓存继续
+"""
+
+import time
+import threading
+import pytest
+
+from embedding_executor import EmbeddingBatchError, EmbeddingExecutor, TokenBucket, pack_batches
+
+
+class FakeEmbeddingServer:
+    """本地的假嵌入服务：按文本长度返回向量，记录每次请求，可以让指定文本的批次失败"""
+
+    def __init__(self, fail_texts=(), failures_per_text=1):
+        self.requests = []
+        self._failures_left = {text: failures_per_text for text in fail_texts}
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.requests.append(list(texts))
+            for text in texts:
+                if self._failures_left.get(text, 0) > 0:
+                    self._failures_left[text] -= 1
+                    raise ConnectionError(f"批次中的 {text} 请求失败")
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def make_executor(server, **kwargs):
+    options = dict(max_batch_size=2, max_batch_chars=1000, max_concurrency=2,
+                   requests_per_second=1000, max_retries=2, backoff_base=0, backoff_max=0)
+    options.update(kwargs)
+    return EmbeddingExecutor(server.embed_documents, **options)
+
+
+def test_pack_batches_limits_count_and_chars_and_keeps_order():
+    texts = ["a", "bb", "ccc", "dddd", "e" * 10, "f"]
+    batches = pack_batches(texts, max_batch_size=3, max_batch_chars=6)
+
+    assert batches == [(0, ["a", "bb", "ccc"]), (3, ["dddd"]), (4, ["e" * 10]), (5, ["f"])]
+    assert [text for _, batch in batches for text in batch] == texts
+
+
+def test_token_bucket_limits_request_rate():
+    bucket = TokenBucket(rate=20, capacity=1)
+    started_at = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    # 第一个令牌立即可用，其余4个每个需要等待1/20秒
+    assert time.monotonic() - started_at >= 4 / 20 * 0.9
+
+
+def test_only_failed_batch_is_retried():
+    server = FakeEmbeddingServer(fail_texts=["c"])
+    executor = make_executor(server)
+
+    vectors = executor.embed(["a", "b", "c", "d", "e"])
+
+    assert vectors == [[1.0, 1.0]] * 5
+    requested = [tuple(batch) for batch in server.requests]
+    assert requested.count(("a", "b")) == 1
+    assert requested.count(("c", "d")) == 2
+    assert requested.count(("e",)) == 1
+    assert executor.stats()['total_retries'] == 1
+
+
+def test_failed_batch_does_not_drop_successful_batches():
+    server = FakeEmbeddingServer(fail_texts=["c"], failures_per_text=10)
+    executor = make_executor(server)
+    delivered = []
+
+    with pytest.raises(EmbeddingBatchError) as excinfo:
+        executor.embed(["a", "b", "c", "d", "e"], on_batch_done=lambda texts, vectors: delivered.append(texts))
+
+    assert excinfo.value.failed_batches == 1
+    assert sorted(delivered) == [["a", "b"], ["e"]]
+
+
+def test_resumed_job_skips_cached_chunks(tmp_path):
+    pytest.importorskip("langchain_core")
+    from embedding_cache import CachedEmbeddings, EmbeddingCache
+
+    texts = ["a", "b", "c", "d", "e"]
+    cache = EmbeddingCache(db_path=str(tmp_path / "embeddings.sqlite3"))
+
+    # 第一次执行时c所在的批次一直失败，其他批次已经写入缓存
+    failing_server = FakeEmbeddingServer(fail_texts=["c"], failures_per_text=10)
+    with pytest.raises(EmbeddingBatchError):
+        CachedEmbeddings(failing_server, cache, executor=make_executor(failing_server)).embed_documents(texts)
+
+    # 重新执行时只请求上次失败的文本
+    server = FakeEmbeddingServer()
+    vectors = CachedEmbeddings(server, cache, executor=make_executor(server)).embed_documents(texts)
+
+    assert server.requests == [["c", "d"]]
+    assert vectors == [[1.0, 1.0]] * 5
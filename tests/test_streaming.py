@@ -0,0 +1,65 @@
+"""
+streaming模块测试：检索链在有对话历史时，改写问题的LLM输出不应进入流式回答
+"""
+
+import pytest
+
+pytest.importorskip("langchain")
+
+from typing import List
+from langchain.chains import ConversationalRetrievalChain
+from langchain.memory import ConversationBufferMemory
+from langchain_core.documents import Document
+from langchain_core.language_models.llms import LLM
+from langchain_core.retrievers import BaseRetriever
+import streaming
+
+CONDENSED_QUESTION = "改写后的独立问题"
+ANSWER = "这是最终的回答"
+
+
+class ScriptedLLM(LLM):
+    """按顺序返回预设的输出，并逐字触发on_llm_new_token"""
+
+    responses: List[str]
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        response = self.responses[self.calls]
+        self.calls += 1
+        if run_manager is not None:
+            for char in response:
+                run_manager.on_llm_new_token(char)
+        return response
+
+
+class StaticRetriever(BaseRetriever):
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return [Document(page_content="知识库中的内容")]
+
+
+def _build_chain(llm):
+    memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True, output_key="answer")
+    memory.save_context({"question": "上一轮的问题"}, {"answer": "上一轮的回答"})
+    return ConversationalRetrievalChain.from_llm(llm, retriever=StaticRetriever(), memory=memory)
+
+
+def test_stream_answer_skips_condensed_question_tokens():
+    llm = ScriptedLLM(responses=[CONDENSED_QUESTION, ANSWER])
+    chain = _build_chain(llm)
+
+    events = list(streaming.stream_answer(chain, "这一轮的问题"))
+    tokens = "".join(event['text'] for event in events if event['type'] == 'token')
+    done = events[-1]
+
+    # 两次LLM调用都发生了，但只有回答的token被转发
+    assert llm.calls == 2
+    assert tokens == ANSWER
+    assert done['type'] == 'done'
+    assert done['answer'] == ANSWER
+    assert done['tokens'] == len(ANSWER)
+    assert done['ttft'] is not None
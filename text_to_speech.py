@@ -3,23 +3,47 @@
 """
 
 import os
+import re
 import asyncio
-import tempfile
-import edge_tts
-import time
-import glob
 import threading
-from datetime import datetime, timedelta
+from io import BytesIO
+from collections import OrderedDict
+import edge_tts
+import tts_cache
+
+# 最多保留的不同语音的实例数，语音名称来自客户端请求，超出时淘汰最久未使用的实例
+TTS_MAX_VOICES = int(os.getenv("TTS_MAX_VOICES", "16"))
+
+# Edge TTS的语音名称格式，如zh-CN-XiaoxiaoNeural、zh-CN-liaoning-XiaobeiNeural
+_VOICE_NAME = re.compile(r'[a-z]{2,3}-[A-Z]{2}(?:-[A-Za-z]+)?-[A-Za-z]+Neural')
 
-# 定义临时目录
-TTS_TEMP_DIR = os.path.join(tempfile.gettempdir(), "tts_temp")
-# 确保临时目录存在
-os.makedirs(TTS_TEMP_DIR, exist_ok=True)
+# 所有语音合成共用一个常驻事件循环，在后台线程中运行
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    """获取常驻事件循环，第一次调用时启动后台线程"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="tts-loop", daemon=True).start()
+        return _loop
+
+def run_coroutine(coro):
+    """
+    在常驻事件循环中执行协程并等待结果，可以在任意线程（Flask请求、Socket.IO回调）中调用
+
+    Returns:
+        协程的返回值
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
 
 class TextToSpeech:
     """使用Edge TTS将文本转换为语音"""
     
-    def __init__(self, voice="zh-CN-XiaoxiaoNeural"):
+    def __init__(self, voice="zh-CN-XiaoxiaoNeural", use_cache=True):
         """
         初始化Edge TTS
         
@@ -30,60 +54,52 @@ class TextToSpeech:
                 - zh-CN-YunxiNeural (男声)
                 - zh-CN-YunyangNeural (男声)
                 - en-US-AriaNeural (英语女声)
+            use_cache: 是否使用全局语音缓存
         """
         self.voice = voice
+        self.use_cache = use_cache
+
+    @property
+    def cache(self):
+        """全局语音缓存，第一次使用时才加载磁盘索引（导入模块时不加载）"""
+        return tts_cache.get_cache() if self.use_cache else None
     
-    async def text_to_speech_async(self, text, output_file=None, rate="+0%", volume="+0%"):
+    async def text_to_speech_async(self, text, output_file, rate="+0%", volume="+0%"):
         """
-        将文本转换为语音
+        将文本转换为语音并保存到文件
         
         Args:
             text: 要转换的文本
-            output_file: 输出文件路径，如果为None则生成临时文件
+            output_file: 输出文件路径
             rate: 语速调整，如"+10%"表示加快10%
             volume: 音量调整，如"+10%"表示增加10%
             
         Returns:
-            输出文件路径
+            输出文件路径，失败时返回None
         """
-        try:
-            # 如果没有指定输出文件，创建临时文件
-            if output_file is None:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                output_file = os.path.join(TTS_TEMP_DIR, f"tts_{timestamp}.mp3")
-            
-            # 设置语音参数
-            communicate = edge_tts.Communicate(text, self.voice)
-            
-            # 调整语速和音量
-            if rate != "+0%":
-                communicate.rate = rate
-            if volume != "+0%":
-                communicate.volume = volume
-            
-            # 生成语音
-            await communicate.save(output_file)
-            
-            return output_file
-            
-        except Exception as e:
-            print(f"文本转语音出错: {e}")
+        success, result = await self.text_to_speech_bytes_async(text, rate, volume)
+        if not success:
             return None
+        # 文件写入不在事件循环线程中进行
+        return await asyncio.get_running_loop().run_in_executor(None, _save_audio, result, output_file)
 
-    def text_to_speech(self, text, output_file=None, rate="+0%", volume="+0%"):
+    def text_to_speech(self, text, output_file, rate="+0%", volume="+0%"):
         """
-        将文本转换为语音（同步版本）
+        将文本转换为语音并保存到文件（同步版本）
         
         Args:
             text: 要转换的文本
-            output_file: 输出文件路径，如果为None则生成临时文件
+            output_file: 输出文件路径
             rate: 语速调整，如"+10%"表示加快10%
             volume: 音量调整，如"+10%"表示增加10%
             
         Returns:
             输出文件路径
         """
-        return asyncio.run(self.text_to_speech_async(text, output_file, rate, volume))
+        success, result = self.text_to_speech_bytes(text, rate, volume)
+        if not success:
+            return None
+        return _save_audio(result, output_file)
 
     async def text_to_speech_bytes_async(self, text, rate="+0%", volume="+0%"):
         """
@@ -98,35 +114,27 @@ class TextToSpeech:
             成功时: (True, 语音的二进制数据)
             失败时: (False, 错误信息)
         """
-        temp_filename = None
+        if not text or text.strip() == "":
+            return False, "文本内容为空"
+        
+        # 缓存读写涉及磁盘，放到线程池中执行，不阻塞所有合成共用的事件循环
+        loop = asyncio.get_running_loop()
+        key = tts_cache.cache_key(text, self.voice, rate, volume)
+        if self.cache is not None:
+            audio_data = await loop.run_in_executor(None, self.cache.get, key)
+            if audio_data is not None:
+                return True, audio_data
+        
         try:
-            if not text or text.strip() == "":
-                return False, "文本内容为空"
-                
-            # 创建临时文件
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-            temp_filename = os.path.join(TTS_TEMP_DIR, f"tts_temp_{timestamp}.mp3")
-            
-            # 生成语音文件
-            await self.text_to_speech_async(text, temp_filename, rate, volume)
-            
-            # 读取文件内容
-            with open(temp_filename, "rb") as f:
-                audio_data = f.read()
-            
-            return True, audio_data
-            
+            audio_data = await self._synthesize_async(text, rate, volume)
         except Exception as e:
             error_msg = f"文本转语音出错: {str(e)}"
             print(error_msg)
             return False, error_msg
-        finally:
-            # 确保始终删除临时文件
-            if temp_filename and os.path.exists(temp_filename):
-                try:
-                    os.remove(temp_filename)
-                except Exception as e:
-                    print(f"删除临时文件出错: {e}")
+        
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.cache.put, key, audio_data)
+        return True, audio_data
     
     def text_to_speech_bytes(self, text, rate="+0%", volume="+0%"):
         """
@@ -141,27 +149,105 @@ class TextToSpeech:
             成功时: (True, 语音的二进制数据)
             失败时: (False, 错误信息)
         """
-        return asyncio.run(self.text_to_speech_bytes_async(text, rate, volume))
+        if not text or text.strip() == "":
+            return False, "文本内容为空"
+        
+        # 相同的文本和语音参数直接返回缓存的音频，缓存读写在调用方线程中进行，事件循环只负责网络合成
+        key = tts_cache.cache_key(text, self.voice, rate, volume)
+        if self.cache is not None:
+            audio_data = self.cache.get(key)
+            if audio_data is not None:
+                return True, audio_data
+        
+        try:
+            audio_data = run_coroutine(self._synthesize_async(text, rate, volume))
+        except Exception as e:
+            error_msg = f"文本转语音出错: {str(e)}"
+            print(error_msg)
+            return False, error_msg
+        
+        if self.cache is not None:
+            self.cache.put(key, audio_data)
+        return True, audio_data
+
+    async def _synthesize_async(self, text, rate, volume):
+        """调用Edge TTS合成，失败或没有音频时抛出异常"""
+        # 直接把音频帧收集到内存中，不经过临时文件
+        communicate = edge_tts.Communicate(text, self.voice, rate=rate, volume=volume)
+        buffer = BytesIO()
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                buffer.write(chunk["data"])
+        audio_data = buffer.getvalue()
+        if not audio_data:
+            raise RuntimeError("没有生成任何音频")
+        return audio_data
+
+def _save_audio(audio_data, output_file):
+    """保存音频到文件，失败时返回None"""
+    try:
+        with open(output_file, "wb") as f:
+            f.write(audio_data)
+        return output_file
+    except Exception as e:
+        print(f"保存语音文件出错: {e}")
+        return None
 
 # 创建默认实例
 default_tts = TextToSpeech()
 
-def text_to_speech(text, output_file=None, voice="zh-CN-XiaoxiaoNeural", rate="+0%", volume="+0%"):
+_instances = OrderedDict()  # {语音名称: TextToSpeech}，默认语音不在其中，不会被淘汰
+_instances_lock = threading.Lock()
+
+def is_valid_voice(voice):
+    """语音名称是否符合Edge TTS的格式"""
+    return isinstance(voice, str) and _VOICE_NAME.fullmatch(voice) is not None
+
+def get_tts(voice="zh-CN-XiaoxiaoNeural"):
+    """
+    获取指定语音的共享实例
+    
+    Args:
+        voice: 语音名称
+        
+    Returns:
+        TextToSpeech实例
+    
+    Raises:
+        ValueError: 语音名称格式不正确
+    """
+    if voice == default_tts.voice:
+        return default_tts
+    if not is_valid_voice(voice):
+        raise ValueError(f"不支持的语音: {voice}")
+    with _instances_lock:
+        tts = _instances.get(voice)
+        if tts is None:
+            tts = _instances[voice] = TextToSpeech(voice)
+            while len(_instances) > TTS_MAX_VOICES:
+                _instances.popitem(last=False)
+        else:
+            _instances.move_to_end(voice)
+        return tts
+
+def text_to_speech(text, output_file, voice="zh-CN-XiaoxiaoNeural", rate="+0%", volume="+0%"):
     """
-    将文本转换为语音的便捷函数
+    将文本转换为语音并保存到文件的便捷函数
     
     Args:
         text: 要转换的文本
-        output_file: 输出文件路径，如果为None则生成临时文件
+        output_file: 输出文件路径
         voice: 语音名称
         rate: 语速调整
         volume: 音量调整
         
     Returns:
-        输出文件路径
+        输出文件路径，失败时返回None
     """
-    tts = TextToSpeech(voice)
-    return tts.text_to_speech(text, output_file, rate, volume)
+    if not is_valid_voice(voice):
+        print(f"不支持的语音: {voice}")
+        return None
+    return get_tts(voice).text_to_speech(text, output_file, rate, volume)
 
 def text_to_speech_bytes(text, voice="zh-CN-XiaoxiaoNeural", rate="+0%", volume="+0%"):
     """
@@ -177,51 +263,6 @@ def text_to_speech_bytes(text, voice="zh-CN-XiaoxiaoNeural", rate="+0%", volume=
         成功时: (True, 语音的二进制数据)
         失败时: (False, 错误信息)
     """
-    tts = TextToSpeech(voice)
-    return tts.text_to_speech_bytes(text, rate, volume)
-
-def cleanup_temp_files(max_age_hours=24):
-    """
-    清理过期的临时文件
-    
-    Args:
-        max_age_hours: 文件保留的最大小时数
-    """
-    try:
-        print(f"正在清理临时文件，保留最近{max_age_hours}小时内的文件...")
-        now = datetime.now()
-        cutoff_time = now - timedelta(hours=max_age_hours)
-        
-        # 获取所有tts开头的临时文件
-        file_pattern = os.path.join(TTS_TEMP_DIR, "tts_*.mp3")
-        for file_path in glob.glob(file_pattern):
-            try:
-                file_stat = os.stat(file_path)
-                file_mtime = datetime.fromtimestamp(file_stat.st_mtime)
-                
-                # 如果文件超过最大保留时间，删除它
-                if file_mtime < cutoff_time:
-                    os.remove(file_path)
-                    print(f"已删除过期临时文件: {file_path}")
-            except Exception as e:
-                print(f"处理临时文件出错: {file_path}, 错误: {e}")
-    except Exception as e:
-        print(f"清理临时文件时出错: {e}")
-
-def start_cleanup_scheduler():
-    """启动定期清理临时文件的调度器"""
-    def cleanup_task():
-        while True:
-            cleanup_temp_files()
-            # 每小时运行一次清理
-            time.sleep(3600)
-    
-    # 在后台线程中启动清理任务
-    cleanup_thread = threading.Thread(target=cleanup_task, daemon=True)
-    cleanup_thread.start()
-    print("已启动临时文件清理调度器")
-
-# 应用启动时执行一次清理
-cleanup_temp_files()
-# 启动定期清理
-start_cleanup_scheduler() 
\ No newline at end of file
+    if not is_valid_voice(voice):
+        return False, f"不支持的语音: {voice}"
+    return get_tts(voice).text_to_speech_bytes(text, rate, volume)
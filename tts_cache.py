@@ -0,0 +1,206 @@
+"""
+语音缓存模块 - 按(文本, 语音, 语速, 音量)缓存合成好的音频，内存和磁盘两级，超出容量时淘汰最久未访问的条目
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 缓存配置
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_MEMORY_BYTES = int(os.getenv("TTS_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+TTS_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+
+
+def cache_key(text, voice, rate, volume):
+    """计算缓存键（内容哈希）"""
+    content = "\x00".join([voice, rate, volume, text])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class TTSCache:
+    """
+    两级语音缓存
+
+    内存中保存最近使用的音频，磁盘上每条音频保存为一个以缓存键命名的mp3文件，
+    重启后仍然可用。两级都按最近访问顺序淘汰。
+    """
+
+    def __init__(self, cache_dir=TTS_CACHE_DIR, max_memory_bytes=TTS_CACHE_MEMORY_BYTES,
+                 max_disk_bytes=TTS_CACHE_DISK_BYTES):
+        """
+        初始化缓存
+
+        Args:
+            cache_dir: 磁盘缓存目录
+            max_memory_bytes: 内存缓存的最大字节数
+            max_disk_bytes: 磁盘缓存的最大字节数
+        """
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+
+        self._memory = OrderedDict()  # {缓存键: 音频数据}
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # {缓存键: 文件大小}，按最近访问排序
+        self._disk_bytes = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_disk_index()
+
+    def get(self, key):
+        """
+        查询缓存
+
+        Returns:
+            音频数据，未命中时返回None
+        """
+        with self._lock:
+            audio_data = self._memory.get(key)
+            if audio_data is not None:
+                self._memory.move_to_end(key)
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+                self.memory_hits += 1
+                return audio_data
+            on_disk = key in self._disk
+
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    audio_data = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                audio_data = None
+
+        with self._lock:
+            if audio_data is None:
+                if on_disk:
+                    self._forget_disk(key)
+                self.misses += 1
+                return None
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._remember(key, audio_data)
+            self.disk_hits += 1
+        return audio_data
+
+    def put(self, key, audio_data):
+        """写入缓存"""
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(audio_data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"写入语音缓存出错: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            with self._lock:
+                self._remember(key, audio_data)
+            return
+
+        with self._lock:
+            self._forget_disk(key)
+            self._disk[key] = len(audio_data)
+            self._disk_bytes += len(audio_data)
+            self._remember(key, audio_data)
+            self._evict_disk()
+
+    def stats(self):
+        """获取缓存统计信息"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            }
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp3")
+
+    def _load_disk_index(self):
+        # 按修改时间恢复访问顺序，命中时会更新文件的修改时间
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith(".mp3"):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name[:-len(".mp3")], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        with self._lock:
+            self._evict_disk()
+        if entries:
+            print(f"已加载语音缓存: {len(self._disk)} 条, {self._disk_bytes / 1024 / 1024:.1f} MB")
+
+    def _remember(self, key, audio_data):
+        """放入内存缓存（调用方需持有self._lock）"""
+        if len(audio_data) > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = audio_data
+        self._memory_bytes += len(audio_data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _forget_disk(self, key):
+        """从磁盘索引中移除（调用方需持有self._lock）"""
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _evict_disk(self):
+        """淘汰最久未访问的磁盘文件（调用方需持有self._lock）"""
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError as e:
+                print(f"删除语音缓存文件出错: {e}")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """获取全局语音缓存实例"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TTSCache()
+        return _cache
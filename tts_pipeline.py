@@ -0,0 +1,157 @@
+"""
+语音合成流水线模块 - 把流式生成的文本按句子切分，多个句子并行合成，按原顺序输出音频
+"""
+
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 同时进行的语音合成数量
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "3"))
+# 整段文本合成时，每个请求最多同时提交的句子数，其余句子在前面的句子交付后再提交
+TTS_STREAM_WINDOW = int(os.getenv("TTS_STREAM_WINDOW", "3"))
+# 句子短于该长度时与下一句合并，减少过碎的合成请求
+TTS_MIN_SEGMENT_CHARS = 6
+# 没有句末标点时，文本超过该长度就在逗号等位置切分
+TTS_MAX_SEGMENT_CHARS = 80
+
+# 句末标点（英文句点后需要跟空白，避免切开小数和缩写）
+_SENTENCE_END = re.compile(r'[。！？!?；;\n]+|\.(?=\s)')
+_CLAUSE_END = re.compile(r'[，,、：:]')
+
+_executor = ThreadPoolExecutor(max_workers=TTS_CONCURRENCY, thread_name_prefix="tts")
+
+
+class SentenceSegmenter:
+    """把逐个到达的文本片段切分成适合语音合成的句子"""
+
+    def __init__(self, min_chars=TTS_MIN_SEGMENT_CHARS, max_chars=TTS_MAX_SEGMENT_CHARS):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def feed(self, text):
+        """
+        追加文本
+
+        Returns:
+            已经完整的句子列表
+        """
+        self._buffer += text
+        segments = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            if match.end() - start >= self.min_chars:
+                segments.append(self._buffer[start:match.end()])
+                start = match.end()
+        self._buffer = self._buffer[start:]
+
+        # 长句没有句末标点时在分句标点处切开，尽早开始合成
+        while len(self._buffer) > self.max_chars:
+            clause_ends = [m.end() for m in _CLAUSE_END.finditer(self._buffer, 0, self.max_chars)]
+            cut = clause_ends[-1] if clause_ends else self.max_chars
+            segments.append(self._buffer[:cut])
+            self._buffer = self._buffer[cut:]
+
+        return [segment for segment in segments if segment.strip()]
+
+    def flush(self):
+        """
+        取出剩余的文本
+
+        Returns:
+            剩余文本组成的句子列表（可能为空）
+        """
+        rest, self._buffer = self._buffer, ""
+        return [rest] if rest.strip() else []
+
+
+class TTSPipeline:
+    """
+    并行合成多个句子，按提交顺序交付结果
+
+    合成在线程池中进行，调用方可以一边继续发送文本，一边用ready()取出已经按顺序完成的音频，
+    最后用drain()等待剩余的句子。客户端断开或出错时调用close()取消还没有开始的合成。
+    """
+
+    def __init__(self, synthesize):
+        """
+        Args:
+            synthesize: 合成函数，接收文本，返回音频二进制数据，失败时抛出异常
+        """
+        self.synthesize = synthesize
+        self._futures = []  # 按顺序排列的 (序号, 文本, future)
+        self._next_seq = 0
+        self._lock = threading.Lock()
+
+    def submit(self, text):
+        """
+        提交一个句子进行合成
+
+        Returns:
+            句子的序号
+        """
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._futures.append((seq, text, _executor.submit(self._synthesize, text)))
+        return seq
+
+    def ready(self):
+        """
+        取出已经完成且前面的句子都已交付的结果，不阻塞
+
+        Returns:
+            结果列表，每项为{'seq', 'text', 'audio', 'error', 'synthesis_ms'}
+        """
+        results = []
+        with self._lock:
+            while self._futures and self._futures[0][2].done():
+                results.append(self._pop_result())
+        return results
+
+    def drain(self):
+        """
+        等待剩余的句子，按顺序逐个返回结果，每完成一个就立即返回
+
+        Yields:
+            结果，格式同ready()
+        """
+        while True:
+            with self._lock:
+                if not self._futures:
+                    return
+                future = self._futures[0][2]
+            future.result()
+            with self._lock:
+                result = self._pop_result()
+            yield result
+
+    def close(self):
+        """
+        取消还没有开始的合成并丢弃所有未交付的结果，正在进行的合成完成后结果被忽略
+
+        Returns:
+            被取消的句子数量
+        """
+        with self._lock:
+            futures, self._futures = self._futures, []
+        return sum(1 for _, _, future in futures if future.cancel())
+
+    def _synthesize(self, text):
+        started_at = time.monotonic()
+        try:
+            audio = self.synthesize(text)
+            error = None
+        except Exception as e:
+            print(f"合成语音片段出错: {e}")
+            audio, error = None, str(e)
+        return audio, error, (time.monotonic() - started_at) * 1000
+
+    def _pop_result(self):
+        # 调用方需持有self._lock
+        seq, text, future = self._futures.pop(0)
+        audio, error, synthesis_ms = future.result()
+        return {'seq': seq, 'text': text, 'audio': audio, 'error': error, 'synthesis_ms': synthesis_ms}
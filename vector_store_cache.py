@@ -0,0 +1,189 @@
+"""
+向量存储缓存模块 - 进程内按智能体共享FAISS索引，带内存预算和LRU淘汰
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+def estimate_store_size(vector_store_path):
+    """
+    估算向量存储加载到内存后的大小
+
+    FAISS的index.faiss和index.pkl在磁盘上的大小与反序列化后的内存占用基本一致，
+    这里直接用目录下文件的总大小作为估算值。
+
+    Args:
+        vector_store_path: 向量存储目录
+
+    Returns:
+        估算的字节数
+    """
+    total = 0
+    if not os.path.isdir(vector_store_path):
+        return total
+    for name in os.listdir(vector_store_path):
+        file_path = os.path.join(vector_store_path, name)
+        if os.path.isfile(file_path):
+            total += os.path.getsize(file_path)
+    return total
+
+
+class _CacheEntry:
+    """缓存条目"""
+
+    __slots__ = ('store', 'size')
+
+    def __init__(self, store, size):
+        self.store = store
+        self.size = size
+
+
+class VectorStoreCache:
+    """按智能体ID缓存已加载的向量存储，超出内存预算时淘汰最久未使用的条目"""
+
+    def __init__(self, max_bytes):
+        """
+        初始化缓存
+
+        Args:
+            max_bytes: 缓存的内存预算（字节）
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # {agent_id: _CacheEntry}，末尾为最近使用
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self._loading_locks = {}  # {agent_id: Lock}，避免同一索引被并发重复加载
+        self._generations = {}  # {agent_id: int}，失效时递增，丢弃失效前开始的加载结果
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, agent_id, vector_store_path, loader):
+        """
+        获取智能体的向量存储，未命中时用loader从磁盘加载并放入缓存
+
+        Args:
+            agent_id: 智能体ID
+            vector_store_path: 向量存储目录
+            loader: 加载函数，接收向量存储目录，返回向量存储对象
+
+        Returns:
+            向量存储对象
+        """
+        with self._lock:
+            store = self._lookup(agent_id)
+            if store is not None:
+                return store
+            loading_lock = self._loading_locks.setdefault(agent_id, threading.Lock())
+
+        with loading_lock:
+            # 等待期间可能已被其他线程加载完成
+            with self._lock:
+                store = self._lookup(agent_id)
+                if store is not None:
+                    return store
+                self.misses += 1
+                generation = self._generations.get(agent_id, 0)
+
+            store = loader(vector_store_path)
+            size = estimate_store_size(vector_store_path)
+
+            with self._lock:
+                if self._generations.get(agent_id, 0) == generation:
+                    self._insert(agent_id, store, size)
+            return store
+
+    def put(self, agent_id, store, size):
+        """
+        直接放入（或替换）智能体的向量存储
+
+        Args:
+            agent_id: 智能体ID
+            store: 向量存储对象
+            size: 估算的字节数
+        """
+        with self._lock:
+            self._generations[agent_id] = self._generations.get(agent_id, 0) + 1
+            self._remove(agent_id)
+            self._insert(agent_id, store, size)
+
+    def invalidate(self, agent_id):
+        """
+        使智能体的缓存失效，在智能体被删除或知识库变化时调用
+
+        Args:
+            agent_id: 智能体ID
+        """
+        with self._lock:
+            self._generations[agent_id] = self._generations.get(agent_id, 0) + 1
+            self._remove(agent_id)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            for agent_id in list(self._entries.keys()):
+                self._generations[agent_id] = self._generations.get(agent_id, 0) + 1
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def stats(self):
+        """获取缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'current_bytes': self._current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    # --- 内部方法（调用方需持有self._lock） ---
+
+    def _lookup(self, agent_id):
+        entry = self._entries.get(agent_id)
+        if entry is None:
+            return None
+        self._entries.move_to_end(agent_id)
+        self.hits += 1
+        return entry.store
+
+    def _insert(self, agent_id, store, size):
+        if size > self.max_bytes:
+            print(f"向量存储 {agent_id} 大小 {size} 字节超出缓存预算，不进行缓存")
+            return
+        self._entries[agent_id] = _CacheEntry(store, size)
+        self._current_bytes += size
+        while self._current_bytes > self.max_bytes and self._entries:
+            evicted_id, evicted = self._entries.popitem(last=False)
+            self._current_bytes -= evicted.size
+            self.evictions += 1
+            print(f"向量存储缓存已满，淘汰智能体 {evicted_id} 的索引")
+
+    def _remove(self, agent_id):
+        entry = self._entries.pop(agent_id, None)
+        if entry is not None:
+            self._current_bytes -= entry.size
+
+
+# 单例模式，整个进程共享一个缓存
+_instance = None
+
+def get_cache(max_mb=None):
+    """
+    获取VectorStoreCache实例（单例模式）
+
+    Args:
+        max_mb: 内存预算（MB），为None时读取环境变量VECTOR_STORE_CACHE_MB，默认512
+    """
+    global _instance
+    if _instance is None:
+        if max_mb is None:
+            max_mb = int(os.getenv("VECTOR_STORE_CACHE_MB", "512"))
+        _instance = VectorStoreCache(max_mb * 1024 * 1024)
+    return _instance